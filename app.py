@@ -1,15 +1,29 @@
-from search.search_query import (get_collection,
-                                load_data_into_collection, 
-                                query_db,
-                                print_results,
-                                )
-from utils.image_utils import show_image_from_path
+from search.serving import (get_duplicate_clusters,
+                            get_image_embedding_cache,
+                            get_lexical_index,
+                            get_metadata_store,
+                            get_query_embedding_cache,
+                            query_db,
+                            start_warm_up,
+                            )
+from search.query_filters import describe_where, parse_query_constraints
 from utils.langchain import (format_prompt_inputs,
                             get_vision_model,
                             get_image_prompt_template,
+                            PROMPT_TEMPLATE_VERSION,
                             )
+from utils.response_cache import ResponseCache
+from utils.metrics import (StageTimer,
+                        REGISTRY,
+                        increment,
+                        metrics_enabled,
+                        observe,
+                        render_prometheus,
+                        )
 from langchain_core.output_parsers import StrOutputParser
+from concurrent.futures import ThreadPoolExecutor
 
+import time
 import streamlit as st
 
 import warnings
@@ -21,24 +35,89 @@ warnings.filterwarnings("ignore")
 st.title("Multi-Modal RAG Product Search and Recommendation System")
 
 
-@st.cache_resource
+def get_cached_warm_up():
+    # loads the model, opens the collection and runs a dummy query on a background thread;
+    # start_warm_up keeps the future per process itself, and starts over after a failure
+    return start_warm_up()
+
+
 def get_cached_collection():
-    return get_collection()
+    # blocks only while the warm-up is still running
+    collection, _ = get_cached_warm_up().result()
+    return collection
+
+
+@st.cache_resource
+def get_cached_metadata_store():
+    return get_metadata_store()
+
+
+@st.cache_resource
+def get_cached_query_embedding_cache():
+    return get_query_embedding_cache()
+
+
+@st.cache_resource
+def get_cached_image_embedding_cache():
+    return get_image_embedding_cache()
+
+
+@st.cache_resource
+def get_cached_categories():
+    return get_cached_metadata_store().distinct_values("main_category")
+
+
+@st.cache_resource
+def get_cached_lexical_index():
+    return get_lexical_index()
+
+
+@st.cache_resource
+def get_cached_duplicate_clusters():
+    return get_duplicate_clusters()
+
+
+@st.cache_resource
+def get_cached_response_cache():
+    return ResponseCache()
+
+
+@st.cache_resource
+def get_cached_executor():
+    # background workers for stages that overlap with rendering (image reads, base64 encoding)
+    return ThreadPoolExecutor(max_workers = 4)
 
 
 @st.cache_resource
 def get_cached_vision_model(model_name="gpt-4o", temperature=0.0):
-    return get_vision_model(model_name, temperature)
+    # created in the background too: langchain_openai is slow to import
+    return get_cached_executor().submit(get_vision_model, model_name, temperature)
 
 
 if __name__ == "__main__":
     print("Welcome to Multimodal RAG Product Search!")
-    
-    # get collection
-    product_collection = get_cached_collection()
+
+    # start loading the model and collection; the page renders meanwhile
+    warm_up = get_cached_warm_up()
+
+    # full product records (descriptions etc.) are looked up by id
+    metadata_store = get_cached_metadata_store()
+
+    # BM25 index for hybrid retrieval; ASINs, model numbers and store names skip the text encoder
+    lexical_index = get_cached_lexical_index()
+    retrieval_mode = "hybrid" if len(lexical_index) else "vector"
+
+    # near-duplicate clusters (colour variants, relists): each retrieval slot shows a distinct product
+    duplicate_clusters = get_cached_duplicate_clusters()
+    if not len(duplicate_clusters):
+        duplicate_clusters = None
+
+    # answers already generated for the same products and (near-)same question
+    response_cache = get_cached_response_cache()
 
     # load the vision model 
-    vision_model = get_cached_vision_model(model_name = "gpt-4o", temperature = 0.0)
+    model_name = "gpt-4o"
+    vision_model_future = get_cached_vision_model(model_name = model_name, temperature = 0.0)
     
     # output parser
     parser = StrOutputParser()
@@ -46,30 +125,125 @@ if __name__ == "__main__":
     # get the prompt template
     image_prompt = get_image_prompt_template()
 
-    # create the chain:
-    vision_chain = image_prompt | vision_model | parser
+    # display only, per session: collection is process-wide and controlled by RAG_METRICS=1
+    show_metrics = st.sidebar.checkbox("Show debug metrics", value = False)
+
+    if not warm_up.done():
+        st.sidebar.caption("Loading the search model in the background...")
+    elif warm_up.exception() is None:
+        st.sidebar.caption(f"Search model ready (warm-up took {warm_up.result()[1]['total']:.1f} s)")
+    else:
+        st.sidebar.error(f"Search model failed to load: {warm_up.exception()!r}. It is retried with the next query.")
 
     query = st.text_input("Enter your query (ex: 'advanced dj controller')")
+    uploaded = st.file_uploader("...and/or search with an image", type = ["jpg", "jpeg", "png", "webp"])
+
+    # an upload replaces the product picked with "More like this"
+    if uploaded is not None:
+        st.session_state.pop("similar_to", None)
+        query_image = uploaded.getvalue()
+    else:
+        query_image = st.session_state.get("similar_to")
+    if query_image is not None:
+        st.image(query_image, caption = "Query image", width = 160)
+        if "similar_to" in st.session_state and st.sidebar.button("Clear image"):
+            st.session_state.pop("similar_to", None)
+            st.rerun()
+    image_weight = st.sidebar.slider("Image weight in text + image queries", 0.0, 1.0, 0.5) if query and query_image is not None else 0.5
 
     # display input query:
-    if query:
-        st.write(f"Your query: {query}")
+    if query or query_image is not None:
+        if query:
+            st.write(f"Your query: {query}")
+        # the vision model still needs a question when searching by image alone
+        user_query = query or "Products that look like the image I searched with"
     
-        # fetch the images from VectorDB based on text query
-        with st.spinner("Retrieving images..."):
-            results = query_db(query = query, collection = product_collection, n_results = 2)
-        
+        timer = StageTimer()
+
+        # the model-backed resources wait for the warm-up if a query arrives before it is done
+        with timer.stage("wait_ready"):
+            product_collection = get_cached_collection()
+            # repeated queries reuse their text embeddings instead of re-running OpenCLIP
+            embedding_cache = get_cached_query_embedding_cache()
+            # uploaded and "more like this" images reuse their embeddings, keyed by content hash
+            image_cache = get_cached_image_embedding_cache()
+
+        # price, rating and category constraints become a metadata filter applied inside the search
+        search_text, where = parse_query_constraints(query, get_cached_categories()) if query else ("", None)
+        if where:
+            st.caption(f"Filters: {describe_where(where)}")
+
+        # fetch the images from VectorDB based on the text and/or image query
+        image_misses = image_cache.misses
+        with st.spinner("Retrieving images..."), timer.stage("retrieve"):
+            results = query_db(query = search_text, collection = product_collection, n_results = 2, metadata_store = metadata_store, embedding_cache = embedding_cache, lexical_index = lexical_index, mode = retrieval_mode, where = where,
+                               image = query_image, image_cache = image_cache, image_weight = image_weight, duplicate_clusters = duplicate_clusters)
+        if query_image is not None:
+            encoded = "encoded" if image_cache.misses > image_misses else "cached embedding"
+            st.caption(f"Image query retrieval: {timer.seconds['retrieve'] * 1000:.0f} ms ({encoded})")
+            observe("app.image_query", timer.seconds["retrieve"])
+
+        # start reading and base64-encoding the images while they are being rendered
+        prompt_future = get_cached_executor().submit(format_prompt_inputs, data = results, user_query = user_query)
+
         # display the retrieved images
         st.write("Here are the top products based on your query:")
-        for i in range(len(results["uris"][0])):
-            st.image(image = results["uris"][0][i], caption = results["metadatas"][0][i]["title"])
-
-        # format the prompt_inputs according to the results and query
-        # invoke the chain with the prompt input
-        with st.spinner("Generating suggestions..."):
-            prompt_input = format_prompt_inputs(data = results, user_query = query)
-            response = vision_chain.invoke(prompt_input)
+        with timer.stage("render"):
+            for i in range(len(results["uris"][0])):
+                st.image(image = results["uris"][0][i], caption = results["metadatas"][0][i]["title"])
+                if st.button("More like this", key = f"similar_{results['ids'][0][i]}"):
+                    st.session_state["similar_to"] = results["uris"][0][i]
+                    st.rerun()
+
+        product_ids = results["ids"][0]
+        with timer.stage("cache_lookup"):
+            # reuse the text embedding retrieval computed; queries that never reached the encoder
+            # (lexical fast path, image only) get an exact-match lookup instead of encoding here
+            query_embedding = embedding_cache.peek(search_text) if search_text else None
+            response = response_cache.get(product_ids, model_name, PROMPT_TEMPLATE_VERSION, user_query, query_embedding)
 
         # print the response:
         st.markdown("\n Here is some information about the product query: \n")
-        st.write(response)
+        if response is not None:
+            prompt_future.cancel()
+            st.write(response)
+        else:
+            with timer.stage("prompt_wait"):
+                prompt_input = prompt_future.result()
+
+            # create the chain:
+            vision_chain = image_prompt | vision_model_future.result() | parser
+
+            # stream the answer into the page token by token
+            def stream_answer():
+                start = time.perf_counter()
+                first = True
+                for token in vision_chain.stream(prompt_input):
+                    if first:
+                        timer.record("first_token", time.perf_counter() - start)
+                        first = False
+                    yield token
+
+            try:
+                with timer.stage("generate"):
+                    response = st.write_stream(stream_answer())
+            except Exception:
+                increment("generation.errors")
+                raise
+            response_cache.put(product_ids, model_name, PROMPT_TEMPLATE_VERSION, user_query, response, query_embedding)
+
+        print(f"Stage timings for {user_query!r}: {timer.format_ms()}")
+        for stage, seconds in timer.seconds.items():
+            observe(f"app.{stage}", seconds)
+
+    if show_metrics and not metrics_enabled():
+        st.sidebar.caption("Metrics are not being collected; start the app with RAG_METRICS=1.")
+    elif show_metrics:
+        with st.sidebar.expander("Latency and cache metrics", expanded = True):
+            snapshot = REGISTRY.snapshot()
+            st.dataframe(
+                [{"span": name, **stats} for name, stats in snapshot["spans"].items()],
+                hide_index = True,
+            )
+            st.json(snapshot["counters"])
+            st.code(render_prometheus(), language = "text")
@@ -0,0 +1,115 @@
+"""
+Recall/latency/memory sweep of the in-process vector indexes in search.ann_index.
+
+Exact search is the ground truth. Every IVF configuration (nlist x nprobe x quantizer x rerank)
+is scored by recall@k against it, single-query latency percentiles, batched queries/sec and
+resident index size relative to the float32 vectors. Uses clustered synthetic unit vectors
+(like CLIP embeddings) unless --store points at a real embedding store.
+
+Usage:
+    python -m benchmarks.bench_ann --vectors 200000 --dim 512 --nlist 256 1024 --nprobe 4 16 64
+    python -m benchmarks.bench_ann --store ./data/embeddings --quantizer none int8 pq --rerank 0 4
+"""
+import json
+import time
+import argparse
+import itertools
+
+import numpy as np
+
+from search.ann_index import ExactIndex, IVFIndex
+from search.embedding_store import EmbeddingStore
+from utils.metrics import percentiles
+
+
+def synthetic_vectors(n: int, dim: int, clusters: int = 1000, spread: float = 0.35, seed: int = 0) -> np.ndarray:
+    """Unit vectors scattered around random cluster centres."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    vectors = centres[rng.integers(0, clusters, n)]
+    vectors += spread / np.sqrt(dim) * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def measure(index, queries: np.ndarray, k: int, truth: np.ndarray = None, batch_size: int = 256) -> dict:
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        rows, _ = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(rows[0])
+
+    start = time.perf_counter()
+    for offset in range(0, len(queries), batch_size):
+        index.search(queries[offset:offset + batch_size], k)
+    batched_s = time.perf_counter() - start
+
+    stats = {f"{name}_ms": round(value, 3) for name, value in percentiles(latencies).items()}
+    stats["batched_qps"] = round(len(queries) / batched_s, 1)
+    stats["memory_mb"] = round(index.memory_bytes() / 1e6, 2)
+    if truth is not None:
+        stats["recall"] = round(float(np.mean([len(set(f.tolist()) & set(t.tolist())) / k for f, t in zip(found, truth)])), 4)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", default=None, help="embedding store directory (default: synthetic vectors)")
+    parser.add_argument("--vectors", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, nargs="+", default=[256, 1024])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--quantizer", nargs="+", default=["none", "int8", "pq"])
+    parser.add_argument("--pq-m", type=int, default=64, help="PQ sub-vectors (bytes per vector)")
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    if args.store:
+        ids, uris, vectors = EmbeddingStore(args.store).as_arrays()
+    else:
+        vectors = synthetic_vectors(args.vectors + args.queries, args.dim)
+        ids = uris = [str(i) for i in range(args.vectors)]
+    rng = np.random.default_rng(1)
+    if args.store:
+        # held-out queries: perturbed copies of stored vectors
+        queries = np.asarray(vectors[np.sort(rng.choice(len(ids), args.queries, replace=False))], dtype=np.float32)
+        queries += 0.05 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    else:
+        vectors, queries = vectors[:args.vectors], vectors[args.vectors:]
+    float32_mb = len(ids) * vectors.shape[1] * 4 / 1e6
+
+    exact = ExactIndex(ids, uris, vectors)
+    truth, _ = exact.search(queries, args.k)
+    results = [{"index": "exact", **measure(exact, queries, args.k, truth)}]
+
+    for nlist, quantizer in itertools.product(args.nlist, args.quantizer):
+        start = time.perf_counter()
+        index = IVFIndex(ids, uris, vectors, nlist = nlist, quantizer = quantizer, pq_m = args.pq_m)
+        # nlist is capped for small vector counts, so the label uses the trained value
+        build_s = time.perf_counter() - start
+        for nprobe, rerank in itertools.product(args.nprobe, args.rerank):
+            if rerank and quantizer == "none":
+                continue
+            index.nprobe, index.rerank = nprobe, rerank
+            results.append({"index": f"ivf{index.nlist},{quantizer}", "nprobe": nprobe, "rerank": rerank,
+                            "build_s": round(build_s, 2), **measure(index, queries, args.k, truth)})
+
+    print(f"{len(ids)} vectors x {vectors.shape[1]} dims, {args.queries} queries, recall@{args.k}; "
+          f"float32 vectors take {float32_mb:.1f} MB")
+    print(f"{'index':<18} {'nprobe':>6} {'rerank':>6} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'qps':>9} {'MB':>9} {'of f32':>7}")
+    for r in results:
+        print(f"{r['index']:<18} {r.get('nprobe', '-'):>6} {r.get('rerank', '-'):>6} {r['recall']:>7.3f} "
+              f"{r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['batched_qps']:>9.1f} {r['memory_mb']:>9.1f} "
+              f"{r['memory_mb'] / float32_mb:>6.0%}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "float32_mb": round(float32_mb, 2), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Concurrency check of the async RAG pipeline against a stub chat model with configurable latency.
+
+With N concurrent requests and an LLM latency of L seconds, wall time should stay close to L
+(plus retrieval) rather than N * L, showing one worker holds many in-flight requests.
+
+Usage:
+    python -m benchmarks.bench_async_pipeline --requests 50 --latency 2.0
+"""
+import time
+import asyncio
+import argparse
+
+from langchain_core.output_parsers import StrOutputParser
+
+from search.serving import get_collection, get_metadata_store
+from search.rag_pipeline import AsyncRAGPipeline
+from utils.langchain import get_image_prompt_template, get_stub_vision_model
+from utils.metrics import percentiles
+
+
+async def run(args):
+    chain = get_image_prompt_template() | get_stub_vision_model(latency=args.latency) | StrOutputParser()
+    pipeline = AsyncRAGPipeline(
+        collection=get_collection(),
+        chain=chain,
+        metadata_store=get_metadata_store(),
+        max_concurrency=args.concurrency,
+        generation_timeout=args.latency * 10,
+    )
+    queries = [f"{args.query} {i}" for i in range(args.requests)]
+
+    start = time.perf_counter()
+    outputs = await pipeline.answer_many(queries)
+    wall = time.perf_counter() - start
+    pipeline.close()
+
+    ok = [o for o in outputs if not isinstance(o, BaseException)]
+    print(f"{len(ok)}/{len(queries)} requests succeeded in {wall:.2f}s "
+          f"(stub latency {args.latency:.2f}s, serial lower bound {args.latency * len(queries):.2f}s)")
+    for stage in ("queue", "retrieve", "prompt", "generate", "total"):
+        stats = percentiles(o["timings"][stage] for o in ok)
+        print(f"  {stage:<9} " + "  ".join(f"{k}={v * 1000:.1f}ms" for k, v in stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=2.0, help="stub LLM latency in seconds")
+    parser.add_argument("--query", default="advanced dj controller")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
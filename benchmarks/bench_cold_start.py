@@ -0,0 +1,152 @@
+"""
+Cold start of a serving process: import time, time until ready and first-query latency.
+
+Every measurement runs in a fresh interpreter. Import probes time importing a module set and
+list which heavy dependencies it pulled in. Startup runs then open the collection and query it
+as a new replica would:
+- lazy: nothing is loaded until the first query, which opens the collection and the model;
+- warm-up: search.serving.start_warm_up runs at process start, and the first query arrives
+  after --think seconds, like a user typing into a freshly loaded page.
+By default the collection is a synthetic one with the fake embedding function; --db points at a
+real collection, which is then opened with the OpenCLIP model.
+
+Usage:
+    python -m benchmarks.bench_cold_start --products 20000 --repeats 3
+    python -m benchmarks.bench_cold_start --db ./data/products_base.db --think 10
+"""
+# only the standard library at module level: this file is also the child process being timed
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+IMPORT_PROBES = {
+    "search.search_query (combined)": ["search.search_query"],
+    "search.ingestion": ["search.ingestion"],
+    "search.serving": ["search.serving"],
+    "app imports": ["search.serving", "search.query_filters", "utils.langchain", "utils.response_cache", "utils.metrics"],
+}
+HEAVY_MODULES = ["torch", "open_clip", "chromadb", "datasets", "pandas", "pyarrow", "matplotlib", "tqdm", "langchain_openai"]
+QUERIES = ["portable bluetooth speaker", "studio headphones"]
+
+
+def probe_imports(modules: list) -> dict:
+    start = time.perf_counter()
+    for module in modules:
+        __import__(module)
+    return {"import_s": time.perf_counter() - start, "heavy": [m for m in HEAVY_MODULES if m in sys.modules]}
+
+
+def startup(mode: str, db: str, think: float, fake_dim: int) -> dict:
+    start = time.perf_counter()
+    import search.serving as serving
+    result = {"import_s": time.perf_counter() - start}
+
+    if fake_dim:
+        from benchmarks.synthetic import FakeEmbeddingFunction
+        embedding_function = FakeEmbeddingFunction(dim=fake_dim)
+    else:
+        embedding_function = None
+
+    def open_collection():
+        return serving.get_or_create_vector_db(db, embedding_function or serving.get_embedding_function())
+
+    if mode == "warm-up":
+        future = serving.start_warm_up(open_collection=open_collection, embedding_function=embedding_function)
+    time.sleep(think)
+
+    latencies = []
+    for query in QUERIES:
+        t0 = time.perf_counter()
+        if mode == "warm-up":
+            collection, seconds = future.result()
+            result["ready_s"] = seconds["total"]
+        elif not latencies:
+            collection = open_collection()
+        serving.query_db(query, collection, n_results=5)
+        latencies.append(time.perf_counter() - t0)
+    result["first_query_ms"], result["second_query_ms"] = latencies[0] * 1000, latencies[1] * 1000
+    result["process_s"] = time.perf_counter() - start
+    return result
+
+
+def run_child(*args) -> dict:
+    output = subprocess.run([sys.executable, "-m", "benchmarks.bench_cold_start", *args],
+                            capture_output=True, text=True, check=True).stdout
+    # the last line is the JSON result; anything before it is the code's own logging
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def build_synthetic_db(path: str, products: int, dim: int):
+    from benchmarks.bench_ann import synthetic_vectors
+    from benchmarks.synthetic import FakeEmbeddingFunction
+    from search.serving import get_or_create_vector_db
+
+    collection = get_or_create_vector_db(path, FakeEmbeddingFunction(dim=dim))
+    vectors = synthetic_vectors(products, dim)
+    for start in range(0, products, 5000):
+        ids = [f"B0{i:08d}" for i in range(start, min(start + 5000, products))]
+        collection.add(ids=ids, embeddings=vectors[start:start + len(ids)], uris=[f"image_{asin}.png" for asin in ids])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=None, help="existing Chroma db to open with OpenCLIP (default: synthetic)")
+    parser.add_argument("--products", type=int, default=20000, help="size of the synthetic collection")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--think", type=float, default=3.0, help="seconds between process start and the first query")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--modules", nargs="+", default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == "imports":
+        print(json.dumps(probe_imports(args.modules)))
+        return
+    if args.child:
+        print(json.dumps(startup(args.child, args.db, args.think, args.dim)))
+        return
+
+    workdir = None
+    # a real collection is opened with the real model: children get --dim 0
+    fake_dim = 0 if args.db else args.dim
+    if args.db is None:
+        workdir = tempfile.mkdtemp(prefix="rag-cold-start-")
+        args.db = os.path.join(workdir, "chroma.db")
+        build_synthetic_db(args.db, args.products, args.dim)
+
+    try:
+        results = {"imports": {}, "startup": {}}
+        print(f"{'import probe':<32} {'seconds':>8}  heavy modules loaded")
+        for name, modules in IMPORT_PROBES.items():
+            runs = [run_child("--child", "imports", "--modules", *modules) for _ in range(args.repeats)]
+            seconds = statistics.median(r["import_s"] for r in runs)
+            results["imports"][name] = {"import_s": round(seconds, 3), "heavy": runs[0]["heavy"]}
+            print(f"{name:<32} {seconds:>8.2f}  {', '.join(runs[0]['heavy']) or '-'}")
+
+        print(f"\n{'startup':<8} {'import s':>9} {'ready s':>8} {'1st query ms':>13} {'2nd query ms':>13} "
+              f"(first query {args.think:.0f}s after start, median of {args.repeats})")
+        for mode in ("lazy", "warm-up"):
+            runs = [run_child("--child", mode, "--db", args.db, "--think", str(args.think), "--dim", str(fake_dim))
+                    for _ in range(args.repeats)]
+            stats = {key: round(statistics.median(r[key] for r in runs), 3) for key in runs[0]}
+            results["startup"][mode] = stats
+            ready = f"{stats['ready_s']:>8.2f}" if "ready_s" in stats else f"{'-':>8}"
+            print(f"{mode:<8} {stats['import_s']:>9.2f} {ready} {stats['first_query_ms']:>13.1f} {stats['second_query_ms']:>13.1f}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"params": vars(args), **results}, f, indent=2)
+            print(f"Results written to {args.output}")
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Latency of image-as-query retrieval for different upload sizes.
+
+Each uploaded image is embedded three ways and followed by a vector search:
+- full: decoded at full resolution, with no downscaling;
+- downscaled: short edge reduced to QUERY_IMAGE_MIN_EDGE before embedding (JPEG draft decoding);
+- cached: the same bytes again, served from the content-hash cache.
+The fake embedding function keeps it offline; --model openclip times the real vision encoder.
+
+Usage:
+    python -m benchmarks.bench_image_query --sizes 512 1600 3000 --queries 20
+    python -m benchmarks.bench_image_query --model openclip --vectors 20000
+"""
+import io
+import time
+import argparse
+import contextlib
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.bench_ann import synthetic_vectors
+from benchmarks.run_benchmarks import latency_stats
+from benchmarks.synthetic import FakeEmbeddingFunction
+from search.ann_index import ExactIndex
+from search.embedding_cache import ImageEmbeddingCache
+from search.serving import query_db
+from utils.image_utils import QUERY_IMAGE_MIN_EDGE
+
+
+def jpeg_uploads(count: int, size: int, seed: int = 0) -> list:
+    """Distinct JPEG-encoded photos-like images of size x size * 3/4 pixels."""
+    rng = np.random.default_rng(seed)
+    uploads = []
+    for _ in range(count):
+        base = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(base).resize((size, size * 3 // 4), Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        uploads.append(buffer.getvalue())
+    return uploads
+
+
+def time_queries(index, uploads: list, cache: ImageEmbeddingCache, k: int) -> list:
+    latencies = []
+    for upload in uploads:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            query_db(query="", collection=index, n_results=k, image=upload, image_cache=cache)
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=["fake", "openclip"], default="fake")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1600, 3000], help="upload widths in pixels")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.model == "openclip":
+        from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+        embedding_function = OpenCLIPEmbeddingFunction()
+    else:
+        embedding_function = FakeEmbeddingFunction()
+    dim = len(embedding_function(["probe"])[0])
+    ids = [f"B0{i:08d}" for i in range(args.vectors)]
+    index = ExactIndex(ids, ids, synthetic_vectors(args.vectors, dim))
+
+    print(f"{args.model} encoder, {args.vectors} vectors, {args.queries} queries per size, k={args.k}")
+    print(f"{'upload':>11} {'KB':>6} {'mode':<11} {'p50 ms':>8} {'p95 ms':>8}")
+    for size in args.sizes:
+        uploads = jpeg_uploads(args.queries, size, seed=size)
+        kilobytes = np.mean([len(u) for u in uploads]) / 1e3
+        full = ImageEmbeddingCache(embedding_function, min_edge=10 ** 6)
+        downscaled = ImageEmbeddingCache(embedding_function, min_edge=QUERY_IMAGE_MIN_EDGE)
+        runs = {
+            "full": time_queries(index, uploads, full, args.k),
+            "downscaled": time_queries(index, uploads, downscaled, args.k),
+            "cached": time_queries(index, uploads, downscaled, args.k),
+        }
+        for mode, latencies in runs.items():
+            stats = latency_stats(latencies)
+            print(f"{size:>5}x{size * 3 // 4:<5} {kilobytes:>6.0f} {mode:<11} {stats['p50']:>8.2f} {stats['p95']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
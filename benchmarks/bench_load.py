@@ -0,0 +1,350 @@
+"""
+Load test of the end-to-end search and answer path (query_db -> format_prompt_inputs -> vision
+chain, through search.rag_pipeline.AsyncRAGPipeline) on one machine, with no network.
+
+A synthetic deployment is built in a temporary folder:
+- a catalog with images and derivatives;
+- the metadata store and a Chroma collection (or the exact in-process index);
+- a query encoder that spends --encode-ms of CPU per uncached query, like OpenCLIP's text tower;
+- a stub chat model whose first-token latency is log-normal with the given median and p95,
+  plus --token-delay per streamed word and an optional failure rate.
+
+Queries come from a log (.txt, or .jsonl with "query" and optional "ts" in seconds) or are
+synthetic. Each load level runs in turn:
+- open loop (--rate): requests arrive at the given rates, Poisson or evenly spaced, whether or
+  not earlier ones have finished. This is what finds the rate at which latency collapses.
+- closed loop (--users): each simulated user sends a query, waits for the answer, thinks for
+  an exponentially distributed --think seconds and repeats.
+- replay (--arrival replay): the log's own timestamps, sped up by each --speedup.
+
+Reports throughput (over each level's first arrival to last answer, so short runs understate
+it), end-to-end latency from the scheduled arrival and, per stage (queue wait for a concurrency
+slot, retrieve, prompt, generate), completions/sec, p50/p95/p99 and errors.
+The highest level whose p95 and error rate meet --slo-p95 and --max-error-rate is the capacity.
+
+Usage:
+    python -m benchmarks.bench_load --rate 2 5 10 20 40 --duration 30
+    python -m benchmarks.bench_load --users 8 32 128 --think 5 --duration 60
+    python -m benchmarks.bench_load --queries queries.jsonl --arrival replay --speedup 1 4 16
+"""
+import io
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+from langchain_core.output_parsers import StrOutputParser
+
+from benchmarks.run_benchmarks import latency_stats, new_collection
+from benchmarks.synthetic import FakeEmbeddingFunction, generate_catalog, generate_queries
+from search.ann_index import ExactIndex
+from search.embedding_cache import QueryEmbeddingCache
+from search.ingestion import add_images_metadata_to_vectordb_streaming
+from search.lexical_index import get_or_build_lexical_index
+from search.rag_pipeline import AsyncRAGPipeline, PipelineStageError
+from utils.data_utils import get_file_names
+from utils.image_utils import make_image_derivatives
+from utils.langchain import get_image_prompt_template, get_stub_vision_model
+from utils.metadata_store import MetadataStore
+from utils.text_preprocess import preprocess_dataset
+
+
+STAGES = ("queue", "retrieve", "prompt", "generate")
+
+
+class CostlyEmbeddingFunction(FakeEmbeddingFunction):
+    """
+    FakeEmbeddingFunction that also spends about encode_ms of CPU per text, in numpy matrix
+    products, which release the GIL like torch does. Images cost nothing extra.
+    """
+
+    def __init__(self, dim: int = 512, encode_ms: float = 0.0):
+        super().__init__(dim=dim)
+        self.encode_ms = encode_ms
+        self._work = np.random.default_rng(0).standard_normal((256, 256)).astype(np.float32)
+        self._rounds = 0
+        if encode_ms:
+            start = time.perf_counter()
+            for _ in range(20):
+                self._work @ self._work
+            self._rounds = max(1, round(encode_ms / 1000 / ((time.perf_counter() - start) / 20)))
+
+    def __call__(self, input):
+        for item in input:
+            if isinstance(item, str):
+                for _ in range(self._rounds):
+                    self._work @ self._work
+        return super().__call__(input)
+
+
+def read_query_log(path: str):
+    """(queries, arrival offsets in seconds or None) from a .txt or .jsonl query log."""
+    queries, stamps = [], []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                queries.append(record["query"])
+                stamps.append(record.get("ts"))
+            else:
+                queries.append(line)
+                stamps.append(None)
+    if queries and all(stamp is not None for stamp in stamps):
+        return queries, [float(stamp) - float(stamps[0]) for stamp in stamps]
+    return queries, None
+
+
+def lognormal_sampler(median: float, p95: float, rng: random.Random):
+    """Sampler of log-normal latencies with the given median and 95th percentile (seconds)."""
+    sigma = np.log(max(p95, median) / median) / 1.645
+    return lambda: rng.lognormvariate(np.log(median), sigma)
+
+
+def build_deployment(args, workdir: str) -> dict:
+    image_folder = os.path.join(workdir, "images")
+    derivative_folder = os.path.join(workdir, "derivatives")
+    raw = generate_catalog(image_folder, args.products)
+    cleaned = preprocess_dataset(raw, cache_dir=None)
+    metadata_store = MetadataStore(os.path.join(workdir, "metadata.sqlite"))
+    metadata_store.build(cleaned)
+
+    encoder = CostlyEmbeddingFunction(dim=args.dim, encode_ms=args.encode_ms)
+    collection = new_collection(os.path.join(workdir, "chroma.db"), "bench", encoder)
+    add_images_metadata_to_vectordb_streaming(
+        cleaned, collection, workdir, image_folder, checkpoint_path=os.path.join(workdir, "checkpoint.json"),
+        metadata_store=metadata_store, embedding_function=FakeEmbeddingFunction(dim=args.dim))
+    make_image_derivatives(get_file_names(image_folder)[1], derivative_folder)
+    if args.backend == "exact":
+        rows = collection.get(include=["uris", "embeddings"])
+        collection = ExactIndex(rows["ids"], rows["uris"], rows["embeddings"], encoder, metadata_store)
+    lexical_index = get_or_build_lexical_index(cleaned, os.path.join(workdir, "lexical")) if args.mode == "hybrid" else None
+    return {"collection": collection, "metadata_store": metadata_store, "lexical_index": lexical_index,
+            "encoder": encoder, "derivative_folder": derivative_folder}
+
+
+def make_pipeline(args, deployment: dict, rng: random.Random) -> AsyncRAGPipeline:
+    model = get_stub_vision_model(
+        latency_sampler=lognormal_sampler(args.llm_median, args.llm_p95, rng),
+        token_delay=args.token_delay,
+        response=" ".join(["word"] * args.response_words),
+        failure_rate=args.llm_failure_rate,
+    )
+    return AsyncRAGPipeline(
+        collection=deployment["collection"],
+        chain=get_image_prompt_template() | model | StrOutputParser(),
+        metadata_store=deployment["metadata_store"],
+        # a fresh cache per level, so later levels do not inherit earlier hits
+        embedding_cache=None if args.no_embedding_cache else QueryEmbeddingCache(deployment["encoder"]),
+        lexical_index=deployment["lexical_index"],
+        retrieval_mode=args.mode,
+        n_results=args.n_results,
+        max_concurrency=args.concurrency,
+        retrieval_workers=args.retrieval_workers,
+        retrieval_timeout=args.retrieval_timeout,
+        prompt_timeout=args.prompt_timeout,
+        generation_timeout=args.generation_timeout,
+        derivative_folder=deployment["derivative_folder"],
+    )
+
+
+async def send(pipeline: AsyncRAGPipeline, query: str, scheduled: float, records: list):
+    record = {"scheduled": scheduled, "timings": {}, "error_stage": None}
+    try:
+        output = await pipeline.answer(query)
+        record["timings"] = output["timings"]
+    except PipelineStageError as e:
+        record["timings"], record["error_stage"], record["error"] = e.timings, e.stage, repr(e.cause)
+    except Exception as e:
+        record["error_stage"], record["error"] = "other", repr(e)
+    record["end"] = time.perf_counter()
+    records.append(record)
+
+
+async def open_loop(pipeline: AsyncRAGPipeline, queries: list, offsets: list) -> list:
+    records, tasks = [], []
+    t0 = time.perf_counter()
+    for query, offset in zip(queries, offsets):
+        delay = t0 + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(pipeline, query, t0 + offset, records)))
+    await asyncio.gather(*tasks)
+    return records
+
+
+async def closed_loop(pipeline: AsyncRAGPipeline, queries: list, users: int, think: float, duration: float, rng: random.Random) -> list:
+    records = []
+    deadline = time.perf_counter() + duration
+    next_query = iter(queries)
+
+    async def user():
+        # users start staggered over one think time instead of all at once
+        await asyncio.sleep(rng.uniform(0, think))
+        while time.perf_counter() < deadline:
+            await send(pipeline, next(next_query), time.perf_counter(), records)
+            await asyncio.sleep(rng.expovariate(1 / think) if think else 0)
+
+    await asyncio.gather(*(user() for _ in range(users)))
+    return records
+
+
+def summarize(records: list, offered: float) -> dict:
+    start = min(r["scheduled"] for r in records)
+    wall = max(r["end"] for r in records) - start
+    ok = [r for r in records if r["error_stage"] is None]
+    summary = {
+        "requests": len(records),
+        "offered_rps": round(offered, 2),
+        "throughput_rps": round(len(ok) / wall, 2),
+        "error_rate": round(1 - len(ok) / len(records), 4),
+        "end_to_end": latency_stats([r["end"] - r["scheduled"] for r in ok]),
+        "stages": {},
+    }
+    for stage in STAGES:
+        seconds = [r["timings"][stage] for r in records if stage in r["timings"]]
+        stats = latency_stats(seconds)
+        stats["completed_rps"] = round(len(seconds) / wall, 2)
+        stats["errors"] = sum(r["error_stage"] == stage for r in records)
+        summary["stages"][stage] = stats
+    summary["errors_other"] = sum(r["error_stage"] == "other" for r in records)
+    summary["error_examples"] = sorted({r["error"] for r in records if r["error_stage"]})[:3]
+    return summary
+
+
+def print_level(label: str, summary: dict):
+    e2e = summary["end_to_end"]
+    print(f"\n{label}: {summary['requests']} requests, {summary['throughput_rps']:.2f} answers/s, "
+          f"{100 * summary['error_rate']:.1f}% errors, end-to-end p50/p95/p99 "
+          f"{e2e['p50'] / 1000:.2f}/{e2e['p95'] / 1000:.2f}/{e2e['p99'] / 1000:.2f} s")
+    print(f"  {'stage':<9} {'done/s':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, stats in summary["stages"].items():
+        print(f"  {stage:<9} {stats['completed_rps']:>7.2f} {stats['errors']:>7} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f}")
+    for example in summary["error_examples"]:
+        print(f"  e.g. {example}")
+
+
+async def run_levels(args, deployment: dict, queries: list, log_offsets: list) -> list:
+    rng = random.Random(args.seed)
+    if args.arrival == "replay":
+        if log_offsets is None:
+            raise ValueError("--arrival replay needs a .jsonl query log with a 'ts' on every line")
+        levels = [("speedup", s) for s in args.speedup]
+    elif args.users:
+        levels = [("users", u) for u in args.users]
+    else:
+        levels = [("rate", r) for r in args.rate]
+
+    results = []
+    for kind, level in levels:
+        pipeline = make_pipeline(args, deployment, rng)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if kind == "speedup":
+                offsets = [offset / level for offset in log_offsets]
+                records = await open_loop(pipeline, queries, offsets)
+                offered = len(offsets) / max(offsets[-1], 1e-9)
+            elif kind == "users":
+                pool = (queries[i % len(queries)] for i in range(10 ** 9)) if args.queries else (rng.choice(queries) for _ in range(10 ** 9))
+                records = await closed_loop(pipeline, pool, level, args.think, args.duration, rng)
+                offered = len(records) / args.duration
+            else:
+                count = args.requests or max(1, int(level * args.duration))
+                gaps = [rng.expovariate(level) if args.arrival == "poisson" else 1 / level for _ in range(count)]
+                offsets = np.cumsum([0.0] + gaps[:-1]).tolist()
+                chosen = [queries[i % len(queries)] for i in range(count)] if args.queries else [rng.choice(queries) for _ in range(count)]
+                records = await open_loop(pipeline, chosen, offsets)
+                offered = level
+        pipeline.close()
+        summary = {"level": {kind: level}, **summarize(records, offered)}
+        print_level(f"{kind} {level}", summary)
+        results.append(summary)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_argument_group("load")
+    load.add_argument("--queries", default=None, help="query log (.txt, or .jsonl with 'query' and optional 'ts'); default: synthetic")
+    load.add_argument("--distinct-queries", type=int, default=500, help="size of the synthetic query pool")
+    load.add_argument("--arrival", choices=["poisson", "constant", "replay"], default="poisson")
+    load.add_argument("--rate", type=float, nargs="+", default=[1, 2, 5, 10], help="open-loop arrival rates (requests/s)")
+    load.add_argument("--users", type=int, nargs="+", default=None, help="closed-loop user counts (instead of --rate)")
+    load.add_argument("--think", type=float, default=5.0, help="mean think time of closed-loop users (s)")
+    load.add_argument("--speedup", type=float, nargs="+", default=[1.0], help="replay speed factors")
+    load.add_argument("--duration", type=float, default=20.0, help="seconds of arrivals per level")
+    load.add_argument("--requests", type=int, default=None, help="requests per open-loop level (instead of rate * duration)")
+    load.add_argument("--seed", type=int, default=0)
+    server = parser.add_argument_group("deployment")
+    server.add_argument("--concurrency", type=int, default=64, help="requests in flight before new ones queue")
+    server.add_argument("--retrieval-workers", type=int, default=8)
+    server.add_argument("--retrieval-timeout", type=float, default=10.0)
+    server.add_argument("--prompt-timeout", type=float, default=10.0)
+    server.add_argument("--generation-timeout", type=float, default=30.0)
+    server.add_argument("--mode", choices=["vector", "hybrid"], default="vector")
+    server.add_argument("--backend", choices=["chroma", "exact"], default="chroma")
+    server.add_argument("--n-results", type=int, default=2, help="products per answer, as in the app")
+    server.add_argument("--no-embedding-cache", action="store_true")
+    server.add_argument("--products", type=int, default=2000)
+    server.add_argument("--dim", type=int, default=512)
+    server.add_argument("--encode-ms", type=float, default=30.0, help="CPU per uncached query encoding")
+    llm = parser.add_argument_group("stub chat model")
+    llm.add_argument("--llm-median", type=float, default=2.0, help="median first-token latency (s)")
+    llm.add_argument("--llm-p95", type=float, default=6.0, help="95th percentile first-token latency (s)")
+    llm.add_argument("--token-delay", type=float, default=0.01, help="seconds per generated word")
+    llm.add_argument("--response-words", type=int, default=150)
+    llm.add_argument("--llm-failure-rate", type=float, default=0.0)
+    slo = parser.add_argument_group("capacity")
+    slo.add_argument("--slo-p95", type=float, default=10.0, help="end-to-end p95 target (s)")
+    slo.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    if args.queries:
+        queries, log_offsets = read_query_log(args.queries)
+    else:
+        queries, log_offsets = generate_queries(args.distinct_queries, seed=args.seed + 1), None
+
+    workdir = tempfile.mkdtemp(prefix="rag-load-")
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            deployment = build_deployment(args, workdir)
+        print(f"Synthetic deployment: {args.products} products, {args.backend} {args.mode} retrieval, "
+              f"built in {time.perf_counter() - start:.1f}s; {len(queries)} queries"
+              + (f" from {args.queries}" if args.queries else " (synthetic)"))
+        print(f"Stub LLM first token median {args.llm_median}s, p95 {args.llm_p95}s, "
+              f"{args.response_words} words at {args.token_delay}s; concurrency {args.concurrency}")
+        results = asyncio.run(run_levels(args, deployment, queries, log_offsets))
+
+        within = [r for r in results if r["end_to_end"]["p95"] / 1000 <= args.slo_p95 and r["error_rate"] <= args.max_error_rate]
+        print(f"\n{'level':<16} {'offered/s':>9} {'answers/s':>9} {'errors %':>8} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7}")
+        for r in results:
+            (kind, level), e2e = next(iter(r["level"].items())), r["end_to_end"]
+            print(f"{kind + ' ' + str(level):<16} {r['offered_rps']:>9.2f} {r['throughput_rps']:>9.2f} {100 * r['error_rate']:>8.1f} "
+                  f"{e2e['p50'] / 1000:>7.2f} {e2e['p95'] / 1000:>7.2f} {e2e['p99'] / 1000:>7.2f}")
+        if within:
+            best = max(within, key=lambda r: r["throughput_rps"])
+            kind, level = next(iter(best["level"].items()))
+            print(f"Capacity within p95 <= {args.slo_p95}s and errors <= {100 * args.max_error_rate:g}%: "
+                  f"{kind} {level}, {best['throughput_rps']:.2f} answers/s")
+        else:
+            print(f"No level met p95 <= {args.slo_p95}s with errors <= {100 * args.max_error_rate:g}%")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"params": vars(args), "results": results}, f, indent=2)
+            print(f"Results written to {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
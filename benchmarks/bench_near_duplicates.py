@@ -0,0 +1,148 @@
+"""
+Near-duplicate detection (search.near_duplicates): hashing and clustering cost, how well planted
+duplicates are found, the index size reduction, and the effect of collapsing at query time.
+
+A synthetic catalog is written with a share of its products re-listed under new ASINs as
+altered copies (JPEG re-encoded, resized, colour-shifted). The report covers:
+- hashing throughput and clustering time, multi-index hashing versus all-pairs comparison;
+- precision and recall of the planted duplicate pairs, and the index size reduction;
+- for top-k vector queries, how many result slots hold a duplicate of a better-ranked
+  product, with and without collapsing, and the latency collapsing adds.
+
+Usage:
+    python -m benchmarks.bench_near_duplicates --products 5000 --duplicate-share 0.2
+    python -m benchmarks.bench_near_duplicates --hashes 200000 --max-distance 4 6 8
+"""
+import io
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.bench_ann import synthetic_vectors
+from benchmarks.run_benchmarks import latency_stats
+from benchmarks.synthetic import generate_products, write_images
+from search.ann_index import ExactIndex
+from search.near_duplicates import (DuplicateClusters,
+                                    MultiIndexHash,
+                                    build_duplicate_clusters,
+                                    collapse_duplicates,
+                                    hamming_distance)
+from search.serving import DUPLICATE_OVERFETCH
+from utils.data_utils import get_file_names
+
+
+def write_variants(folder: str, originals: list, seed: int = 0) -> dict:
+    """Altered copy of each original image under a new ASIN; returns {new ASIN: original ASIN}."""
+    rng = np.random.default_rng(seed)
+    variants = {}
+    for asin in originals:
+        with Image.open(os.path.join(folder, f"image_{asin}.png")) as image:
+            image = image.convert("RGB")
+        width, height = image.size
+        scale = rng.uniform(0.6, 0.95)
+        image = image.resize((int(width * scale), int(height * scale)), Image.BICUBIC)
+        # colour variant: per-channel gain, then a lossy round trip
+        pixels = np.asarray(image, dtype=np.float32) * rng.uniform(0.8, 1.2, size=3)
+        buffer = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=int(rng.integers(60, 90)))
+        variant = "B1" + asin[2:]
+        Image.open(buffer).save(os.path.join(folder, f"image_{variant}.png"))
+        variants[variant] = asin
+    return variants
+
+
+def index_scaling(count: int, distances: list, seed: int = 0):
+    """Multi-index hashing versus all-pairs comparison on random hashes with planted neighbours."""
+    rng = np.random.default_rng(seed)
+    hashes = rng.integers(0, np.iinfo(np.int64).max, size=count, dtype=np.int64).astype(np.uint64) << np.uint64(1)
+    hashes[count // 2:] = hashes[:count - count // 2] ^ np.uint64(0b1011)
+    print(f"\n{'max distance':>12} {'MIH s':>8} {'all-pairs s':>12} {'pairs':>8} (hashes: {count})")
+    for max_distance in distances:
+        start = time.perf_counter()
+        pairs = MultiIndexHash(hashes, max_distance).pairs()
+        mih_s = time.perf_counter() - start
+        # all-pairs for a sample of rows, extrapolated: the full matrix would not fit in memory
+        sample = max(1, min(count, 20_000_000 // count))
+        start = time.perf_counter()
+        hamming_distance(hashes[:sample, None], hashes[None, :]) <= max_distance
+        brute_s = (time.perf_counter() - start) * count / sample
+        print(f"{max_distance:>12} {mih_s:>8.2f} {brute_s:>11.1f}* {len(pairs):>8}")
+    print(f"* extrapolated from the first {max(1, min(count, 20_000_000 // count))} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=3000)
+    parser.add_argument("--duplicate-share", type=float, default=0.2, help="share of products re-listed as altered copies")
+    parser.add_argument("--max-distance", type=int, nargs="+", default=[4])
+    parser.add_argument("--detail", type=int, default=12, help="colour grid side of the synthetic images")
+    parser.add_argument("--hashes", type=int, default=100000, help="size of the index scaling run (0 skips it)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=2, help="results per query, as in the app")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-near-duplicates-")
+    try:
+        folder = os.path.join(workdir, "images")
+        products = generate_products(args.products)
+        # a finer colour grid than the default, so unrelated images are told apart like photos
+        write_images(products, folder, detail=args.detail)
+        originals = [p["parent_asin"] for p in products[:int(args.products * args.duplicate_share)]]
+        variants = write_variants(folder, originals)
+        ids, uris = get_file_names(folder)
+        truth = {frozenset(pair) for pair in variants.items()}
+        print(f"{len(ids)} products, {len(variants)} of them altered copies of another")
+
+        print(f"\n{'max distance':>12} {'clusters':>9} {'reduction %':>12} {'precision':>10} {'recall':>7} {'hash s':>7} {'cluster s':>10}")
+        for max_distance in args.max_distance:
+            path = os.path.join(workdir, f"clusters_{max_distance}.sqlite")
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = build_duplicate_clusters(ids, uris, path, max_distance, dim=512)
+            clusters = DuplicateClusters(path)
+            cluster_of = dict(zip(ids, clusters.get_many(ids)))
+            members = {}
+            for asin, cluster_id in cluster_of.items():
+                members.setdefault(cluster_id, []).append(asin)
+            found = {frozenset((a, b)) for group in members.values() for i, a in enumerate(group) for b in group[i + 1:]}
+            precision = len(found & truth) / max(len(found), 1)
+            recall = len(found & truth) / max(len(truth), 1)
+            print(f"{max_distance:>12} {report['clusters']:>9} {report['reduction_pct']:>12.1f} {precision:>10.3f} {recall:>7.3f} "
+                  f"{report['hash_s']:>7.2f} {report['cluster_s']:>10.3f}")
+
+        # copies get vectors close to their original's, like a real image encoder would give them
+        vectors = synthetic_vectors(len(ids), 512, seed=3)
+        row_of = {asin: row for row, asin in enumerate(ids)}
+        for variant, original in variants.items():
+            vectors[row_of[variant]] = vectors[row_of[original]] + 0.01 * np.random.default_rng(row_of[variant]).standard_normal(512)
+        index = ExactIndex(ids, uris, vectors.astype(np.float32))
+        rng = np.random.default_rng(5)
+        queries = vectors[rng.choice(len(ids), args.queries)] + 0.3 * rng.standard_normal((args.queries, 512)).astype(np.float32)
+
+        print(f"\n{'results':<10} {'duplicate slots %':>18} {'p50 ms':>8} {'p95 ms':>8} (top-{args.k}, {args.queries} queries)")
+        for name, fetch in (("raw", args.k), ("collapsed", args.k * DUPLICATE_OVERFETCH)):
+            latencies, duplicate_slots = [], 0
+            for query in queries:
+                start = time.perf_counter()
+                result = index.query(query_embeddings=[query], n_results=fetch, include=["uris", "distances"])
+                if name == "collapsed":
+                    collapse_duplicates(result, clusters, args.k)
+                latencies.append(time.perf_counter() - start)
+                row = [cluster_of.get(asin) or asin for asin in result["ids"][0]]
+                duplicate_slots += len(row) - len(set(row))
+            stats = latency_stats(latencies)
+            print(f"{name:<10} {100 * duplicate_slots / (args.k * args.queries):>18.1f} {stats['p50']:>8.2f} {stats['p95']:>8.2f}")
+
+        if args.hashes:
+            index_scaling(args.hashes, args.max_distance)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Rows/sec of the batched, multi-process preprocess_dataset against the row-at-a-time loop.
+
+Usage:
+    python -m benchmarks.bench_preprocess --rows 20000 --num-proc 8
+"""
+import argparse
+import tempfile
+import time
+
+from datasets import load_dataset
+
+from utils.text_preprocess import preprocess_dataset, preprocess_dataset_rowwise
+
+
+def time_call(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000, help="number of catalog rows to preprocess")
+    parser.add_argument("--num-proc", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    raw = load_dataset("milistu/AMAZON-Products-2023")["train"]
+    raw = raw.select(range(min(args.rows, len(raw))))
+    num_rows = len(raw)
+
+    _, rowwise_s = time_call(preprocess_dataset_rowwise, raw)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        batched, batched_s = time_call(
+            preprocess_dataset, raw, batch_size=args.batch_size, num_proc=args.num_proc, cache_dir=cache_dir
+        )
+        _, cached_s = time_call(preprocess_dataset, raw, batch_size=args.batch_size, num_proc=args.num_proc, cache_dir=cache_dir)
+
+    print(f"Preprocessing {num_rows} rows:")
+    for name, seconds in [("rowwise", rowwise_s), ("batched", batched_s), ("cached", cached_s)]:
+        print(f"  {name:<8} {seconds:>8.2f}s  {num_rows / seconds:>12.1f} rows/sec")
+    print(f"  speedup (batched vs rowwise): {rowwise_s / batched_s:.1f}x")
+    assert len(batched) == num_rows
+
+
+if __name__ == "__main__":
+    main()
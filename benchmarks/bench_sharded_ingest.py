@@ -0,0 +1,130 @@
+"""
+Scaling of sharded ingestion (search.ingestion.add_images_metadata_to_vectordb_sharded) with
+the number of embedding worker processes.
+
+A synthetic catalog of PNGs is ingested into a fresh Chroma collection once per worker count,
+with the cores split evenly between workers unless --threads-per-worker is given. Reports
+images/sec (writes included), speedup over the first worker count and parallel efficiency.
+The default encoder is a CPU-bound stand-in (patch projections through a few dense layers, so it
+is offline and fast to load); --model openclip runs the real model in every worker.
+
+Usage:
+    python -m benchmarks.bench_sharded_ingest --images 4000 --workers 1 2 4 8
+    python -m benchmarks.bench_sharded_ingest --model openclip --images 2000 --workers 1 8 16 --threads-per-worker 4
+"""
+import io
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import functools
+
+import numpy as np
+from datasets import Dataset
+
+from benchmarks.run_benchmarks import new_collection
+from benchmarks.synthetic import FakeEmbeddingFunction, generate_products, write_images
+from search.ingestion import add_images_metadata_to_vectordb_sharded
+from search.sharded_embedding import default_embedding_function
+from utils.metadata_store import MetadataStore
+from utils.text_preprocess import preprocess_dataset
+
+
+class ProjectionEmbeddingFunction:
+    """
+    Deterministic image encoder with a ViT-like cost profile: the image is cut into patch x patch
+    tiles, each tile goes through layers dense layers of width, and the mean is projected to dim.
+    The weights come from a fixed seed, so every worker builds the same model.
+    """
+
+    def __init__(self, dim: int = 512, width: int = 768, layers: int = 4, patch: int = 16, image_size: int = 224, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.dim, self.width, self.layers, self.patch, self.image_size = dim, width, layers, patch, image_size
+        self._embed = rng.standard_normal((patch * patch * 3, width), dtype=np.float32) / np.sqrt(patch * patch * 3)
+        self._layers = [rng.standard_normal((width, width), dtype=np.float32) / np.sqrt(width) for _ in range(layers)]
+        self._project = rng.standard_normal((width, dim), dtype=np.float32) / np.sqrt(width)
+
+    def __call__(self, input) -> list:
+        embeddings = []
+        size, patch = self.image_size, self.patch
+        for image in input:
+            pixels = np.asarray(image, dtype=np.float32)[:size, :size, :3] / 255.0
+            pixels = np.pad(pixels, ((0, size - pixels.shape[0]), (0, size - pixels.shape[1]), (0, 3 - pixels.shape[2])))
+            tiles = pixels.reshape(size // patch, patch, size // patch, patch, 3).transpose(0, 2, 1, 3, 4).reshape(-1, patch * patch * 3)
+            hidden = tiles @ self._embed
+            for weights in self._layers:
+                hidden = np.tanh(hidden @ weights)
+            vector = hidden.mean(0) @ self._project
+            embeddings.append(vector / np.linalg.norm(vector))
+        return embeddings
+
+    def get_config(self) -> dict:
+        return {"dim": self.dim, "width": self.width, "layers": self.layers, "patch": self.patch}
+
+
+def run(workers: int, args, catalog, metadata_store: MetadataStore, folder: str, workdir: str) -> dict:
+    if args.model == "openclip":
+        factory = default_embedding_function
+    else:
+        factory = functools.partial(ProjectionEmbeddingFunction, dim=args.dim, layers=args.layers)
+    # vectors come from the workers; the collection's own function is never called
+    collection = new_collection(os.path.join(workdir, f"chroma_{workers}.db"), "bench", FakeEmbeddingFunction(dim=args.dim))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        add_images_metadata_to_vectordb_sharded(
+            catalog, collection, workdir, folder, workers=workers, threads_per_worker=args.threads_per_worker,
+            chunk_size=args.chunk_size, metadata_store=metadata_store, embedding_function_factory=factory)
+    seconds = time.perf_counter() - start
+    return {"workers": workers, "images": collection.count(), "seconds": round(seconds, 2),
+            "images_per_s": round(collection.count() / seconds, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=["projection", "openclip"], default="projection")
+    parser.add_argument("--images", type=int, default=2000)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="default: cores / workers")
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--layers", type=int, default=4, help="dense layers of the projection encoder")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-sharded-")
+    try:
+        folder = os.path.join(workdir, "images")
+        with contextlib.redirect_stdout(io.StringIO()):
+            products = generate_products(args.images)
+            write_images(products, folder, image_size=args.image_size)
+            catalog = preprocess_dataset(Dataset.from_list(products), cache_dir=None)
+            metadata_store = MetadataStore(os.path.join(workdir, "metadata.sqlite"))
+            metadata_store.build(catalog)
+
+        print(f"{args.model} encoder, {args.images} images of {args.image_size}px, {os.cpu_count()} cores")
+        print(f"{'workers':>7} {'threads':>7} {'seconds':>8} {'images/s':>9} {'speedup':>8} {'efficiency':>10}")
+        results = []
+        for workers in args.workers:
+            result = run(workers, args, catalog, metadata_store, folder, workdir)
+            result["threads"] = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+            # relative to the first (smallest) worker count, normally 1
+            base = results[0] if results else result
+            result["speedup"] = round(result["images_per_s"] / base["images_per_s"], 2)
+            result["efficiency"] = round(result["speedup"] * base["workers"] / workers, 2)
+            results.append(result)
+            print(f"{workers:>7} {result['threads']:>7} {result['seconds']:>8.1f} {result['images_per_s']:>9.1f} "
+                  f"{result['speedup']:>7.2f}x {result['efficiency']:>10.2f}")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"params": vars(args), "results": results}, f, indent=2)
+            print(f"Results written to {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
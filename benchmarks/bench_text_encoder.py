@@ -0,0 +1,75 @@
+"""
+Latency and throughput of the query text encoders on CPU: the full-precision OpenCLIP function
+the collection uses versus the int8 text tower from search.text_encoder, at several thread counts.
+
+Reports single-query latency percentiles (distinct queries, so no cache is involved) and
+queries/sec for batches of each size. Needs torch, open_clip and an exported tower:
+    python -m search.text_encoder export --output ./models/text_int8
+
+Usage:
+    python -m benchmarks.bench_text_encoder --model-path ./models/text_int8 --threads 1 4 8 --batch-sizes 1 16 64
+"""
+import json
+import time
+import argparse
+
+from benchmarks.run_benchmarks import latency_stats
+from benchmarks.synthetic import generate_queries
+from search.text_encoder import QuantizedTextEmbeddingFunction
+
+
+def measure(embedding_function, queries: list, batch_sizes: list, singles: int) -> dict:
+    # one untimed call: first-use allocations and graph optimization
+    embedding_function(queries[:1])
+    latencies = []
+    for query in queries[:singles]:
+        start = time.perf_counter()
+        embedding_function([query])
+        latencies.append(time.perf_counter() - start)
+    stats = {"single": latency_stats(latencies)}
+    for batch_size in batch_sizes:
+        batches = [queries[i:i + batch_size] for i in range(0, len(queries) - batch_size + 1, batch_size)][:max(1, 256 // batch_size)]
+        start = time.perf_counter()
+        for batch in batches:
+            embedding_function(batch)
+        seconds = time.perf_counter() - start
+        stats[f"batch_{batch_size}_qps"] = round(sum(len(b) for b in batches) / seconds, 1)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-path", required=True, help="tower written by search.text_encoder export")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--singles", type=int, default=100, help="single-query calls to time")
+    parser.add_argument("--skip-reference", action="store_true", help="only time the quantized tower")
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    args = parser.parse_args()
+
+    import torch
+    queries = generate_queries(max(args.singles, 512), seed=7)
+    results = []
+    for threads in args.threads:
+        # torch's intra-op pool is process-wide, so both encoders run with the same setting
+        torch.set_num_threads(threads)
+        encoders = {"int8": QuantizedTextEmbeddingFunction(args.model_path, num_threads=threads)}
+        if not args.skip_reference:
+            from search.serving import get_embedding_function
+            encoders["fp32"] = get_embedding_function()
+        for name, encoder in encoders.items():
+            results.append({"encoder": name, "threads": threads, **measure(encoder, queries, args.batch_sizes, args.singles)})
+
+    columns = [f"batch_{b}_qps" for b in args.batch_sizes]
+    print(f"{'encoder':<8} {'threads':>7} {'p50 ms':>8} {'p95 ms':>8} " + " ".join(f"{c:>14}" for c in columns))
+    for r in results:
+        print(f"{r['encoder']:<8} {r['threads']:>7} {r['single']['p50']:>8.2f} {r['single']['p95']:>8.2f} "
+              + " ".join(f"{r[c]:>14.1f}" for c in columns))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"params": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Offline benchmark suite for the hot paths of the ingestion and serving code.
+
+Generates a synthetic catalog, then times preprocessing, text normalization, file listing,
+ingestion (bulk and streaming), query latency, prompt building and a stub LLM call. Uses a
+deterministic fake embedding function and a stub chat model, so it runs without network
+access. Results are written as JSON for comparing versions.
+
+Usage:
+    python -m benchmarks.run_benchmarks --products 2000 --queries 200 --output bench_results.json
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+import chromadb
+from chromadb.utils.data_loaders import ImageLoader
+from langchain_core.output_parsers import StrOutputParser
+
+from benchmarks.synthetic import FakeEmbeddingFunction, generate_catalog, generate_queries
+from search.ingestion import add_images_metadata_to_vectordb, add_images_metadata_to_vectordb_streaming
+from search.serving import query_db
+from utils.data_utils import get_file_names
+from utils.image_utils import make_image_derivatives
+from utils.langchain import format_prompt_inputs, get_image_prompt_template, get_stub_vision_model
+from utils.metadata_store import MetadataStore
+from utils.metrics import percentiles
+from utils.text_preprocess import normalize_text, preprocess_dataset, preprocess_dataset_rowwise, _normalize_text_cached
+
+
+def timed(fn, *args, **kwargs):
+    """Run fn with stdout silenced; return (result, seconds)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+
+def distribution(values: list, unit: str) -> dict:
+    stats = {k: round(v, 3) for k, v in percentiles(values).items()}
+    stats["mean"] = round(sum(values) / len(values), 3) if values else 0.0
+    return {"unit": unit, "samples": len(values), **stats}
+
+
+def latency_stats(seconds: list) -> dict:
+    return distribution([s * 1000 for s in seconds], "ms")
+
+
+def throughput(rows: int, seconds: float) -> dict:
+    return {"rows": rows, "seconds": round(seconds, 4), "rows_per_sec": round(rows / seconds, 1) if seconds else 0.0}
+
+
+def new_collection(path: str, name: str, embedding_function):
+    client = chromadb.PersistentClient(path=path)
+    return client.get_or_create_collection(name, embedding_function=embedding_function, data_loader=ImageLoader())
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+
+def run(args, workdir: str) -> dict:
+    results = {}
+    image_folder = os.path.join(workdir, "images")
+    raw = generate_catalog(image_folder, args.products, image_size=args.image_size)
+    queries = generate_queries(args.queries)
+    embedding_function = FakeEmbeddingFunction(dim=args.dim)
+
+    # text preprocessing
+    _, rowwise_s = timed(preprocess_dataset_rowwise, raw)
+    cleaned, batched_s = timed(preprocess_dataset, raw, cache_dir=None)
+    results["preprocess_dataset"] = {"rowwise": throughput(len(raw), rowwise_s), "batched": throughput(len(raw), batched_s)}
+
+    texts = [t for column in ("title", "description", "store", "main_category") for t in raw[column]]
+    _normalize_text_cached.cache_clear()
+    _, normalize_s = timed(lambda: [normalize_text(t) for t in texts])
+    results["normalize_text"] = throughput(len(texts), normalize_s)
+
+    _, listing_s = timed(get_file_names, image_folder)
+    results["get_file_names"] = throughput(args.products, listing_s)
+
+    # ingestion
+    store = MetadataStore(os.path.join(workdir, "metadata.sqlite"))
+    _, build_s = timed(store.build, cleaned)
+    results["metadata_store_build"] = throughput(len(cleaned), build_s)
+
+    collection = new_collection(os.path.join(workdir, "bulk.db"), "bench", embedding_function)
+    _, bulk_s = timed(add_images_metadata_to_vectordb, cleaned, collection, workdir, image_folder, metadata_store=store)
+    results["ingest_bulk"] = throughput(collection.count(), bulk_s)
+
+    streaming = new_collection(os.path.join(workdir, "streaming.db"), "bench", embedding_function)
+    _, stream_s = timed(
+        add_images_metadata_to_vectordb_streaming, cleaned, streaming, workdir, image_folder,
+        chunk_size=args.chunk_size, checkpoint_path=os.path.join(workdir, "checkpoint.json"),
+        metadata_store=store, embedding_function=embedding_function,
+    )
+    results["ingest_streaming"] = throughput(streaming.count(), stream_s)
+
+    # retrieval
+    latencies, all_results = [], []
+    for query in queries:
+        result, seconds = timed(query_db, query, collection, n_results=args.n_results, metadata_store=store)
+        latencies.append(seconds)
+        all_results.append(result)
+    results["query_db"] = latency_stats(latencies)
+
+    # prompt building and generation
+    derivative_folder = os.path.join(workdir, "derivatives")
+    _, derive_s = timed(make_image_derivatives, get_file_names(image_folder)[1], derivative_folder)
+    results["make_image_derivatives"] = throughput(args.products, derive_s)
+
+    latencies, prompts = [], []
+    for query, result in zip(queries, all_results):
+        prompt, seconds = timed(format_prompt_inputs, result, query, derivative_folder)
+        latencies.append(seconds)
+        prompts.append(prompt)
+    results["format_prompt_inputs"] = latency_stats(latencies)
+    results["prompt_bytes"] = distribution([p["packing_stats"]["bytes"] for p in prompts], "bytes")
+
+    chain = get_image_prompt_template() | get_stub_vision_model(latency=args.llm_latency) | StrOutputParser()
+    latencies = [timed(chain.invoke, prompt)[1] for prompt in prompts[:args.llm_calls]]
+    results["stub_chain_invoke"] = latency_stats(latencies)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--image-size", type=int, default=256)
+    parser.add_argument("--dim", type=int, default=512, help="fake embedding dimension")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--n-results", type=int, default=2)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="stub LLM latency in seconds")
+    parser.add_argument("--llm-calls", type=int, default=20)
+    parser.add_argument("--workdir", default=None, help="keep generated data here instead of a temp dir")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag-bench-")
+    try:
+        results = run(args, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Benchmark results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Offline fixtures for benchmarks: a synthetic product catalog with random images and a
+deterministic fake embedding function, so hot paths can be timed without network access,
+model weights or an OpenAI key.
+"""
+from __future__ import annotations
+
+import os
+import random
+import hashlib
+from typing import TYPE_CHECKING, List
+
+import numpy as np
+from PIL import Image
+from chromadb.api.types import EmbeddingFunction
+
+if TYPE_CHECKING:
+    # generate_catalog imports datasets itself, so the fake embedding function stays cheap to import
+    from datasets import Dataset
+
+WORDS = (
+    "wireless bluetooth portable speaker dj controller mixer headphones noise cancelling studio "
+    "monitor microphone usb audio interface guitar pedal keyboard midi stand cable adapter "
+    "charger black white professional compact lightweight rechargeable battery premium bass "
+    "stereo digital analog vintage led display travel case kit pack set"
+).split()
+CATEGORIES = ["Musical Instruments", "All Electronics", "Home Audio & Theater", "Computers", "Cell Phones & Accessories"]
+STORES = ["Pioneer DJ", "Numark", "Sony", "Audio-Technica", "Behringer", "JBL", "Roland", "Amazon Basics"]
+
+
+def _sentence(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def generate_products(num_products: int, seed: int = 0) -> List[dict]:
+    """Raw rows in the schema of milistu/AMAZON-Products-2023 (before preprocess_dataset)."""
+    rng = random.Random(seed)
+    products = []
+    for i in range(num_products):
+        products.append({
+            "parent_asin": f"B0{i:08d}",
+            "title": _sentence(rng, 4, 14).title() + f' {rng.randint(10, 32)}"',
+            "description": " ".join(_sentence(rng, 8, 20) + "." for _ in range(rng.randint(1, 12))),
+            "main_category": rng.choice(CATEGORIES),
+            "store": rng.choice(STORES),
+            "average_rating": round(rng.uniform(1, 5), 1),
+            "rating_number": rng.randint(0, 50000),
+            "price": round(rng.uniform(5, 1500), 2),
+            "image": f"https://example.invalid/images/B0{i:08d}.jpg",
+        })
+    return products
+
+
+def write_images(products: List[dict], folder: str, image_size: int = 256, seed: int = 0, detail: int = 4) -> List[str]:
+    """
+    Write one random PNG per product as image_<asin>.png, like save_all_images does. Each image
+    is a detail x detail grid of random colours upsampled to image_size, plus noise.
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for product in products:
+        path = os.path.join(folder, f"image_{product['parent_asin']}.png")
+        if not os.path.exists(path):
+            # smooth gradients plus noise compress roughly like product photos
+            base = rng.integers(0, 256, size=(detail, detail, 3), dtype=np.uint8)
+            image = Image.fromarray(base).resize((image_size, image_size), Image.BILINEAR)
+            noise = rng.integers(-8, 8, size=(image_size, image_size, 3))
+            pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+            Image.fromarray(pixels).save(path)
+        paths.append(path)
+    return paths
+
+
+def generate_catalog(folder: str, num_products: int, image_size: int = 256, seed: int = 0) -> Dataset:
+    """Raw catalog Dataset plus its images in folder."""
+    from datasets import Dataset
+    products = generate_products(num_products, seed=seed)
+    write_images(products, folder, image_size=image_size, seed=seed)
+    return Dataset.from_list(products)
+
+
+def generate_queries(num_queries: int, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    return [_sentence(rng, 2, 6) for _ in range(num_queries)]
+
+
+class FakeEmbeddingFunction(EmbeddingFunction):
+    """
+    Deterministic stand-in for OpenCLIPEmbeddingFunction. Texts and images map to unit vectors
+    seeded by a hash of their content, so identical inputs always embed identically.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _vector(self, payload: bytes) -> np.ndarray:
+        seed = int.from_bytes(hashlib.blake2b(payload, digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def __call__(self, input):
+        embeddings = []
+        for item in input:
+            if isinstance(item, str):
+                embeddings.append(self._vector(item.encode("utf-8")))
+            else:
+                # hash a coarse thumbnail so the cost stays flat with image size
+                pixels = np.ascontiguousarray(np.asarray(item)[::16, ::16])
+                embeddings.append(self._vector(pixels.tobytes()))
+        return embeddings
+
+    @staticmethod
+    def name() -> str:
+        return "fake"
+
+    def get_config(self) -> dict:
+        return {"dim": self.dim}
+
+    @staticmethod
+    def build_from_config(config: dict) -> "FakeEmbeddingFunction":
+        return FakeEmbeddingFunction(**config)
@@ -0,0 +1,437 @@
+"""
+In-process vector indexes over (memory-mapped) embeddings, usable in place of a Chroma collection.
+
+Every index exposes the part of Collection.query that query_db relies on: query_embeddings or
+query_texts, n_results and include, returning Chroma-shaped results (lists of lists of ids,
+distances, uris and metadatas). Distances are squared L2, like Chroma's default space.
+
+- ExactIndex: brute force over blocks of rows with one matrix multiply per block
+- IVFIndex:   k-means inverted lists probed nprobe at a time, storing raw float32 vectors or
+              compressed residuals (int8 per dimension, or product quantization with 256
+              centroids per subspace), with optional exact re-ranking from the source vectors
+"""
+import json
+import hashlib
+from typing import List, Optional, Union
+
+import numpy as np
+
+from search.query_filters import FILTER_FIELDS, where_mask
+from utils.metadata_store import MetadataStore
+
+
+# fewest vectors per IVF list worth training a centroid for (the usual k-means rule of thumb)
+MIN_VECTORS_PER_LIST = 39
+
+def _as_float32(x) -> np.ndarray:
+    return np.ascontiguousarray(np.asarray(x, dtype=np.float32))
+
+
+def _top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k smallest distances of each row, sorted ascending."""
+    k = min(k, distances.shape[-1])
+    if k == 0:
+        return np.zeros(distances.shape[:-1] + (0,), dtype=np.int64)
+    part = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+    order = np.take_along_axis(distances, part, axis=-1).argsort(axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def ids_digest(ids: List[str]) -> str:
+    """Fingerprint of an ordered id list, which ties a saved index to the rows it was built over."""
+    return hashlib.sha1("\n".join(ids).encode()).hexdigest()
+
+
+def assign(vectors, centroids: np.ndarray, batch_size: int = 8192) -> np.ndarray:
+    """Index of the nearest centroid of every vector, computed in batches."""
+    centroid_norms = (centroids ** 2).sum(1)
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = _as_float32(vectors[start:start + batch_size])
+        out[start:start + len(batch)] = (centroid_norms[None, :] - 2 * batch @ centroids.T).argmin(1)
+    return out
+
+
+def kmeans(vectors, k: int, iterations: int = 20, sample_size: int = 100_000, seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means on a random sample of vectors; empty clusters are reseeded from the sample."""
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    if n < k:
+        raise ValueError(f"Need at least {k} vectors to train {k} centroids, got {n}")
+    sample = _as_float32(vectors[np.sort(rng.choice(n, min(n, max(sample_size, k)), replace=False))])
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=k)
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts[nonempty], axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        centroids[~nonempty] = sample[rng.choice(len(sample), int((~nonempty).sum()))]
+    return centroids
+
+
+class Int8Quantizer:
+    """Symmetric per-dimension int8 codes: 4x smaller than float32."""
+
+    def fit(self, vectors: np.ndarray):
+        self.scale = np.maximum(np.abs(vectors).max(0), 1e-12).astype(np.float32) / 127
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale
+
+    def distances(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return ((self.decode(codes) - query) ** 2).sum(1)
+
+    def state(self) -> dict:
+        return {"scale": self.scale}
+
+    def load_state(self, state: dict):
+        self.scale = state["scale"]
+        return self
+
+
+class ProductQuantizer:
+    """
+    m sub-vectors per vector, each replaced by the id of its nearest of 256 centroids, so a vector
+    costs m bytes (dim * 4 / m times smaller). Distances use per-query lookup tables (ADC).
+    """
+
+    def __init__(self, m: int = 32, iterations: int = 15, seed: int = 0):
+        self.m = m
+        self.iterations = iterations
+        self.seed = seed
+
+    def fit(self, vectors: np.ndarray):
+        dim = vectors.shape[1]
+        if dim % self.m:
+            raise ValueError(f"Dimension {dim} is not divisible into {self.m} sub-vectors")
+        self.sub_dim = dim // self.m
+        self.codebooks = np.stack([
+            kmeans(vectors[:, j * self.sub_dim:(j + 1) * self.sub_dim], 256, self.iterations, seed=self.seed + j)
+            for j in range(self.m)
+        ])
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = assign(vectors[:, j * self.sub_dim:(j + 1) * self.sub_dim], self.codebooks[j])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.codebooks[np.arange(self.m), codes].reshape(len(codes), -1)
+
+    def distances(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        table = ((self.codebooks - query.reshape(self.m, 1, self.sub_dim)) ** 2).sum(-1)
+        # flat gather: entry (j, codes[:, j]) of the (m, 256) table sits at 256 * j + code
+        return np.take(table.ravel(), codes + 256 * np.arange(self.m)).sum(1)
+
+    def state(self) -> dict:
+        return {"codebooks": self.codebooks}
+
+    def load_state(self, state: dict):
+        self.codebooks = state["codebooks"]
+        self.m, _, self.sub_dim = self.codebooks.shape
+        return self
+
+
+def make_quantizer(quantizer: Optional[str], pq_m: int = 32):
+    if quantizer in (None, "none", "float32"):
+        return None
+    if quantizer == "int8":
+        return Int8Quantizer()
+    if quantizer == "pq":
+        return ProductQuantizer(m = pq_m)
+    raise ValueError(f"Unknown quantizer {quantizer!r}; use None, 'int8' or 'pq'")
+
+
+def exact_search(vectors, queries: np.ndarray, k: int, mask: np.ndarray = None, norms: np.ndarray = None,
+                 block_size: int = 65536):
+    """
+    Exact k nearest rows of vectors for every query, among the rows where mask (if given) is
+    True: one matrix multiply per block, merged into a running top-k. Sparse masks gather just
+    the matching rows; dense ones scan contiguous blocks and rule the rest out by distance.
+    """
+    gather = mask is not None and mask.mean() < 0.5
+    rows = np.flatnonzero(mask) if gather else None
+    total = len(rows) if gather else len(vectors)
+    query_norms = (queries ** 2).sum(1)[:, None]
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    best = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, total, block_size):
+        block_rows = rows[start:start + block_size] if gather else np.arange(start, min(start + block_size, total))
+        block = _as_float32(vectors[block_rows] if gather else vectors[start:start + block_size])
+        block_norms = norms[block_rows] if norms is not None else (block ** 2).sum(1)
+        distances = query_norms + block_norms[None, :] - 2 * queries @ block.T
+        if mask is not None and not gather:
+            distances[:, ~mask[block_rows]] = np.inf
+        top = _top_k(distances, k)
+        best = np.concatenate([best, np.take_along_axis(distances, top, 1)], 1)
+        best_rows = np.concatenate([best_rows, block_rows[top]], 1)
+        keep = _top_k(best, k)
+        best, best_rows = np.take_along_axis(best, keep, 1), np.take_along_axis(best_rows, keep, 1)
+    best = np.maximum(best, 0)
+    if mask is not None and not gather and not np.isfinite(best).all():
+        # fewer than k rows matched: drop the ruled-out padding
+        return [r[np.isfinite(d)] for r, d in zip(best_rows, best)], [d[np.isfinite(d)] for d in best]
+    return best_rows, best
+
+
+class VectorIndex:
+    """
+    Shared Chroma-style query front end. Subclasses implement search(queries, k, mask), returning
+    per query the row numbers and squared L2 distances of its nearest neighbours, closest first,
+    among the rows where the boolean mask (if given) is True.
+
+    where clauses are evaluated against columns of the FILTER_FIELDS loaded once from the metadata
+    store, and the resulting mask is pushed into the search itself.
+    """
+
+    def __init__(self, ids: List[str], uris: List[str], vectors, embedding_function = None, metadata_store: MetadataStore = None):
+        self.ids = list(ids)
+        self.uris = list(uris)
+        self.vectors = vectors
+        self.embedding_function = embedding_function
+        self.metadata_store = metadata_store
+        self._columns = None
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def filter_mask(self, where: Optional[dict]) -> Optional[np.ndarray]:
+        if not where:
+            return None
+        if self._columns is None:
+            if self.metadata_store is None:
+                raise ValueError("Filtering an index needs a metadata_store")
+            records = self.metadata_store.get_many(self.ids)
+            self._columns = {}
+            for field in FILTER_FIELDS:
+                values = [(record or {}).get(field) for record in records]
+                numeric = all(isinstance(v, (int, float)) or v is None for v in values)
+                self._columns[field] = (np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+                                        if numeric else np.array(["" if v is None else str(v) for v in values], dtype=object))
+        return where_mask(self._columns, where)
+
+    def get(self, ids: List[str], include: List[str] = ("metadatas",), where: dict = None, **kwargs) -> dict:
+        """Chroma-style get by id; unknown ids and, with where, non-matching ones are left out."""
+        if not hasattr(self, "_row_of"):
+            self._row_of = {asin: row for row, asin in enumerate(self.ids)}
+        found = [asin for asin in ids if asin in self._row_of]
+        mask = self.filter_mask(where)
+        if mask is not None:
+            found = [asin for asin in found if mask[self._row_of[asin]]]
+        records = self.metadata_store.get_many(found) if self.metadata_store is not None else [None] * len(found)
+        return {
+            "ids": found,
+            "uris": [self.uris[self._row_of[asin]] for asin in found] if "uris" in include else None,
+            "metadatas": [record or {} for record in records] if "metadatas" in include else None,
+            "embeddings": None,
+            "documents": None,
+            "included": list(include),
+        }
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray = None):
+        raise NotImplementedError
+
+    def memory_bytes(self) -> int:
+        raise NotImplementedError
+
+    def query(
+            self,
+            query_embeddings = None,
+            query_texts: Union[str, List[str]] = None,
+            n_results: int = 10,
+            include: List[str] = ("metadatas", "distances"),
+            where: dict = None,
+            **kwargs
+        ) -> dict:
+        if query_embeddings is None:
+            if self.embedding_function is None:
+                raise ValueError("query_texts needs an index built with an embedding_function")
+            query_embeddings = self.embedding_function([query_texts] if isinstance(query_texts, str) else list(query_texts))
+        rows, distances = self.search(_as_float32(query_embeddings), n_results, self.filter_mask(where))
+
+        result = {
+            "ids": [[self.ids[r] for r in row] for row in rows],
+            "distances": [d.tolist() for d in distances] if "distances" in include else None,
+            "uris": [[self.uris[r] for r in row] for row in rows] if "uris" in include else None,
+            "metadatas": None,
+            "embeddings": None,
+            "documents": None,
+            "included": list(include),
+        }
+        if "metadatas" in include:
+            result["metadatas"] = []
+            for row_ids in result["ids"]:
+                records = self.metadata_store.get_many(row_ids) if self.metadata_store is not None else [None] * len(row_ids)
+                result["metadatas"].append([record or {} for record in records])
+        return result
+
+
+class ExactIndex(VectorIndex):
+    """Exact nearest neighbours: one matrix multiply per block of block_size rows, merged top-k."""
+
+    def __init__(self, ids, uris, vectors, embedding_function = None, metadata_store = None, block_size: int = 65536):
+        super().__init__(ids, uris, vectors, embedding_function, metadata_store)
+        self.block_size = block_size
+        self.norms = np.concatenate([
+            (_as_float32(vectors[s:s + block_size]) ** 2).sum(1) for s in range(0, len(vectors), block_size)
+        ]) if len(vectors) else np.zeros(0, dtype=np.float32)
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray = None):
+        # the filter is applied inside the scan instead of post-filtering the top k
+        return exact_search(self.vectors, queries, k, mask = mask, norms = self.norms, block_size = self.block_size)
+
+    def memory_bytes(self) -> int:
+        # the vectors themselves may be a memory map paged in on demand
+        return int(np.prod(self.vectors.shape)) * 4 + self.norms.nbytes
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted-file index: vectors are bucketed by their nearest of nlist k-means centroids, and a
+    query only scans the nprobe buckets closest to it. Buckets hold float32 vectors, or int8/PQ
+    codes of the residual to their centroid. With rerank > 0, the best rerank * k candidates by
+    code distance are re-scored against the full-precision source vectors (which can stay a
+    memory map on disk, so only the codes need to be resident).
+
+    nlist is capped at one list per MIN_VECTORS_PER_LIST vectors (and at least 1), so a small
+    catalog still trains: k-means needs more vectors than centroids, and centroids trained on
+    fewer vectors than that are mostly noise.
+    """
+
+    def __init__(self, ids, uris, vectors, embedding_function = None, metadata_store = None,
+                 nlist: int = 1024, nprobe: int = 16, quantizer: Optional[str] = None, pq_m: int = 32,
+                 rerank: int = 0, train_size: int = 100_000, seed: int = 0, build: bool = True):
+        super().__init__(ids, uris, vectors, embedding_function, metadata_store)
+        self.nlist = min(nlist, max(1, len(ids) // MIN_VECTORS_PER_LIST)) if build else nlist
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.quantizer_name = quantizer
+        self.quantizer = make_quantizer(quantizer, pq_m)
+        if build:
+            self._build(train_size, seed)
+
+    def _build(self, train_size: int, seed: int, batch_size: int = 65536):
+        self.centroids = kmeans(self.vectors, self.nlist, sample_size = train_size, seed = seed)
+        labels = assign(self.vectors, self.centroids)
+        self.order = np.argsort(labels, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.nlist))])
+
+        if self.quantizer is not None:
+            rng = np.random.default_rng(seed)
+            sample = np.sort(rng.choice(len(self.vectors), min(len(self.vectors), train_size), replace=False))
+            self.quantizer.fit(_as_float32(self.vectors[sample]) - self.centroids[labels[sample]])
+
+        parts = []
+        for start in range(0, len(self.order), batch_size):
+            rows = self.order[start:start + batch_size]
+            order = np.argsort(rows)
+            vectors = np.empty((len(rows), self.centroids.shape[1]), dtype=np.float32)
+            vectors[order] = _as_float32(self.vectors[rows[order]])
+            residuals = vectors - self.centroids[labels[rows]]
+            parts.append(residuals if self.quantizer is None else self.quantizer.encode(residuals))
+        self.codes = np.concatenate(parts) if parts else np.zeros((0, self.vectors.shape[1]), dtype=np.float32)
+
+    def _list_distances(self, query: np.ndarray, lists: np.ndarray, mask: np.ndarray = None):
+        rows, distances = [], []
+        for l in lists:
+            start, end = self.offsets[l], self.offsets[l + 1]
+            list_rows = self.order[start:end]
+            codes = self.codes[start:end]
+            if mask is not None:
+                keep = mask[list_rows]
+                list_rows, codes = list_rows[keep], codes[keep]
+            if not len(list_rows):
+                continue
+            residual = query - self.centroids[l]
+            if self.quantizer is None:
+                distances.append(((codes - residual) ** 2).sum(1))
+            else:
+                distances.append(self.quantizer.distances(residual, codes))
+            rows.append(list_rows)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return np.concatenate(rows), np.concatenate(distances)
+
+    def search(self, queries: np.ndarray, k: int, mask: np.ndarray = None):
+        if mask is not None and mask.sum() <= len(self.ids) * self.nprobe / self.nlist:
+            # selective filter: fewer matching rows than nprobe lists would scan, so check them all exactly
+            return exact_search(self.vectors, queries, k, mask = mask)
+
+        centroid_distances = ((queries ** 2).sum(1)[:, None] + (self.centroids ** 2).sum(1)[None, :]
+                              - 2 * queries @ self.centroids.T)
+        all_rows, all_distances = [], []
+        for i, query in enumerate(queries):
+            probes = np.argsort(centroid_distances[i])
+            rows, distances = self._list_distances(query, probes[:self.nprobe], mask)
+            # with a filter, keep probing further lists until k matching candidates were seen
+            probed = self.nprobe
+            while mask is not None and len(rows) < k and probed < self.nlist:
+                more_rows, more_distances = self._list_distances(query, probes[probed:probed + self.nprobe], mask)
+                rows, distances = np.concatenate([rows, more_rows]), np.concatenate([distances, more_distances])
+                probed += self.nprobe
+            if self.rerank and self.quantizer is not None and len(rows):
+                candidates = _top_k(distances, self.rerank * k)
+                rows = rows[candidates]
+                # read the source rows in file order, which is much faster on a memory map
+                order = np.argsort(rows)
+                exact = np.empty((len(rows), queries.shape[1]), dtype=np.float32)
+                exact[order] = _as_float32(self.vectors[rows[order]])
+                distances = ((exact - query) ** 2).sum(1)
+            # may hold fewer than k rows when the probed lists are small
+            best = _top_k(distances, k)
+            all_rows.append(rows[best])
+            all_distances.append(np.maximum(distances[best], 0))
+        return all_rows, all_distances
+
+    def memory_bytes(self) -> int:
+        quantizer_bytes = sum(v.nbytes for v in self.quantizer.state().values()) if self.quantizer is not None else 0
+        return self.codes.nbytes + self.centroids.nbytes + self.order.nbytes + self.offsets.nbytes + quantizer_bytes
+
+    def save(self, path: str, stamp: str = None):
+        """
+        Write the trained index (not the ids or source vectors) to an .npz file, with a digest of
+        the ids and an optional stamp of the source vectors' version that load checks.
+        """
+        params = {"nlist": self.nlist, "nprobe": self.nprobe, "rerank": self.rerank,
+                  "quantizer": self.quantizer_name, "rows": len(self.ids), "ids": ids_digest(self.ids), "stamp": stamp}
+        quantizer_state = self.quantizer.state() if self.quantizer is not None else {}
+        np.savez(path, centroids = self.centroids, order = self.order, offsets = self.offsets, codes = self.codes,
+                 params = json.dumps(params), **{f"quantizer_{k}": v for k, v in quantizer_state.items()})
+
+    @classmethod
+    def load(cls, path: str, ids, uris, vectors, embedding_function = None, metadata_store = None, stamp: str = None):
+        """
+        Open an index written by save over the same ids, in the same order, and (when stamp is
+        given) the same version of their vectors; raises ValueError otherwise.
+        """
+        data = np.load(path)
+        params = json.loads(str(data["params"]))
+        if params["rows"] != len(ids):
+            raise ValueError(f"Index at {path} covers {params['rows']} rows, but {len(ids)} were given")
+        if params.get("ids") != ids_digest(ids):
+            raise ValueError(f"Index at {path} was built over different ids")
+        if stamp is not None and params.get("stamp") != stamp:
+            raise ValueError(f"Index at {path} was built from vectors {params.get('stamp')}, not {stamp}")
+        index = cls(ids, uris, vectors, embedding_function, metadata_store, nlist = params["nlist"], nprobe = params["nprobe"],
+                    quantizer = params["quantizer"], rerank = params["rerank"], build = False)
+        index.centroids, index.order, index.offsets, index.codes = data["centroids"], data["order"], data["offsets"], data["codes"]
+        if index.quantizer is not None:
+            index.quantizer.load_state({k[len("quantizer_"):]: data[k] for k in data.files if k.startswith("quantizer_")})
+        return index
+
+
+def build_index(backend: str, ids, uris, vectors, embedding_function = None, metadata_store = None, **params) -> VectorIndex:
+    """ExactIndex for backend "exact", IVFIndex for "ivf" (params: nlist, nprobe, quantizer, pq_m, rerank, ...)."""
+    if backend == "exact":
+        return ExactIndex(ids, uris, vectors, embedding_function, metadata_store, **params)
+    if backend == "ivf":
+        return IVFIndex(ids, uris, vectors, embedding_function, metadata_store, **params)
+    raise ValueError(f"Unknown index backend {backend!r}; use 'exact' or 'ivf'")
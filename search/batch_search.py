@@ -0,0 +1,164 @@
+"""
+Batch search for offline relevance evaluation.
+
+Reads queries from a .txt file (one per line) or a .jsonl file (objects with a "query" and an
+optional "id" field), embeds each batch in one forward pass of the query text encoder, runs
+collection.query over batches of precomputed embeddings and streams the results to JSONL or
+Parquet. Reports queries/sec, and latency percentiles per batch and per query. Queries of a
+batch are processed together, so per-query figures are each batch's time divided by its size
+(amortized cost), not the latency a single query would see on its own.
+
+Usage:
+    python -m search.batch_search --queries queries.txt --output results.jsonl --n-results 10
+"""
+import os
+import json
+import time
+import argparse
+from typing import List
+
+from chromadb.types import Collection
+
+from search.serving import get_collection, get_query_embedding_function
+from search.text_encoder import encode_text_batch
+from utils.data_utils import iter_chunks
+from utils.metrics import percentiles
+
+
+def read_queries(path: str):
+    """Return (query_ids, queries) from a .txt or .jsonl file."""
+    query_ids, queries = [], []
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                queries.append(record["query"])
+                query_ids.append(str(record.get("id", line_no)))
+            else:
+                queries.append(line)
+                query_ids.append(str(line_no))
+    return query_ids, queries
+
+
+class ResultWriter:
+    """Stream result rows to a .jsonl or .parquet file, one batch at a time."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self._file = None
+        self._writer = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if not self.parquet:
+            self._file = open(path, "w")
+
+    def write(self, rows: List[dict]):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pylist(rows)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            for row in rows:
+                self._file.write(json.dumps(row) + "\n")
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._file is not None:
+            self._file.close()
+
+
+def batch_search(
+        query_ids: List[str],
+        queries: List[str],
+        collection: Collection,
+        embedding_function,
+        writer: ResultWriter,
+        n_results: int = 10,
+        embed_batch_size: int = 512,
+        query_batch_size: int = 256
+    ) -> dict:
+    """
+    Embed queries in batches of embed_batch_size (one forward pass of embedding_function's text
+    model each, see search.text_encoder.encode_text_batch), search them in batches and write one
+    result row per query. The *_batch_ms percentiles are over whole batches; *_ms_per_query divide each batch's time by its
+    number of queries.
+    """
+    embed_latencies, search_latencies = [], []
+    embed_per_query, search_per_query = [], []
+    start = time.perf_counter()
+
+    for offset, batch_queries in iter_chunks(queries, embed_batch_size):
+        t0 = time.perf_counter()
+        embeddings = encode_text_batch(embedding_function, batch_queries)
+        embed_latencies.append(time.perf_counter() - t0)
+        embed_per_query.append(embed_latencies[-1] / len(batch_queries))
+
+        for sub_offset, batch_embeddings in iter_chunks(embeddings, query_batch_size):
+            t0 = time.perf_counter()
+            result = collection.query(
+                query_embeddings = batch_embeddings, n_results = n_results, include = ["distances"]
+            )
+            search_latencies.append(time.perf_counter() - t0)
+            search_per_query.append(search_latencies[-1] / len(batch_embeddings))
+
+            first = offset + sub_offset
+            writer.write([
+                {
+                    "query_id": query_ids[first + i],
+                    "query": queries[first + i],
+                    "ids": ids,
+                    "distances": distances,
+                }
+                for i, (ids, distances) in enumerate(zip(result["ids"], result["distances"]))
+            ])
+
+    elapsed = time.perf_counter() - start
+    return {
+        "queries": len(queries),
+        "seconds": round(elapsed, 3),
+        "queries_per_sec": round(len(queries) / elapsed, 1) if elapsed > 0 else 0.0,
+        "embed_batch_ms": {k: round(v * 1000, 2) for k, v in percentiles(embed_latencies).items()},
+        "search_batch_ms": {k: round(v * 1000, 2) for k, v in percentiles(search_latencies).items()},
+        "embed_ms_per_query": {k: round(v * 1000, 3) for k, v in percentiles(embed_per_query).items()},
+        "search_ms_per_query": {k: round(v * 1000, 3) for k, v in percentiles(search_per_query).items()},
+        "embed_batch_size": embed_batch_size,
+        "query_batch_size": query_batch_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", required=True, help=".txt (one query per line) or .jsonl file")
+    parser.add_argument("--output", required=True, help=".jsonl or .parquet results file")
+    parser.add_argument("--n-results", type=int, default=10)
+    parser.add_argument("--embed-batch-size", type=int, default=512)
+    parser.add_argument("--query-batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    query_ids, queries = read_queries(args.queries)
+    collection = get_collection()
+    writer = ResultWriter(args.output)
+    try:
+        stats = batch_search(
+            query_ids, queries, collection, get_query_embedding_function(), writer,
+            n_results = args.n_results,
+            embed_batch_size = args.embed_batch_size,
+            query_batch_size = args.query_batch_size,
+        )
+    finally:
+        writer.close()
+
+    print(json.dumps(stats, indent=2))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
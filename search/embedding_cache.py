@@ -0,0 +1,221 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utils.image_utils import QUERY_IMAGE_MIN_EDGE, prepare_query_image
+from utils.metrics import increment, span
+from utils.text_preprocess import normalize_query
+
+
+# persistent tier of the query-embedding cache
+QUERY_CACHE_PATH = "./data/query_embeddings.sqlite"
+
+# OpenCLIP model and weights the collection is embedded with (OpenCLIPEmbeddingFunction's defaults)
+COLLECTION_MODEL_NAME = "ViT-B-32"
+COLLECTION_CHECKPOINT = "laion2b_s34b_b79k"
+
+
+def embedding_model_config(embedding_function) -> dict:
+    """
+    Class name and config (model name, checkpoint, ...) identifying an embedding function. A
+    stand-in that defers loading its model (search.ingestion.DeferredOpenCLIPEmbeddingFunction)
+    names the model's class in model_class, so it is identified as the model itself.
+    """
+    config = {"class": getattr(embedding_function, "model_class", None) or type(embedding_function).__name__}
+    get_config = getattr(embedding_function, "get_config", None)
+    if callable(get_config):
+        try:
+            config.update(get_config())
+        except Exception:
+            pass
+    for attr in ("model_name", "checkpoint", "_model_name", "_checkpoint"):
+        if hasattr(embedding_function, attr):
+            config[attr] = getattr(embedding_function, attr)
+    return config
+
+
+def embedding_model_id(embedding_function) -> str:
+    """Short fingerprint of embedding_model_config."""
+    return model_config_id(embedding_model_config(embedding_function))
+
+
+def model_config_id(config: dict) -> str:
+    """Fingerprint of a config returned by embedding_model_config (e.g. one built in another process)."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache of query text embeddings in front of an embedding function.
+
+    Lookups go to an in-process LRU first, then to an optional SQLite tier on disk. Entries are
+    keyed by the normalized query and tagged with the embedding model's fingerprint; entries of
+    any other model are dropped when the disk tier is opened, so swapping models invalidates it.
+    """
+
+    # disk table, metric prefix and span of the encoder call; overridden for image queries
+    table = "query_embeddings"
+    metric = "embedding_cache"
+    encoder_span = "retrieval.text_encoder"
+
+    def __init__(self, embedding_function, max_entries: int = 10000, disk_path: str = None):
+        self.embedding_function = embedding_function
+        self.model_id = embedding_model_id(embedding_function)
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk = None
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            with self._disk:
+                self._disk.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} "
+                    "(model_id TEXT, query TEXT, embedding BLOB, PRIMARY KEY (model_id, query)) WITHOUT ROWID"
+                )
+                self._disk.execute(f"DELETE FROM {self.table} WHERE model_id != ?", (self.model_id,))
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key: str):
+        embedding = self._memory.get(key)
+        if embedding is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            increment(f"{self.metric}.memory_hits")
+            return embedding
+        if self._disk is not None:
+            row = self._disk.execute(
+                f"SELECT embedding FROM {self.table} WHERE model_id = ? AND query = ?", (self.model_id, key)
+            ).fetchone()
+            if row is not None:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, embedding)
+                self.disk_hits += 1
+                increment(f"{self.metric}.disk_hits")
+                return embedding
+        return None
+
+    def _embed(self, keys: List[str], inputs: dict, encode) -> List[np.ndarray]:
+        """Embeddings for keys in order; encode gets the inputs of the distinct misses, in one batch."""
+        found = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                embedding = self._lookup(key)
+                if embedding is not None:
+                    found[key] = embedding
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            self.misses += len(missing)
+            increment(f"{self.metric}.misses", len(missing))
+
+        if missing:
+            with span(self.encoder_span):
+                embeddings = [np.asarray(e, dtype=np.float32) for e in encode([inputs[key] for key in missing])]
+            with self._lock:
+                for key, embedding in zip(missing, embeddings):
+                    found[key] = embedding
+                    self._remember(key, embedding)
+                if self._disk is not None:
+                    with self._disk:
+                        self._disk.executemany(
+                            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                            [(self.model_id, key, embedding.tobytes()) for key, embedding in zip(missing, embeddings)],
+                        )
+        return [found[key] for key in keys]
+
+    def embed(self, queries: List[str]) -> List[np.ndarray]:
+        """Embeddings for queries in order; only distinct misses are sent to the model, in one batch."""
+        keys = [normalize_query(q) for q in queries]
+        return self._embed(keys, {key: key for key in keys}, self.embedding_function)
+
+    def peek(self, query: str) -> Optional[np.ndarray]:
+        """The in-memory embedding of query, if any, without running the model or counting a lookup."""
+        with self._lock:
+            return self._memory.get(normalize_query(query))
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._memory),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._disk is not None:
+                with self._disk:
+                    self._disk.execute(f"DELETE FROM {self.table}")
+
+
+def combine_embeddings(text_embedding: np.ndarray, image_embedding: np.ndarray, image_weight: float = 0.5) -> np.ndarray:
+    """Unit-normalized weighted sum of a text and an image embedding from the same CLIP space."""
+    text_embedding = text_embedding / np.linalg.norm(text_embedding)
+    image_embedding = image_embedding / np.linalg.norm(image_embedding)
+    combined = (1 - image_weight) * text_embedding + image_weight * image_embedding
+    return (combined / np.linalg.norm(combined)).astype(np.float32)
+
+
+def read_query_image(image) -> Tuple[str, object]:
+    """
+    (content hash, image) for a query image given as encoded bytes, a file path, a PIL image or
+    an array. Files are read into bytes, so an upload and the same file on disk share one key.
+    """
+    if isinstance(image, (str, os.PathLike)):
+        with open(image, "rb") as f:
+            image = f.read()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return hashlib.sha1(image).hexdigest(), image
+    pixels = np.ascontiguousarray(np.asarray(image))
+    digest = hashlib.sha1(pixels.tobytes())
+    digest.update(str(pixels.shape).encode())
+    return digest.hexdigest(), image
+
+
+class ImageEmbeddingCache(QueryEmbeddingCache):
+    """
+    Cache of query image embeddings keyed by a hash of the image content, with the same two
+    tiers as QueryEmbeddingCache. Repeated uploads of an image and "more like this" lookups of
+    a catalog image skip decoding and the vision encoder. Misses are downscaled to min_edge
+    pixels on their short side before embedding.
+    """
+
+    table = "image_embeddings"
+    metric = "image_embedding_cache"
+    encoder_span = "retrieval.image_encoder"
+
+    def __init__(self, embedding_function, max_entries: int = 1000, disk_path: str = None, min_edge: int = QUERY_IMAGE_MIN_EDGE):
+        super().__init__(embedding_function, max_entries=max_entries, disk_path=disk_path)
+        self.min_edge = min_edge
+
+    def _encode(self, images: list) -> list:
+        arrays = [prepare_query_image(image, self.min_edge) for image in images]
+        return self.embedding_function(arrays)
+
+    def embed(self, images: list) -> List[np.ndarray]:
+        """Embeddings for images (bytes, paths, PIL images or arrays) in order."""
+        keys, inputs = [], {}
+        for image in images:
+            digest, image = read_query_image(image)
+            # the downscaling size changes the embedding, so it is part of the key
+            key = f"{self.min_edge}:{digest}"
+            keys.append(key)
+            inputs[key] = image
+        return self._embed(keys, inputs, self._encode)
@@ -0,0 +1,315 @@
+"""
+Image embeddings persisted outside Chroma, plus export/import between a store and a collection.
+
+Usage:
+    python -m search.embedding_store export --store ./data/embeddings     # collection -> store
+    python -m search.embedding_store import --store ./data/embeddings --db ./data/products_rebuilt.db
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import argparse
+from typing import TYPE_CHECKING, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+from search.embedding_cache import embedding_model_config, embedding_model_id, model_config_id
+from utils.metadata_store import MetadataStore, to_chroma_metadata
+
+
+# image embeddings keyed by parent_asin, independent of any vector db
+EMBEDDING_STORE_PATH = "./data/embeddings"
+
+EMBEDDING_STORE_FORMAT = 1
+
+
+def _write_json_atomic(path: str, data: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStore:
+    """
+    Image embeddings persisted outside Chroma, so the vector db can be rebuilt, re-tuned or moved
+    without re-running the embedding model.
+
+    A store is a directory with four files:
+      - vectors.f32: a memory-mapped float32 matrix, one row per product (grown in place)
+      - ids.json:    the parent_asin and image uri of every row (null for deleted rows)
+      - ids.log:     row changes since ids.json was written, one JSON line each, replayed on open
+      - meta.json:   dimension, row count, the id and config of the model that produced the rows,
+                     and a version bumped by every put or delete
+
+    Writes go to the memory map directly; flush() makes them and the row index durable. A flush
+    appends only the rows changed since the last one to ids.log, so flushing after every chunk of
+    an ingestion stays linear in the rows written; ids.json is rewritten (and the log emptied)
+    once the log outgrows it.
+    """
+
+    def __init__(self, path: str = EMBEDDING_STORE_PATH):
+        self.path = path
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._ids_path = os.path.join(path, "ids.json")
+        self._log_path = os.path.join(path, "ids.log")
+        self._meta_path = os.path.join(path, "meta.json")
+        os.makedirs(path, exist_ok=True)
+
+        self.meta = {"format": EMBEDDING_STORE_FORMAT, "model_id": None, "model": None, "dim": None, "rows": 0}
+        self._ids, self._uris = [], []
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as f:
+                self.meta = json.load(f)
+            with open(self._ids_path, "r") as f:
+                index = json.load(f)
+            self._ids, self._uris = index["ids"], index["uris"]
+            self._log_rows = self._replay_log()
+        else:
+            self._log_rows = 0
+            if os.path.exists(self._log_path):
+                # left by a first flush that never completed
+                os.remove(self._log_path)
+        # rows changed since the last flush, and whether ids.json must be rewritten as a whole
+        self._dirty, self._rewrite = set(), False
+        self._row_of = {asin: row for row, asin in enumerate(self._ids) if asin is not None}
+        self._vectors = None
+        if self.dim and os.path.exists(self._vectors_path):
+            self._open(capacity = max(len(self._ids), os.path.getsize(self._vectors_path) // (4 * self.dim)))
+
+    def _replay_log(self) -> int:
+        """Apply ids.log on top of ids.json; returns the number of entries read."""
+        if not os.path.exists(self._log_path):
+            return 0
+        with open(self._log_path, "r+") as f:
+            lines = f.read().split("\n")
+            if lines[-1]:
+                # a line torn by a crash mid-flush: cut it off so later appends start on a new line
+                f.truncate(sum(len(line) + 1 for line in lines[:-1]))
+        # entries are ASCII (json.dumps escapes the rest), so characters count bytes above
+        entries = 0
+        for line in lines[:-1]:
+            row, asin, uri = json.loads(line)
+            if row >= len(self._ids):
+                self._ids.extend([None] * (row + 1 - len(self._ids)))
+                self._uris.extend([None] * (row + 1 - len(self._uris)))
+            self._ids[row], self._uris[row] = asin, uri
+            entries += 1
+        return entries
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self.meta["dim"]
+
+    @property
+    def model_id(self) -> Optional[str]:
+        return self.meta["model_id"]
+
+    @property
+    def version(self) -> str:
+        """Changes whenever rows are written or deleted (or the model changes); indexes built over the store keep it."""
+        return f"{self.model_id}:{self.meta.get('version', 0)}"
+
+    def _open(self, capacity: int):
+        size = capacity * self.dim * 4
+        with open(self._vectors_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _reserve(self, rows: int):
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if rows > capacity:
+            if self._vectors is not None:
+                self._vectors.flush()
+            # grow geometrically so appending chunk by chunk stays linear
+            self._open(capacity = max(rows, 2 * capacity, 1024))
+
+    def put(self, ids: List[str], embeddings, uris: List[str], embedding_function = None, model_id: str = None, model_config: dict = None):
+        """
+        Insert or overwrite the rows of ids. The first write records the model; later writes must match it.
+        The model is given as embedding_function, or as its embedding_model_config when it lives in another process.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if model_config is None and embedding_function is not None:
+            model_config = embedding_model_config(embedding_function)
+        if model_id is None and model_config is not None:
+            model_id = model_config_id(model_config)
+        if self.dim is None:
+            self.meta.update({"dim": int(embeddings.shape[1]), "model_id": model_id, "model": model_config})
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match the store's {self.dim}")
+        if model_id is not None and self.model_id is not None and model_id != self.model_id:
+            raise ValueError(f"Embeddings from model {model_id} cannot be mixed with the store's model {self.model_id}")
+
+        rows = []
+        for asin, uri in zip(ids, uris):
+            row = self._row_of.get(asin)
+            if row is None:
+                row = len(self._ids)
+                self._row_of[asin] = row
+                self._ids.append(asin)
+                self._uris.append(uri)
+            else:
+                self._uris[row] = uri
+            self._dirty.add(row)
+            rows.append(row)
+        self._reserve(len(self._ids))
+        self._vectors[rows] = embeddings
+        self.meta["version"] = self.meta.get("version", 0) + 1
+
+    def delete(self, ids: List[str]):
+        """Drop rows; their space is reclaimed by compact()."""
+        for asin in ids:
+            row = self._row_of.pop(asin, None)
+            if row is not None:
+                self._ids[row] = None
+                self._uris[row] = None
+                self._dirty.add(row)
+        self.meta["version"] = self.meta.get("version", 0) + 1
+
+    def get_many(self, ids: List[str]) -> List[Optional[np.ndarray]]:
+        """Embeddings for ids in the same order; None where an ASIN is unknown."""
+        rows = [self._row_of.get(asin) for asin in ids]
+        return [None if row is None else np.array(self._vectors[row]) for row in rows]
+
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[Tuple[List[str], List[str], np.ndarray]]:
+        """Yield (ids, uris, embeddings) for all live rows, batch_size rows at a time."""
+        live = [row for row, asin in enumerate(self._ids) if asin is not None]
+        for start in range(0, len(live), batch_size):
+            rows = live[start:start + batch_size]
+            yield [self._ids[r] for r in rows], [self._uris[r] for r in rows], np.asarray(self._vectors[rows])
+
+    def as_arrays(self) -> Tuple[List[str], List[str], np.ndarray]:
+        """(ids, uris, vectors) of all live rows; vectors is the memory map itself unless rows were deleted."""
+        if len(self._row_of) == len(self._ids):
+            vectors = self._vectors[:len(self._ids)] if self._vectors is not None else np.zeros((0, self.dim or 0), dtype=np.float32)
+            return list(self._ids), list(self._uris), vectors
+        live = [row for row, asin in enumerate(self._ids) if asin is not None]
+        return [self._ids[r] for r in live], [self._uris[r] for r in live], np.asarray(self._vectors[live])
+
+    def compact(self):
+        """Rewrite the matrix without the holes left by deleted rows."""
+        live = [row for row, asin in enumerate(self._ids) if asin is not None]
+        if len(live) == len(self._ids):
+            return
+        vectors = np.asarray(self._vectors[live]) if live else np.zeros((0, self.dim or 0), dtype=np.float32)
+        self._ids = [self._ids[r] for r in live]
+        self._uris = [self._uris[r] for r in live]
+        self._row_of = {asin: row for row, asin in enumerate(self._ids)}
+        self._vectors = None
+        os.remove(self._vectors_path)
+        if live:
+            self._open(capacity = len(live))
+            self._vectors[:] = vectors
+        # row numbers changed, so the log cannot describe this
+        self._rewrite = True
+        self.flush()
+
+    def flush(self):
+        if self._vectors is not None:
+            self._vectors.flush()
+        if self._rewrite or self._log_rows + len(self._dirty) > max(len(self._ids), 1024):
+            _write_json_atomic(self._ids_path, {"ids": self._ids, "uris": self._uris})
+            if os.path.exists(self._log_path):
+                os.remove(self._log_path)
+            self._log_rows, self._rewrite = 0, False
+        elif self._dirty:
+            if not os.path.exists(self._ids_path):
+                _write_json_atomic(self._ids_path, {"ids": [], "uris": []})
+            with open(self._log_path, "a") as f:
+                f.write("".join(json.dumps([row, self._ids[row], self._uris[row]]) + "\n" for row in sorted(self._dirty)))
+            self._log_rows += len(self._dirty)
+        self._dirty.clear()
+        self.meta.update({"rows": len(self._row_of), "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+        _write_json_atomic(self._meta_path, self.meta)
+
+    def __contains__(self, asin: str) -> bool:
+        return asin in self._row_of
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+
+def export_collection_embeddings(
+        collection: Collection,
+        store: EmbeddingStore,
+        embedding_function = None,
+        batch_size: int = 1000
+    ) -> int:
+    """Copy every embedding (with its uri) out of a Chroma collection into store; returns the row count."""
+    exported = 0
+    for offset in range(0, collection.count(), batch_size):
+        batch = collection.get(include = ["embeddings", "uris"], limit = batch_size, offset = offset)
+        if not batch["ids"]:
+            break
+        store.put(batch["ids"], batch["embeddings"], batch["uris"], embedding_function = embedding_function)
+        exported += len(batch["ids"])
+    store.flush()
+    print(f"Exported {exported} embeddings to {store.path}")
+    return exported
+
+
+def load_collection_from_store(
+        store: EmbeddingStore,
+        collection: Collection,
+        metadata_store: MetadataStore = None,
+        embedding_function = None,
+        batch_size: int = 1000
+    ) -> int:
+    """
+    Upsert precomputed embeddings from store into collection, with no model compute.
+
+    When embedding_function (the one the collection encodes queries with) is given, its model
+    must be the one that produced the stored embeddings, or query and image vectors would not be
+    comparable. Chroma metadata comes from metadata_store; ASINs it does not know are skipped.
+    """
+    if embedding_function is not None and store.model_id is not None and embedding_model_id(embedding_function) != store.model_id:
+        raise ValueError(f"Store {store.path} was built with model {store.model_id} ({store.meta.get('model')}), "
+                         f"not {embedding_model_id(embedding_function)}")
+    loaded = 0
+    for ids, uris, embeddings in store.iter_batches(batch_size):
+        metadatas = None
+        if metadata_store is not None:
+            records = metadata_store.get_many(ids)
+            keep = [i for i, record in enumerate(records) if record is not None]
+            ids, uris, embeddings = [ids[i] for i in keep], [uris[i] for i in keep], embeddings[keep]
+            metadatas = [to_chroma_metadata(records[i]) for i in keep]
+        if ids:
+            collection.upsert(ids = ids, embeddings = embeddings, uris = uris, metadatas = metadatas)
+            loaded += len(ids)
+    print(f"Loaded {loaded} precomputed embeddings from {store.path} into the collection")
+    return loaded
+
+
+def main():
+    # imported here: search.serving and search.ingestion themselves depend on this module
+    from search.serving import PATH, get_metadata_store, get_or_create_vector_db
+    from search.ingestion import DeferredOpenCLIPEmbeddingFunction
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"], help="export: collection -> store, import: store -> collection")
+    parser.add_argument("--store", default=EMBEDDING_STORE_PATH, help="embedding store directory")
+    parser.add_argument("--db", default=PATH, help="Chroma database path")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    # the model's identity without the model: neither direction embeds anything
+    embedding_function = DeferredOpenCLIPEmbeddingFunction()
+    collection = get_or_create_vector_db(args.db, embedding_function = embedding_function)
+    store = EmbeddingStore(args.store)
+    start = time.perf_counter()
+    if args.command == "export":
+        rows = export_collection_embeddings(collection, store, embedding_function, batch_size = args.batch_size)
+    else:
+        rows = load_collection_from_store(store, collection, get_metadata_store(), embedding_function, batch_size = args.batch_size)
+    print(f"{args.command}: {rows} embeddings in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+"""
+Ingestion-side surface of the search code: preprocessing the catalog and writing images,
+embeddings and metadata into the collection, the metadata store, the embedding store and the
+lexical index. Serving code should import search.serving instead, which avoids the heavy
+dependencies imported here.
+"""
+from chromadb.types import Collection
+from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+from tqdm import tqdm, trange
+from typing import List
+from datasets import Dataset, load_dataset
+from concurrent.futures import ThreadPoolExecutor
+
+
+from utils.text_preprocess import preprocess_dataset
+from utils.image_utils import (open_example_image, 
+                            load_image_chunk,
+                            make_image_derivatives,
+                            DERIVATIVE_FOLDER) 
+from utils.data_utils import (get_file_names, 
+                            iter_chunks, 
+                            read_checkpoint, 
+                            write_checkpoint,
+                            open_done_log,
+                            append_done_log)
+from utils.metrics import StageTimer
+from utils.metadata_store import (MetadataStore, 
+                                METADATA_PATH, 
+                                get_or_build_metadata_store, 
+                                to_chroma_metadata)
+from utils.ingest_manifest import IngestionManifest, MANIFEST_PATH
+from search.embedding_cache import COLLECTION_MODEL_NAME, COLLECTION_CHECKPOINT
+from search.embedding_store import (EmbeddingStore,
+                                    EMBEDDING_STORE_PATH,
+                                    export_collection_embeddings,
+                                    load_collection_from_store)
+from search.sharded_embedding import default_embedding_function, embed_sharded
+from search.lexical_index import LEXICAL_INDEX_PATH, get_or_build_lexical_index
+from search.near_duplicates import DUPLICATES_PATH, build_duplicate_clusters
+from search.serving import PATH, get_embedding_function, get_or_create_vector_db
+
+
+# folder where images are present
+DATASET_FOLDER = "./products_dataset/AMAZON-Products-2023"
+
+# checkpoint of the streaming ingestion (next offset into the sorted file list)
+CHECKPOINT_PATH = "./data/ingestion_checkpoint.json"
+
+# finished ASINs of the sharded ingestion, one line per chunk (chunks finish out of order)
+SHARDED_CHECKPOINT_PATH = "./data/ingestion_checkpoint_sharded.jsonl"
+
+# number of images decoded, embedded and written per chunk in streaming mode
+DEFAULT_CHUNK_SIZE = 256
+
+# images per chunk sent back by each embedding worker in sharded mode
+SHARDED_CHUNK_SIZE = 64
+
+
+class DeferredOpenCLIPEmbeddingFunction(OpenCLIPEmbeddingFunction):
+    """
+    The collection's OpenCLIP model as seen by a process that does not embed itself (the writer
+    of sharded ingestion): it has the model's name and config, so Chroma opens the collection
+    with it, but the model is only loaded (via get_embedding_function) if it is actually called.
+    Its embedding_model_config is the model's, so embedding-store checks run without loading it.
+    """
+
+    model_class = OpenCLIPEmbeddingFunction.__name__
+
+    def __init__(self, model_name: str = COLLECTION_MODEL_NAME, checkpoint: str = COLLECTION_CHECKPOINT, device: str = "cpu"):
+        self.model_name = model_name
+        self.checkpoint = checkpoint
+        self.device = device
+
+    def __call__(self, input):
+        return get_embedding_function()(input)
+
+    @staticmethod
+    def build_from_config(config: dict) -> "DeferredOpenCLIPEmbeddingFunction":
+        # Chroma rebuilds the function from its config when creating a collection; stay deferred
+        return DeferredOpenCLIPEmbeddingFunction(**config)
+
+
+def lookup_chroma_metadata(store: MetadataStore, ids: List[str], uris: List[str]):
+    """Fetch slim Chroma metadata for ids, dropping images whose ASIN is not in the store."""
+    records = store.get_many(ids)
+    missing = [asin for asin, record in zip(ids, records) if record is None]
+    if missing:
+        print(f"Skipping {len(missing)} images without metadata, e.g. {missing[:5]}")
+    kept = [(asin, uri, to_chroma_metadata(record)) for asin, uri, record in zip(ids, uris, records) if record is not None]
+    return [k[0] for k in kept], [k[1] for k in kept], [k[2] for k in kept]
+
+
+def add_images_metadata_to_vectordb(
+        dataset: Dataset,
+        collection: Collection,
+        path: str, 
+        dataset_folder: str,
+        metadata_store: MetadataStore = None
+    ):
+    if metadata_store is None:
+        metadata_store = get_or_build_metadata_store(dataset)
+    ids, uris = get_file_names(dataset_folder)
+    ids, uris, metadata = lookup_chroma_metadata(metadata_store, ids, uris)
+
+    collection.add(
+        ids = ids, 
+        uris = uris,
+        metadatas = metadata
+    )
+    print(f"{collection.count()} images and their metadata added to Vector Database located at {path}")
+    return collection
+
+
+def add_images_metadata_to_vectordb_streaming(
+        dataset: Dataset,
+        collection: Collection,
+        path: str,
+        dataset_folder: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        checkpoint_path: str = CHECKPOINT_PATH,
+        prefetch: int = 1,
+        resume: bool = True,
+        metadata_store: MetadataStore = None,
+        embedding_function = None,
+        embedding_store: EmbeddingStore = None
+    ):
+    """
+    Memory-bounded version of add_images_metadata_to_vectordb.
+
+    Walks the image folder in chunks of chunk_size. Images of the next chunk(s) are decoded in a
+    background thread while the current chunk is embedded, so at most (1 + prefetch) chunks of
+    pixels are held in memory. Every chunk is upserted and checkpointed, so a crashed run picks
+    up from the last written chunk when called again with resume=True.
+    """
+    if metadata_store is None:
+        metadata_store = get_or_build_metadata_store(dataset)
+    ids, uris = get_file_names(dataset_folder)
+    if embedding_function is None:
+        embedding_function = get_embedding_function()
+
+    checkpoint = read_checkpoint(checkpoint_path) if resume else {}
+    start = 0
+    if checkpoint.get("dataset_folder") == dataset_folder and checkpoint.get("total") == len(ids):
+        start = checkpoint.get("offset", 0)
+        print(f"Resuming ingestion from offset {start}/{len(ids)}")
+
+    timer = StageTimer()
+    chunks = list(iter_chunks(list(range(len(ids))), chunk_size, start = start))
+    skipped = 0
+
+    with ThreadPoolExecutor(max_workers = max(1, prefetch)) as executor:
+        def decode(chunk):
+            offset, positions = chunk
+            with timer.stage("decode", rows = len(positions)):
+                return offset, positions, load_image_chunk([uris[i] for i in positions])
+
+        pending = [executor.submit(decode, chunk) for chunk in chunks[:prefetch]]
+        next_chunk = len(pending)
+
+        for _ in trange(len(chunks), desc="Ingesting chunks"):
+            offset, positions, (ok, images) = pending.pop(0).result()
+            # keep the decoder busy on the next chunk while this one is embedded
+            if next_chunk < len(chunks):
+                pending.append(executor.submit(decode, chunks[next_chunk]))
+                next_chunk += 1
+
+            chunk_ids = [ids[positions[i]] for i in ok]
+            chunk_uris = [uris[positions[i]] for i in ok]
+            skipped += len(positions) - len(ok)
+
+            with timer.stage("metadata", rows = len(chunk_ids)):
+                records = metadata_store.get_many(chunk_ids)
+            keep = [i for i, record in enumerate(records) if record is not None]
+            if len(keep) < len(chunk_ids):
+                print(f"Skipping {len(chunk_ids) - len(keep)} images without metadata")
+                chunk_ids = [chunk_ids[i] for i in keep]
+                chunk_uris = [chunk_uris[i] for i in keep]
+                images = [images[i] for i in keep]
+            chunk_metadata = [to_chroma_metadata(records[i]) for i in keep]
+
+            if chunk_ids:
+                with timer.stage("embed", rows = len(chunk_ids)):
+                    embeddings = embedding_function(images)
+                with timer.stage("write", rows = len(chunk_ids)):
+                    collection.upsert(
+                        ids = chunk_ids,
+                        embeddings = embeddings,
+                        uris = chunk_uris,
+                        metadatas = chunk_metadata
+                    )
+                if embedding_store is not None:
+                    embedding_store.put(chunk_ids, embeddings, chunk_uris, embedding_function = embedding_function)
+                    embedding_store.flush()
+            del images
+
+            write_checkpoint(checkpoint_path, {
+                "dataset_folder": dataset_folder,
+                "total": len(ids),
+                "offset": offset + len(positions),
+            })
+
+    print(f"{collection.count()} images and their metadata added to Vector Database located at {path} ({skipped} unreadable images skipped)")
+    timer.print_report("Streaming ingestion")
+    return collection
+
+
+def add_images_metadata_to_vectordb_sharded(
+        dataset: Dataset,
+        collection: Collection,
+        path: str,
+        dataset_folder: str,
+        workers: int,
+        threads_per_worker: int = None,
+        chunk_size: int = SHARDED_CHUNK_SIZE,
+        checkpoint_path: str = SHARDED_CHECKPOINT_PATH,
+        resume: bool = True,
+        metadata_store: MetadataStore = None,
+        embedding_function_factory = None,
+        embedding_store: EmbeddingStore = None
+    ):
+    """
+    Multi-process version of add_images_metadata_to_vectordb for many-core hosts.
+
+    The file list is split into one shard per worker process (see search.sharded_embedding); each
+    worker loads its own model with threads_per_worker threads and embeds its shard. This process
+    is the single writer: it upserts every chunk into the collection and the embedding store as it
+    arrives. Images without metadata are dropped before sharding, so they are never embedded.
+
+    Chunks finish out of order, so the checkpoint is a log of finished ASINs rather than an
+    offset; a crashed run called again with resume=True only embeds the images not in it.
+    """
+    if metadata_store is None:
+        metadata_store = get_or_build_metadata_store(dataset)
+    ids, uris = get_file_names(dataset_folder)
+    ids, uris, metadata = lookup_chroma_metadata(metadata_store, ids, uris)
+    metadata_of = dict(zip(ids, metadata))
+    del metadata
+
+    done = open_done_log(checkpoint_path, {"dataset_folder": dataset_folder, "total": len(ids)}, resume = resume)
+    if done:
+        print(f"Resuming sharded ingestion: {len(done)}/{len(ids)} images already written")
+        remaining = [i for i, asin in enumerate(ids) if asin not in done]
+        ids, uris = [ids[i] for i in remaining], [uris[i] for i in remaining]
+
+    timer = StageTimer()
+    skipped, decode_s, embed_s = 0, 0.0, 0.0
+    chunks = embed_sharded(ids, uris, workers = workers, threads_per_worker = threads_per_worker, chunk_size = chunk_size,
+                           embedding_function_factory = embedding_function_factory or default_embedding_function)
+    with tqdm(total = len(ids), desc = f"Ingesting with {workers} workers") as progress:
+        for chunk in chunks:
+            skipped += chunk["skipped"]
+            decode_s += chunk["decode_s"]
+            embed_s += chunk["embed_s"]
+            if chunk["ids"]:
+                with timer.stage("write", rows = len(chunk["ids"])):
+                    collection.upsert(
+                        ids = chunk["ids"],
+                        embeddings = chunk["embeddings"],
+                        uris = chunk["uris"],
+                        metadatas = [metadata_of[asin] for asin in chunk["ids"]]
+                    )
+                if embedding_store is not None:
+                    embedding_store.put(chunk["ids"], chunk["embeddings"], chunk["uris"], model_config = chunk["model_config"])
+                    embedding_store.flush()
+            append_done_log(checkpoint_path, chunk["attempted"])
+            progress.update(len(chunk["attempted"]))
+
+    print(f"{collection.count()} images and their metadata added to Vector Database located at {path} ({skipped} unreadable images skipped)")
+    # decode/embed run in the workers, so their seconds add up across processes
+    print(f"Worker time: decode {decode_s:.1f}s, embed {embed_s:.1f}s (summed over {workers} workers)")
+    timer.print_report("Sharded ingestion")
+    return collection
+
+
+def add_images_metadata_to_vectordb_incremental(
+        dataset: Dataset,
+        collection: Collection,
+        path: str,
+        dataset_folder: str,
+        manifest_path: str = MANIFEST_PATH,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        metadata_store: MetadataStore = None,
+        embedding_function = None,
+        embedding_store: EmbeddingStore = None,
+        workers: int = 0,
+        threads_per_worker: int = None,
+        embedding_function_factory = None
+    ):
+    """
+    Apply only the difference between the catalog and the last ingested state to the collection.
+
+    Every product is fingerprinted by a content hash of its image bytes and of its normalized
+    metadata record, and compared against the manifest at manifest_path. New products and products
+    whose image changed are embedded and upserted; products whose metadata alone changed get a
+    metadata update without re-embedding; products that disappeared are deleted. The manifest is
+    only advanced after each write, so an interrupted run redoes at most one chunk. The first run
+    against an empty manifest embeds everything.
+
+    With workers, the products to embed are sharded across that many embedding processes as in
+    add_images_metadata_to_vectordb_sharded (embedding_function_factory builds each worker's
+    model), and this process only writes.
+    """
+    if metadata_store is None:
+        metadata_store = get_or_build_metadata_store(dataset)
+    if embedding_function is None and not workers:
+        embedding_function = get_embedding_function()
+    manifest = IngestionManifest(manifest_path)
+    timer = StageTimer()
+
+    ids, uris = get_file_names(dataset_folder)
+    with timer.stage("diff", rows = len(ids)):
+        records = metadata_store.get_many(ids)
+        plan = manifest.diff(ids, uris, records)
+    record_of = {asin: record for asin, record in zip(ids, records) if record is not None}
+    entries = plan["entries"]
+    print(f"Incremental ingestion: {len(plan['embed'])} to embed, {len(plan['update_metadata'])} metadata updates, "
+          f"{len(plan['delete'])} to delete, {plan['unchanged']} unchanged")
+
+    def embedded_chunks():
+        """(ids, uris, embeddings, skipped, embedding_store.put model kwargs) per chunk of plan["embed"]."""
+        if workers:
+            for chunk in embed_sharded(plan["embed"], [entries[asin]["uri"] for asin in plan["embed"]], workers = workers,
+                                       threads_per_worker = threads_per_worker, chunk_size = chunk_size,
+                                       embedding_function_factory = embedding_function_factory or default_embedding_function):
+                yield chunk["ids"], chunk["uris"], chunk["embeddings"], chunk["skipped"], {"model_config": chunk["model_config"]}
+            return
+        for _, chunk_ids in iter_chunks(plan["embed"], chunk_size):
+            chunk_uris = [entries[asin]["uri"] for asin in chunk_ids]
+            with timer.stage("decode", rows = len(chunk_ids)):
+                ok, images = load_image_chunk(chunk_uris)
+            embeddings = None
+            if ok:
+                with timer.stage("embed", rows = len(ok)):
+                    embeddings = embedding_function(images)
+            del images
+            yield ([chunk_ids[i] for i in ok], [chunk_uris[i] for i in ok], embeddings, len(chunk_ids) - len(ok),
+                   {"embedding_function": embedding_function})
+
+    skipped = 0
+    for chunk_ids, chunk_uris, embeddings, chunk_skipped, model in embedded_chunks():
+        skipped += chunk_skipped
+        if chunk_ids:
+            with timer.stage("write", rows = len(chunk_ids)):
+                collection.upsert(
+                    ids = chunk_ids,
+                    embeddings = embeddings,
+                    uris = chunk_uris,
+                    metadatas = [to_chroma_metadata(record_of[asin]) for asin in chunk_ids]
+                )
+            if embedding_store is not None:
+                embedding_store.put(chunk_ids, embeddings, chunk_uris, **model)
+                embedding_store.flush()
+            manifest.update({asin: entries[asin] for asin in chunk_ids})
+
+    for _, chunk_ids in iter_chunks(plan["update_metadata"], chunk_size):
+        with timer.stage("update", rows = len(chunk_ids)):
+            collection.update(ids = chunk_ids, metadatas = [to_chroma_metadata(record_of[asin]) for asin in chunk_ids])
+        manifest.update({asin: entries[asin] for asin in chunk_ids})
+
+    for _, chunk_ids in iter_chunks(plan["delete"], chunk_size):
+        with timer.stage("delete", rows = len(chunk_ids)):
+            collection.delete(ids = chunk_ids)
+        if embedding_store is not None:
+            embedding_store.delete(chunk_ids)
+            embedding_store.flush()
+        manifest.remove(chunk_ids)
+
+    # unchanged files whose mtime moved are re-stat'ed so they are not re-hashed next time
+    embedded = set(plan["embed"])
+    manifest.update({asin: entry for asin, entry in entries.items() if asin not in embedded})
+    manifest.close()
+
+    print(f"{collection.count()} images and their metadata in Vector Database located at {path} ({skipped} unreadable images skipped)")
+    timer.print_report("Incremental ingestion")
+    return {
+        "embedded": len(plan["embed"]) - skipped,
+        "metadata_updated": len(plan["update_metadata"]),
+        "deleted": len(plan["delete"]),
+        "unchanged": plan["unchanged"],
+        "skipped": skipped,
+    }
+
+
+def load_data_into_collection(
+        product_dataset_name: str = "Amazon-2023", 
+        show_image: bool = False, 
+        chunk_size: int = None,
+        incremental: bool = False,
+        from_embedding_store: bool = False,
+        embedding_store_path: str = EMBEDDING_STORE_PATH,
+        workers: int = 0
+    ):
+    raw_data = load_dataset("milistu/AMAZON-Products-2023")
+
+    # clean the dataset
+    cleaned_data = preprocess_dataset(dataset = raw_data["train"])
+
+    # show an example image:
+    open_example_image(data = cleaned_data, idx = 100, execute=show_image)
+
+    # build the ASIN-indexed metadata store once (skipped when the dataset is unchanged):
+    metadata_store = get_or_build_metadata_store(dataset = cleaned_data, path = METADATA_PATH)
+
+    # create vector db (with workers, the model is only loaded in the worker processes, and
+    # importing precomputed embeddings never loads it):
+    deferred = DeferredOpenCLIPEmbeddingFunction() if workers or from_embedding_store else None
+    product_collection = get_or_create_vector_db(PATH, embedding_function = deferred)
+
+    # image embeddings are also kept outside Chroma, so the db can be rebuilt without the model:
+    embedding_store = EmbeddingStore(embedding_store_path)
+
+    # add images and metadata to vector db:
+    if from_embedding_store:
+        load_collection_from_store(store = embedding_store, collection = product_collection, metadata_store = metadata_store, embedding_function = deferred)
+    elif incremental:
+        # only embed/upsert new or changed products and delete removed ones (sharded across workers if given)
+        add_images_metadata_to_vectordb_incremental(dataset = cleaned_data, collection = product_collection, path = PATH, dataset_folder = DATASET_FOLDER, chunk_size = chunk_size or (SHARDED_CHUNK_SIZE if workers else DEFAULT_CHUNK_SIZE), metadata_store = metadata_store, embedding_store = embedding_store, workers = workers)
+    elif workers:
+        # embed in worker processes, one shard each; this process writes
+        add_images_metadata_to_vectordb_sharded(dataset = cleaned_data, collection = product_collection, path = PATH, dataset_folder = DATASET_FOLDER, workers = workers, chunk_size = chunk_size or SHARDED_CHUNK_SIZE, metadata_store = metadata_store, embedding_store = embedding_store)
+    elif chunk_size:
+        add_images_metadata_to_vectordb_streaming(dataset = cleaned_data, collection = product_collection, path = PATH, dataset_folder = DATASET_FOLDER, chunk_size = chunk_size, metadata_store = metadata_store, embedding_store = embedding_store)
+    else:
+        add_images_metadata_to_vectordb(dataset = cleaned_data, collection = product_collection, path = PATH, dataset_folder = DATASET_FOLDER, metadata_store = metadata_store)
+        # Chroma embedded the images itself; copy the vectors out
+        export_collection_embeddings(collection = product_collection, store = embedding_store, embedding_function = get_embedding_function())
+
+    # products with both an image and metadata, i.e. the ones the collection can return:
+    ids, uris, _ = lookup_chroma_metadata(metadata_store, *get_file_names(DATASET_FOLDER))
+
+    # BM25 index over title, description and store for hybrid retrieval, restricted to those
+    # products so lexical hits always resolve (rebuilt when the dataset or the product set changes):
+    get_or_build_lexical_index(dataset = cleaned_data, path = LEXICAL_INDEX_PATH, asins = ids)
+
+    # perceptual hashes and near-duplicate clusters, so queries can return one product per cluster:
+    build_duplicate_clusters(ids = ids, uris = uris, path = DUPLICATES_PATH, metadata_store = metadata_store, dim = embedding_store.dim)
+
+    # compact, correctly typed images for the vision model prompts:
+    make_image_derivatives(uris = get_file_names(DATASET_FOLDER)[1], derivative_folder = DERIVATIVE_FOLDER)
+
+    return product_collection
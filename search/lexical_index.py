@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import os
+import re
+import json
+import math
+import hashlib
+from array import array
+from collections import Counter
+from typing import TYPE_CHECKING, Iterable, List, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import datasets
+
+
+# BM25 index over the normalized product text
+LEXICAL_INDEX_PATH = "./data/lexical_index"
+
+# field -> weight of its term frequencies (BM25F-style); parent_asin makes ASINs searchable
+LEXICAL_FIELDS = {"title": 2.0, "store": 1.5, "description": 1.0, "parent_asin": 3.0}
+
+# weights are stored as integer multiples of this, so term frequencies fit a uint16
+_TF_SCALE = 2
+
+_WORD = re.compile(r"[a-z0-9]+(?:[-/.][a-z0-9]+)*")
+_PART = re.compile(r"[a-z0-9]+")
+
+# an ASIN, or a short token mixing letters and digits such as a model number (ddj-400, wh1000xm4)
+_ASIN = re.compile(r"^b0[a-z0-9]{8}$")
+_MODEL_NUMBER = re.compile(r"^(?=[a-z0-9./-]*[0-9])(?=[a-z0-9./-]*[a-z])[a-z0-9./-]{3,}$")
+
+
+def asins_digest(asins: Iterable[str] = None) -> str:
+    """Order-independent fingerprint of an ASIN set (None for no restriction)."""
+    if asins is None:
+        return None
+    return hashlib.sha1("\n".join(sorted(asins)).encode()).hexdigest()
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased alphanumeric tokens. Compound words such as "ddj-400" yield their parts and the
+    joined form ("ddj", "400", "ddj400"), so model numbers match however they are written.
+    """
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        parts = _PART.findall(word)
+        tokens.extend(parts)
+        if len(parts) > 1:
+            tokens.append("".join(parts))
+    return tokens
+
+
+class LexicalIndex:
+    """
+    BM25 inverted index over the LEXICAL_FIELDS of the catalog.
+
+    Posting lists are stored on disk as flat numpy arrays (uint32 document numbers and uint16
+    weighted term frequencies, grouped by term), with per-term offsets, and memory-mapped on
+    load, so opening the index reads only the vocabulary.
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.meta = {}
+        if os.path.exists(os.path.join(path, "meta.json")):
+            self._load()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _write(self, name: str, data):
+        """Write an index file (an array as .npy, anything else as JSON) through a temp file and os.replace."""
+        # a new file replaces the old one, so a reader that memory-mapped the old one keeps it intact
+        tmp_path = self._file(f"{name}.tmp")
+        if isinstance(data, np.ndarray):
+            with open(tmp_path, "wb") as f:
+                np.save(f, data)
+        else:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+        os.replace(tmp_path, self._file(name))
+
+    def _load(self):
+        with open(self._file("meta.json"), "r") as f:
+            self.meta = json.load(f)
+        with open(self._file("terms.json"), "r") as f:
+            self.term_ids = {term: i for i, term in enumerate(json.load(f))}
+        with open(self._file("asins.json"), "r") as f:
+            self.asins = json.load(f)
+        with open(self._file("stores.json"), "r") as f:
+            self.stores = set(json.load(f))
+        self.offsets = np.load(self._file("offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(self._file("doc_ids.npy"), mmap_mode="r")
+        self.tfs = np.load(self._file("tfs.npy"), mmap_mode="r")
+        self.doc_lengths = np.load(self._file("doc_lengths.npy"))
+        self.avg_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    def build(self, dataset: datasets.Dataset, batch_size: int = 10000, asins: Iterable[str] = None):
+        """
+        (Re)build from a preprocessed dataset, recording its fingerprint. With asins, only those
+        products are indexed (the ones actually in the collection), so no hit points at a product
+        that cannot be retrieved.
+        """
+        keep = None if asins is None else set(asins)
+        vocabulary = {}
+        term_col, doc_col, tf_col = array("I"), array("I"), array("H")
+        doc_lengths, indexed, stores = [], [], set()
+        columns = list(LEXICAL_FIELDS)
+        weights = {field: int(weight * _TF_SCALE) for field, weight in LEXICAL_FIELDS.items()}
+
+        for batch in dataset.select_columns(columns).iter(batch_size=batch_size):
+            for values in zip(*(batch[col] for col in columns)):
+                row = dict(zip(columns, values))
+                if keep is not None and row["parent_asin"] not in keep:
+                    continue
+                doc = len(indexed)
+                indexed.append(row["parent_asin"])
+                if row["store"]:
+                    stores.add(" ".join(tokenize(row["store"])))
+                counts = Counter()
+                for field, weight in weights.items():
+                    for token in tokenize(str(row[field] or "")):
+                        counts[token] += weight
+                doc_lengths.append(sum(counts.values()) / _TF_SCALE)
+                for token, tf in counts.items():
+                    term_col.append(vocabulary.setdefault(token, len(vocabulary)))
+                    doc_col.append(doc)
+                    tf_col.append(min(tf, 65535))
+
+        terms = np.frombuffer(term_col, dtype=np.uint32)
+        order = np.argsort(terms, kind="stable")
+        os.makedirs(self.path, exist_ok=True)
+        # an index without meta.json is treated as missing: drop it before touching any file, so a
+        # build that dies midway never leaves a valid meta.json over a mix of old and new files
+        if os.path.exists(self._file("meta.json")):
+            os.remove(self._file("meta.json"))
+        self._write("offsets.npy", np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(vocabulary)))]).astype(np.uint64))
+        self._write("doc_ids.npy", np.frombuffer(doc_col, dtype=np.uint32)[order])
+        self._write("tfs.npy", np.frombuffer(tf_col, dtype=np.uint16)[order])
+        self._write("doc_lengths.npy", np.asarray(doc_lengths, dtype=np.float32))
+        self._write("terms.json", sorted(vocabulary, key=vocabulary.get))
+        self._write("asins.json", indexed)
+        self._write("stores.json", sorted(stores))
+        # written last, once every other file is complete
+        self._write("meta.json", {"fingerprint": getattr(dataset, "_fingerprint", None), "asins": asins_digest(keep),
+                                  "documents": len(indexed), "terms": len(vocabulary), "postings": len(terms), "fields": LEXICAL_FIELDS})
+        self._load()
+        print(f"Lexical index at {self.path}: {len(indexed)} products, {len(vocabulary)} terms, {len(terms)} postings")
+
+    def is_built_from(self, dataset: datasets.Dataset, asins: Iterable[str] = None) -> bool:
+        fingerprint = getattr(dataset, "_fingerprint", None)
+        return (fingerprint is not None and self.meta.get("fingerprint") == fingerprint
+                and self.meta.get("asins") == asins_digest(asins))
+
+    def __len__(self) -> int:
+        return self.meta.get("documents", 0)
+
+    def is_identifier_query(self, query: str) -> bool:
+        """True for exact lookups (an ASIN, a model number, a known store name) that text embeddings match poorly."""
+        words = query.lower().split()
+        if not words or len(words) > 3:
+            return False
+        if " ".join(tokenize(query)) in self.stores:
+            return True
+        return all(_ASIN.match(w) or _MODEL_NUMBER.match(w) for w in words)
+
+    def search(self, query: str, k: int = 10) -> Tuple[List[str], List[float]]:
+        """ASINs of the k best BM25 matches for query, with their scores, best first."""
+        if not self.meta:
+            return [], []
+        documents = len(self.asins)
+        postings_docs, postings_scores = [], []
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = np.asarray(self.doc_ids[start:end])
+            tf = np.asarray(self.tfs[start:end], dtype=np.float32) / _TF_SCALE
+            idf = math.log(1 + (documents - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[docs] / self.avg_length)
+            postings_docs.append(docs)
+            postings_scores.append(idf * tf * (self.k1 + 1) / (tf + norm))
+        if not postings_docs:
+            return [], []
+
+        docs, inverse = np.unique(np.concatenate(postings_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(postings_scores))
+        k = min(k, len(docs))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [self.asins[d] for d in docs[best]], scores[best].tolist()
+
+
+def get_or_build_lexical_index(dataset: datasets.Dataset, path: str = LEXICAL_INDEX_PATH, asins: Iterable[str] = None) -> LexicalIndex:
+    """
+    Open the index at path, rebuilding it only when dataset (or the set of asins to index, all
+    of them if None) differs from the one it was built from.
+    """
+    index = LexicalIndex(path)
+    if not index.is_built_from(dataset, asins):
+        index.build(dataset, asins = asins)
+    return index
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Merge ranked id lists by summed 1 / (k + rank); returns (id, score) pairs, best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda pair: -pair[1])
@@ -0,0 +1,324 @@
+"""
+Near-duplicate products (colour variants, relists, the same photo under several parent ASINs).
+
+Every product image gets a 64-bit difference hash. A multi-index hash table over the hashes
+finds all pairs within MAX_HAMMING_DISTANCE bits without comparing every pair, the pairs are
+merged into clusters, and each product's cluster id (the ASIN of the cluster's representative)
+is stored in a SQLite table. query_db uses it to return one product per cluster.
+
+Usage:
+    python -m search.near_duplicates --folder ./products_dataset/AMAZON-Products-2023
+"""
+import os
+import time
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.image_utils import DHASH_SIZE, dhash
+from utils.metadata_store import MetadataStore
+
+
+# per-product perceptual hash and near-duplicate cluster
+DUPLICATES_PATH = "./data/near_duplicates.sqlite"
+
+# hashes at most this many bits apart (of DHASH_SIZE ** 2) are near-duplicates
+MAX_HAMMING_DISTANCE = 4
+
+# threads decoding and hashing images (PIL releases the GIL while decoding)
+HASH_WORKERS = 8
+
+# SQLite caps the number of bound parameters per statement
+_MAX_VARIABLES = 900
+
+# rows compared at once within a band bucket, which bounds memory on skewed buckets
+_BLOCK = 2048
+
+
+# set bits of every byte value, for popcount on NumPy < 2.0 (which has no np.bitwise_count)
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(x)
+    shape = np.shape(x)
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _BYTE_POPCOUNT[x.view(np.uint8)].reshape(shape + (8,)).sum(-1, dtype=np.uint8)
+
+
+def hamming_distance(a, b) -> np.ndarray:
+    return _popcount(np.bitwise_xor(np.asarray(a, dtype=np.uint64), np.asarray(b, dtype=np.uint64)))
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over 64-bit hashes. Each hash is cut into max_distance + 1 bands and
+    each band is an exact-match table (band values sorted, with the row order). Two hashes
+    within max_distance bits agree exactly on at least one band, so candidates come from
+    max_distance + 1 table lookups and only those are compared bit by bit.
+    """
+
+    def __init__(self, hashes, max_distance: int = MAX_HAMMING_DISTANCE, bits: int = DHASH_SIZE ** 2):
+        if not 0 <= max_distance < bits:
+            raise ValueError(f"max_distance must be in [0, {bits}), got {max_distance}")
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+        edges = np.linspace(0, bits, max_distance + 2).round().astype(int)
+        self._bands = [(int(low), int(high)) for low, high in zip(edges[:-1], edges[1:])]
+        self._tables = []
+        for low, high in self._bands:
+            values = self._band(self.hashes, low, high)
+            order = np.argsort(values, kind="stable")
+            self._tables.append((values[order], order))
+
+    @staticmethod
+    def _band(hashes: np.ndarray, low: int, high: int) -> np.ndarray:
+        return (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def query(self, value: int, max_distance: int = None) -> np.ndarray:
+        """Rows whose hash is within max_distance (at most the index's) bits of value."""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        value = np.asarray([value], dtype=np.uint64)
+        candidates = []
+        for (low, high), (values, order) in zip(self._bands, self._tables):
+            band = self._band(value, low, high)
+            start, end = np.searchsorted(values, band, "left")[0], np.searchsorted(values, band, "right")[0]
+            candidates.append(order[start:end])
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[hamming_distance(self.hashes[candidates], value[0]) <= max_distance]
+
+    def pairs(self) -> np.ndarray:
+        """All row pairs (i < j) within max_distance bits, as an (n, 2) array."""
+        found = []
+        for values, order in self._tables:
+            # runs of equal band values are the buckets whose rows are compared
+            bounds = np.flatnonzero(np.diff(values)) + 1
+            starts, ends = np.r_[0, bounds], np.r_[bounds, len(values)]
+            for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+                rows = np.sort(order[start:end])
+                bucket = self.hashes[rows]
+                for block in range(0, len(rows), _BLOCK):
+                    near = hamming_distance(bucket[block:block + _BLOCK, None], bucket[None, block:]) <= self.max_distance
+                    i, j = np.nonzero(near)
+                    keep = j > i
+                    found.append(np.stack([rows[block + i[keep]], rows[block + j[keep]]], axis=1))
+        if not found:
+            return np.empty((0, 2), dtype=np.int64)
+        return np.unique(np.concatenate(found), axis=0)
+
+
+def cluster_hashes(hashes, max_distance: int = MAX_HAMMING_DISTANCE, priority = None) -> np.ndarray:
+    """
+    Representative row of each hash's near-duplicate cluster. Rows are visited in priority order
+    (lowest first, then by row); each row not yet clustered becomes a representative and takes
+    every unclustered row within max_distance bits of it. Every member is therefore close to its
+    representative, so chains of small differences cannot merge unrelated images the way
+    connected components would. Identical hashes always share a cluster.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    priority = np.zeros(len(hashes)) if priority is None else np.asarray(priority)
+    visit = np.lexsort((np.arange(len(hashes)), priority))
+    rank = np.empty(len(hashes), dtype=np.int64)
+    rank[visit] = np.arange(len(hashes))
+
+    # the index only sees distinct values; each stands for its best-ranked row
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    inverse = inverse.ravel()
+    best_rank = np.full(len(unique), len(hashes), dtype=np.int64)
+    np.minimum.at(best_rank, inverse, rank)
+
+    pairs = MultiIndexHash(unique, max_distance).pairs()
+    edges = np.concatenate([pairs, pairs[:, ::-1]])
+    edges = edges[np.argsort(edges[:, 0], kind="stable")]
+    offsets = np.searchsorted(edges[:, 0], np.arange(len(unique) + 1))
+    neighbours = edges[:, 1]
+
+    leader = np.full(len(unique), -1, dtype=np.int64)
+    for value in np.argsort(best_rank, kind="stable").tolist():
+        if leader[value] >= 0:
+            continue
+        leader[value] = value
+        adjacent = neighbours[offsets[value]:offsets[value + 1]]
+        leader[adjacent[leader[adjacent] < 0]] = value
+    return visit[best_rank[leader[inverse]]]
+
+
+class DuplicateClusters:
+    """
+    SQLite table of each product's image hash and near-duplicate cluster id, keyed by parent_asin.
+    The uri, size and mtime of the hashed file let a rebuild reuse hashes of untouched images.
+    """
+
+    def __init__(self, path: str = DUPLICATES_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # shared by Streamlit's session threads, like the metadata store
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS clusters "
+                "(parent_asin TEXT PRIMARY KEY, uri TEXT, size INTEGER, mtime_ns INTEGER, dhash TEXT, cluster_id TEXT) WITHOUT ROWID"
+            )
+
+    def hashes(self) -> Dict[str, Tuple[str, int, int, int]]:
+        """parent_asin -> (uri, size, mtime_ns, hash) of every stored product."""
+        with self._lock:
+            rows = self._conn.execute("SELECT parent_asin, uri, size, mtime_ns, dhash FROM clusters").fetchall()
+        return {asin: (uri, size, mtime_ns, int(value, 16)) for asin, uri, size, mtime_ns, value in rows}
+
+    def replace(self, rows: List[Tuple[str, str, int, int, int, str]]):
+        """Replace the table with (parent_asin, uri, size, mtime_ns, hash, cluster_id) rows."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM clusters")
+            self._conn.executemany(
+                "INSERT INTO clusters VALUES (?, ?, ?, ?, ?, ?)",
+                [(asin, uri, size, mtime_ns, f"{value:016x}", cluster_id) for asin, uri, size, mtime_ns, value, cluster_id in rows],
+            )
+
+    def get_many(self, asins: List[str]) -> List[Optional[str]]:
+        """Cluster ids of asins in the same order; None where an ASIN was not clustered."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(asins), _MAX_VARIABLES):
+                chunk = asins[start:start + _MAX_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._conn.execute(
+                    f"SELECT parent_asin, cluster_id FROM clusters WHERE parent_asin IN ({placeholders})", chunk
+                ).fetchall())
+        return [found.get(asin) for asin in asins]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def _hash_file(uri: str) -> Optional[int]:
+    try:
+        return dhash(uri)
+    except Exception as e:
+        print(f"Skipping unreadable image {uri}: {e}")
+        return None
+
+
+def build_duplicate_clusters(
+        ids: List[str],
+        uris: List[str],
+        path: str = DUPLICATES_PATH,
+        max_distance: int = MAX_HAMMING_DISTANCE,
+        metadata_store: MetadataStore = None,
+        dim: int = None,
+        workers: int = HASH_WORKERS
+    ) -> dict:
+    """
+    Hash the images at uris (reusing stored hashes of files whose size and mtime are unchanged),
+    cluster near-duplicates (see cluster_hashes) and store every product's cluster id at path.
+    Representatives, whose ASINs are the cluster ids, are picked by rating_number in
+    metadata_store (without one, the first of ids). Returns and prints how much smaller the index
+    would be with one product per cluster; dim adds the vector bytes that would save.
+    """
+    clusters = DuplicateClusters(path)
+    previous = clusters.hashes()
+    start = time.perf_counter()
+
+    stats = [os.stat(uri) for uri in uris]
+    values = [None] * len(ids)
+    stale = []
+    for i, (asin, uri, stat) in enumerate(zip(ids, uris, stats)):
+        old = previous.get(asin)
+        if old is not None and old[:3] == (uri, stat.st_size, stat.st_mtime_ns):
+            values[i] = old[3]
+        else:
+            stale.append(i)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for i, value in zip(stale, executor.map(_hash_file, [uris[i] for i in stale])):
+            values[i] = value
+    hash_s = time.perf_counter() - start
+
+    hashed = [i for i, value in enumerate(values) if value is not None]
+    # the most-rated product represents its cluster
+    popularity = np.zeros(len(hashed))
+    if metadata_store is not None:
+        records = metadata_store.get_many([ids[i] for i in hashed])
+        popularity = np.asarray([(record or {}).get("rating_number") or 0 for record in records], dtype=np.float64)
+    start = time.perf_counter()
+    labels = cluster_hashes([values[i] for i in hashed], max_distance, priority = -popularity)
+    cluster_s = time.perf_counter() - start
+    cluster_ids = [ids[hashed[label]] for label in labels.tolist()]
+
+    clusters.replace([(ids[i], uris[i], stats[i].st_size, stats[i].st_mtime_ns, values[i], cluster_id)
+                      for i, cluster_id in zip(hashed, cluster_ids)])
+    clusters.close()
+
+    sizes = np.bincount(labels) if len(labels) else np.zeros(0, dtype=np.int64)
+    sizes = sizes[sizes > 0]
+    report = {
+        "products": len(hashed),
+        "rehashed": len(stale),
+        "clusters": int(len(sizes)),
+        "duplicates": int(len(hashed) - len(sizes)),
+        "clusters_with_duplicates": int((sizes > 1).sum()),
+        "largest_cluster": int(sizes.max()) if len(sizes) else 0,
+        "reduction_pct": round(100 * (len(hashed) - len(sizes)) / max(len(hashed), 1), 2),
+        "hash_s": round(hash_s, 2),
+        "cluster_s": round(cluster_s, 3),
+    }
+    if dim:
+        report["vector_mb_saved"] = round(report["duplicates"] * dim * 4 / 1e6, 1)
+    saved = f", {report['vector_mb_saved']} MB of vectors" if dim else ""
+    print(f"Near-duplicates: {report['products']} products in {report['clusters']} clusters "
+          f"({report['clusters_with_duplicates']} with duplicates, largest {report['largest_cluster']}); "
+          f"one product per cluster would shrink the index by {report['reduction_pct']}%{saved}. "
+          f"Hashed {report['rehashed']} images in {hash_s:.1f}s, clustered in {cluster_s:.2f}s")
+    return report
+
+
+def collapse_duplicates(results: dict, clusters: DuplicateClusters, n_results: int) -> dict:
+    """
+    Keep the best-ranked product of each near-duplicate cluster in every row of Chroma-shaped
+    results, then trim rows to n_results. Products without a cluster id count as their own cluster.
+    """
+    fields = [key for key in ("ids", "distances", "uris", "metadatas", "scores") if results.get(key) is not None]
+    for row, row_ids in enumerate(results["ids"]):
+        row_ids = list(row_ids)
+        seen, keep = set(), []
+        for position, (asin, cluster_id) in enumerate(zip(row_ids, clusters.get_many(row_ids))):
+            cluster_id = cluster_id or asin
+            if cluster_id not in seen:
+                seen.add(cluster_id)
+                keep.append(position)
+            if len(keep) == n_results:
+                break
+        for field in fields:
+            values = results[field][row]
+            results[field][row] = [values[position] for position in keep]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", required=True, help="folder of image_<asin>.* files")
+    parser.add_argument("--path", default=DUPLICATES_PATH)
+    parser.add_argument("--max-distance", type=int, default=MAX_HAMMING_DISTANCE)
+    parser.add_argument("--metadata", default=None, help="metadata store used to pick cluster representatives")
+    args = parser.parse_args()
+
+    from utils.data_utils import get_file_names
+    ids, uris = get_file_names(args.folder)
+    metadata_store = MetadataStore(args.metadata) if args.metadata else None
+    build_duplicate_clusters(ids, uris, args.path, args.max_distance, metadata_store)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Metadata filters for retrieval: a small parser that turns price, rating and category constraints
+in free text into a Chroma `where` clause, and a vectorized evaluator of such clauses over column
+arrays for the in-process indexes.
+"""
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+# metadata fields a where clause may use
+FILTER_FIELDS = ["price", "average_rating", "rating_number", "main_category", "store"]
+
+# a bare number followed by one of these is a size, count or rating, not a price
+_NOT_PRICE = r"(?![\d.,]|\s*(?:\+|stars?|ratings?|reviews?|inch|\"|ft\b|feet|cm\b|mm\b|gb\b|tb\b|w\b|watts?|pack|pcs|pieces))"
+# "$300" is always a price; a bare "300" only when no unit follows
+_NUMBER = rf"(?:\$\s*(\d+(?:[.,]\d+)?)(?![\d.,])|(\d+(?:[.,]\d+)?){_NOT_PRICE})(?:\s*(?:dollars|usd|bucks))?"
+
+_PRICE_PATTERNS = [
+    # between $50 and $100 / from 50 to 100 dollars / $50-$100
+    (re.compile(rf"\b(?:between|from)\s+{_NUMBER}\s+(?:and|to)\s+{_NUMBER}", re.I), "range"),
+    (re.compile(r"(?<![\w.])\$\s*(\d+(?:[.,]\d+)?)\s*(?:-|to)\s*\$?\s*(\d+(?:[.,]\d+)?)\b", re.I), "range"),
+    (re.compile(rf"(?:\b(?:under|below|less than|cheaper than|at most|up to|no more than)\s+|<=?\s*){_NUMBER}", re.I), "max"),
+    (re.compile(rf"(?:\b(?:over|above|more than|at least)\s+|>=?\s*){_NUMBER}", re.I), "min"),
+]
+
+_RATING_PATTERNS = [
+    # 4+ stars / 4 stars and up / 4.5 star or better / at least 4 stars / rated 4 or higher
+    re.compile(r"\b(?:(?:at least|over|above|more than|rated)\s+)?([1-5](?:\.\d)?)\s*\+?\s*(?:stars?|star rating)(?:\s+(?:and up|or (?:more|higher|better|above)|plus))?", re.I),
+    re.compile(r"\brated\s+(?:at least\s+)?([1-5](?:\.\d)?)(?:\s+(?:and up|or (?:more|higher|better|above)))?", re.I),
+    re.compile(r"\b([1-5](?:\.\d)?)\+\s*(?:rating|rated)", re.I),
+]
+
+_MIN_REVIEWS = re.compile(r"\b(?:at least|over|more than)\s+(\d[\d,]*)\s*(k)?\s*(?:ratings|reviews)\b", re.I)
+
+# words that mark a category mention as a filter: "in books", "in the books category", "category: books"
+_CATEGORY_CUE = r"(?:\bin\s+(?:the\s+)?|\bcategory\s*[:=]?\s*)"
+_CATEGORY_SUFFIX = r"(?:\s+(?:category|section|department))?"
+
+
+def _number(text: str) -> float:
+    return float(text.replace(",", ""))
+
+
+def _category_pattern(category: str) -> re.Pattern:
+    """
+    Mentions of category that make it a filter. A multi-word name counts wherever it appears in
+    full ("musical instruments"); a one-word name, which is usually also a product word ("baby
+    monitor", "books about dj"), only after an explicit cue ("in baby", "category: books").
+    """
+    words = re.findall(r"[a-z0-9]+", category.lower())
+    name = r"\W+(?:and\W+|&\W+)?".join(map(re.escape, words))
+    cue = f"(?:{_CATEGORY_CUE})?" if len(words) > 1 else _CATEGORY_CUE
+    return re.compile(cue + r"\b" + name + r"\b" + _CATEGORY_SUFFIX, re.I)
+
+
+def combine_where(conditions: List[dict]) -> Optional[dict]:
+    """AND a list of single-field conditions into one where clause (None when empty)."""
+    conditions = [c for c in conditions if c]
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def parse_query_constraints(query: str, categories: Iterable[str] = ()) -> Tuple[str, Optional[dict]]:
+    """
+    Split constraints out of a free-text query, returning (remaining_query, where).
+
+    Understands price bounds ("under $200", "over $50", "between $50 and $100", "$50-$100"),
+    minimum ratings ("4+ stars", "rated 4.5 or higher"), minimum review counts ("at least 1000
+    reviews") and one of the given category names, when it is named in full (multi-word names)
+    or after a cue such as "in" or "category:" (see _category_pattern); other words that happen
+    to be category names stay in the query text. Products without a price are stored with
+    price 0 and are excluded by price bounds.
+    """
+    conditions = []
+    text = query
+
+    for pattern, kind in _PRICE_PATTERNS:
+        match = pattern.search(text)
+        if not match:
+            continue
+        # each number alternative has its own group; keep the ones that matched
+        values = [_number(g) for g in match.groups() if g is not None]
+        if kind == "range":
+            low, high = sorted(values)
+            conditions += [{"price": {"$gte": max(low, 0.01)}}, {"price": {"$lte": high}}]
+        elif kind == "max":
+            conditions += [{"price": {"$gt": 0}}, {"price": {"$lte": values[0]}}]
+        else:
+            conditions.append({"price": {"$gte": values[0]}})
+        text = text[:match.start()] + " " + text[match.end():]
+        break
+
+    for pattern in _RATING_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            conditions.append({"average_rating": {"$gte": float(match.group(1))}})
+            text = text[:match.start()] + " " + text[match.end():]
+            break
+
+    match = _MIN_REVIEWS.search(text)
+    if match:
+        count = _number(match.group(1)) * (1000 if match.group(2) else 1)
+        conditions.append({"rating_number": {"$gte": int(count)}})
+        text = text[:match.start()] + " " + text[match.end():]
+
+    # longest names first, so "home audio & theater" wins over a shorter overlapping category
+    for category in sorted(categories, key=len, reverse=True):
+        if not category:
+            continue
+        match = _category_pattern(category).search(text)
+        if match:
+            conditions.append({"main_category": category})
+            text = text[:match.start()] + " " + text[match.end():]
+            break
+
+    text = re.sub(r"\s+(?:with|and|for)\s*$", "", " ".join(text.split()), flags=re.I).strip(" ,")
+    return (text or query), combine_where(conditions)
+
+
+def describe_where(where: Optional[dict]) -> str:
+    """Human-readable form of a where clause, e.g. for showing applied filters."""
+    if not where:
+        return ""
+    symbols = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=", "$in": "in", "$nin": "not in"}
+    parts = []
+    for key, value in where.items():
+        if key in ("$and", "$or"):
+            joiner = " and " if key == "$and" else " or "
+            parts.append(joiner.join(describe_where(c) for c in value))
+        elif isinstance(value, dict):
+            parts.extend(f"{key} {symbols[op]} {operand}" for op, operand in value.items())
+        else:
+            parts.append(f"{key} = {value}")
+    return ", ".join(parts)
+
+
+_OPERATORS = {
+    "$eq": lambda column, v: column == v,
+    "$ne": lambda column, v: column != v,
+    "$gt": lambda column, v: column > v,
+    "$gte": lambda column, v: column >= v,
+    "$lt": lambda column, v: column < v,
+    "$lte": lambda column, v: column <= v,
+    "$in": lambda column, v: np.isin(column, list(v)),
+    "$nin": lambda column, v: ~np.isin(column, list(v)),
+}
+
+
+def where_mask(columns: Dict[str, np.ndarray], where: dict) -> np.ndarray:
+    """Boolean mask of the rows of columns (field -> array) that satisfy a Chroma where clause."""
+    size = len(next(iter(columns.values())))
+    mask = np.ones(size, dtype=bool)
+    for key, value in where.items():
+        if key == "$and":
+            for clause in value:
+                mask &= where_mask(columns, clause)
+        elif key == "$or":
+            mask &= np.logical_or.reduce([where_mask(columns, clause) for clause in value])
+        else:
+            if key not in columns:
+                raise ValueError(f"Cannot filter on {key!r}; filterable fields are {sorted(columns)}")
+            conditions = value if isinstance(value, dict) else {"$eq": value}
+            for op, operand in conditions.items():
+                if op not in _OPERATORS:
+                    raise ValueError(f"Unsupported where operator {op!r}")
+                mask &= _OPERATORS[op](columns[key], operand)
+    return mask
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from search.serving import aquery_db
+from search.embedding_cache import QueryEmbeddingCache
+from search.lexical_index import LexicalIndex
+from utils.metadata_store import MetadataStore
+from utils.image_utils import DERIVATIVE_FOLDER
+from utils.langchain import aformat_prompt_inputs, agenerate_answer
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+
+
+class PipelineStageError(RuntimeError):
+    """A request that failed in one pipeline stage, with the stage name and the timings up to it."""
+
+    def __init__(self, stage: str, timings: dict, cause: BaseException):
+        super().__init__(f"{stage} failed: {type(cause).__name__}: {cause}")
+        self.stage = stage
+        self.timings = timings
+        self.cause = cause
+
+
+class AsyncRAGPipeline:
+    """
+    End-to-end retrieval -> prompt building -> generation for many concurrent requests in one
+    process. Retrieval and file reads run on worker threads, generation uses the chain's async
+    invocation, so requests waiting on the LLM only hold a coroutine. At most max_concurrency
+    requests are in flight; the rest wait on a semaphore. Each stage (retrieval, prompt building,
+    generation) has its own timeout, and a failure is raised as a PipelineStageError naming the
+    stage.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        chain,
+        metadata_store: MetadataStore = None,
+        embedding_cache: QueryEmbeddingCache = None,
+        lexical_index: LexicalIndex = None,
+        retrieval_mode: str = "vector",
+        n_results: int = 2,
+        max_concurrency: int = 64,
+        retrieval_workers: int = 8,
+        retrieval_timeout: float = 10.0,
+        prompt_timeout: float = 10.0,
+        generation_timeout: float = 60.0,
+        derivative_folder: str = DERIVATIVE_FOLDER,
+    ):
+        self.collection = collection
+        self.chain = chain
+        self.metadata_store = metadata_store
+        self.embedding_cache = embedding_cache
+        self.lexical_index = lexical_index
+        self.retrieval_mode = retrieval_mode
+        self.n_results = n_results
+        self.retrieval_timeout = retrieval_timeout
+        self.prompt_timeout = prompt_timeout
+        self.generation_timeout = generation_timeout
+        self.derivative_folder = derivative_folder
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=retrieval_workers)
+
+    async def retrieve(self, query: str):
+        return await asyncio.wait_for(
+            aquery_db(
+                query=query,
+                collection=self.collection,
+                n_results=self.n_results,
+                metadata_store=self.metadata_store,
+                embedding_cache=self.embedding_cache,
+                lexical_index=self.lexical_index,
+                mode=self.retrieval_mode,
+                executor=self._executor,
+            ),
+            timeout=self.retrieval_timeout,
+        )
+
+    async def answer(self, query: str) -> dict:
+        """
+        Return {"query", "results", "response", "timings"} with per-stage seconds. "queue" is the
+        wait for a concurrency slot; "total" runs from acquiring the slot to the answer.
+        """
+        timings = {}
+        arrival = time.perf_counter()
+        async with self._semaphore:
+            start = time.perf_counter()
+            timings["queue"] = start - arrival
+            stage = "retrieve"
+            try:
+                results = await self.retrieve(query)
+                timings["retrieve"] = time.perf_counter() - start
+
+                stage = "prompt"
+                t0 = time.perf_counter()
+                prompt_input = await asyncio.wait_for(
+                    aformat_prompt_inputs(data=results, user_query=query, derivative_folder=self.derivative_folder),
+                    timeout=self.prompt_timeout,
+                )
+                timings["prompt"] = time.perf_counter() - t0
+
+                stage = "generate"
+                t0 = time.perf_counter()
+                response = await agenerate_answer(self.chain, prompt_input, timeout=self.generation_timeout)
+                timings["generate"] = time.perf_counter() - t0
+            except Exception as e:
+                raise PipelineStageError(stage, timings, e) from e
+            timings["total"] = time.perf_counter() - start
+
+        return {"query": query, "results": results, "response": response, "timings": timings}
+
+    async def answer_many(self, queries, return_exceptions: bool = True):
+        return await asyncio.gather(*(self.answer(q) for q in queries), return_exceptions=return_exceptions)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
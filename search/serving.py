@@ -0,0 +1,495 @@
+"""
+Serving-side surface of the search code: opening the collection or in-process index, querying
+it and warming it up. Unlike search.ingestion it does not import datasets, tqdm or matplotlib,
+and chromadb, OpenCLIP and torch are only imported when the collection or model is first used,
+so a serving process starts quickly and can load the model in the background.
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from functools import lru_cache, partial
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Union, List, Tuple
+
+import numpy as np
+
+from utils.image_utils import show_image_from_path
+from utils.metrics import increment, observe, span
+from utils.metadata_store import MetadataStore, METADATA_PATH
+from search.embedding_cache import (QueryEmbeddingCache,
+                                    ImageEmbeddingCache,
+                                    QUERY_CACHE_PATH,
+                                    COLLECTION_MODEL_NAME,
+                                    COLLECTION_CHECKPOINT,
+                                    combine_embeddings)
+from search.embedding_store import EmbeddingStore, EMBEDDING_STORE_PATH
+from search.ann_index import VectorIndex, IVFIndex, build_index
+from search.lexical_index import (LexicalIndex,
+                                  LEXICAL_INDEX_PATH,
+                                  reciprocal_rank_fusion)
+from search.text_encoder import TEXT_ENCODER_PATH
+from search.near_duplicates import DuplicateClusters, DUPLICATES_PATH, collapse_duplicates
+
+if TYPE_CHECKING:
+    from chromadb.types import Collection
+    from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+
+
+# vector db of amazon dataset
+PATH = "./data/products_base.db"
+
+# retrieval backend: "chroma", or an in-process index over the embedding store ("exact", "ivf")
+INDEX_BACKEND = os.environ.get("RAG_INDEX_BACKEND", "chroma")
+
+# trained IVF index, rebuilt when the embedding store's rows or vectors change
+IVF_INDEX_PATH = "./data/ivf_index.npz"
+
+# results taken from each retriever before rank fusion in hybrid mode
+HYBRID_CANDIDATES = 20
+
+# share of the image in a combined text-plus-image query embedding
+IMAGE_QUERY_WEIGHT = 0.5
+
+# query run by warm_up to load the model and touch the index before real traffic
+WARM_UP_QUERY = "wireless headphones"
+
+# candidates fetched per requested result when near-duplicates are collapsed
+DUPLICATE_OVERFETCH = 3
+
+# the model is loaded once even when the warm-up thread and a request ask for it together
+_embedding_function_lock = threading.Lock()
+
+_warm_up_lock = threading.Lock()
+_warm_up_future = None
+
+
+@lru_cache(maxsize=1)
+def _load_embedding_function() -> OpenCLIPEmbeddingFunction:
+    from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+    return OpenCLIPEmbeddingFunction(model_name=COLLECTION_MODEL_NAME, checkpoint=COLLECTION_CHECKPOINT)
+
+
+def get_embedding_function() -> OpenCLIPEmbeddingFunction:
+    # share one OpenCLIP model between the collection and code that embeds directly
+    with _embedding_function_lock:
+        return _load_embedding_function()
+
+
+@lru_cache(maxsize=1)
+def _load_query_embedding_function():
+    from search.text_encoder import QuantizedTextEmbeddingFunction
+    # the stored image embeddings' width, when ingestion has written the store
+    dim = None
+    meta_path = os.path.join(EMBEDDING_STORE_PATH, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            dim = json.load(f)["dim"]
+    try:
+        return QuantizedTextEmbeddingFunction(TEXT_ENCODER_PATH, model_name=COLLECTION_MODEL_NAME, checkpoint=COLLECTION_CHECKPOINT, dim=dim)
+    except ValueError as e:
+        print(f"Ignoring the text encoder at {TEXT_ENCODER_PATH} and using the full-precision model: {e}")
+        return _load_embedding_function()
+
+
+def get_query_embedding_function():
+    """
+    Encoder for text queries: the int8 text tower exported to RAG_TEXT_ENCODER_PATH when that is
+    set (see search.text_encoder), otherwise the shared OpenCLIP model. A tower exported from
+    another model than the collection's (or of another width than the stored embeddings) is not
+    loaded; queries then fall back to the OpenCLIP model.
+    """
+    if not TEXT_ENCODER_PATH:
+        return get_embedding_function()
+    with _embedding_function_lock:
+        return _load_query_embedding_function()
+
+
+def get_or_create_vector_db(path: str, embedding_function = None) -> Collection:
+    import chromadb
+    from chromadb.utils.data_loaders import ImageLoader
+
+    # setup chromaDB to create embeddings
+    image_loader = ImageLoader()
+    if embedding_function is None:
+        embedding_function = get_embedding_function()
+    chroma_client = chromadb.PersistentClient(path=path)
+
+    product_collection = chroma_client.get_or_create_collection(
+        "base_products_collection",
+        embedding_function=embedding_function,
+        data_loader = image_loader,
+        metadata = {
+            "description": "A vector database storing amazon product images and other metadata like product name, description, category, price, average rating, number of ratings, store name, date first available", 
+            "createdAt": str(datetime.now())
+        }
+    )
+
+    return product_collection
+
+
+def hydrate_results(results: dict, metadata_store: MetadataStore) -> dict:
+    """Replace the slim Chroma metadata in query results with full records from the metadata store."""
+    for row_ids, row_metadatas in zip(results["ids"], results["metadatas"]):
+        records = metadata_store.get_many(list(row_ids))
+        for i, record in enumerate(records):
+            if record is not None:
+                row_metadatas[i] = record
+    return results
+
+
+def vector_search(
+        query_texts: List[str],
+        collection: Union[Collection, VectorIndex],
+        n_results: int,
+        embedding_cache: QueryEmbeddingCache = None,
+        where: dict = None,
+        query_embeddings: List[np.ndarray] = None
+    ) -> dict:
+    if query_embeddings is not None:
+        # image (or text-plus-image) queries arrive already embedded
+        with span("retrieval.search"):
+            return collection.query(
+                query_embeddings=query_embeddings, n_results=n_results, where=where, include=["uris", "distances", "metadatas"]
+            )
+    if embedding_cache is not None:
+        # cached embeddings skip the OpenCLIP text tower entirely on a hit
+        with span("retrieval.encode"):
+            query_embeddings = embedding_cache.embed(query_texts)
+        with span("retrieval.search"):
+            return collection.query(
+                query_embeddings=query_embeddings, n_results=n_results, where=where, include=["uris", "distances", "metadatas"]
+            )
+    # Chroma encodes the query inside collection.query, so both stages share one span
+    with span("retrieval.encode_and_search"):
+        return collection.query(
+            query_texts=query_texts, n_results=n_results, where=where, include=["uris", "distances", "metadatas"]
+        )
+
+
+def hybrid_search(
+        query_texts: List[str],
+        collection: Union[Collection, VectorIndex],
+        n_results: int,
+        lexical_index: LexicalIndex,
+        embedding_cache: QueryEmbeddingCache = None,
+        mode: str = "hybrid",
+        candidates: int = HYBRID_CANDIDATES,
+        where: dict = None,
+        query_embeddings: List[np.ndarray] = None
+    ) -> dict:
+    """
+    Lexical (BM25) and vector retrieval merged by reciprocal rank fusion, in Chroma's result shape
+    plus a "scores" entry with the fused scores. Identifier-like queries (ASINs, model numbers,
+    store names) with at least one lexical hit in the collection skip the text encoder and vector
+    search entirely, as do all queries with mode="lexical"; the others fall back to fusion.
+    "distances" holds the vector distance where one is known. A where clause filters the vector
+    search and the fetch of lexical candidates. Precomputed query_embeddings (image queries)
+    replace the text encoding on the vector side.
+    """
+    candidates = max(candidates, n_results)
+    with span("retrieval.lexical"):
+        # the lexical side is filtered after the fact, so draw a deeper list when filtering
+        lexical = [lexical_index.search(q, candidates * (5 if where else 1))[0] for q in query_texts]
+    fast_path = [mode == "lexical" or (query_embeddings is None and bool(hits) and lexical_index.is_identifier_query(q))
+                 for q, hits in zip(query_texts, lexical)]
+    if mode != "lexical" and any(fast_path):
+        # only skip the vector side when a lexical hit is actually retrievable (in the collection
+        # and matching where); otherwise the identifier query falls back to hybrid retrieval
+        probe = list(dict.fromkeys(asin for skip, hits in zip(fast_path, lexical) if skip for asin in hits))
+        present = set(collection.get(ids = probe, where = where, include = [])["ids"])
+        fast_path = [skip and any(asin in present for asin in hits) for skip, hits in zip(fast_path, lexical)]
+    increment("retrieval.lexical_fast_path", sum(fast_path))
+
+    vector_rows = [i for i, skip in enumerate(fast_path) if not skip]
+    vector_ids, vector_distances = {}, {}
+    if vector_rows:
+        embeddings = None if query_embeddings is None else [query_embeddings[i] for i in vector_rows]
+        vector = vector_search([query_texts[i] for i in vector_rows], collection, candidates, embedding_cache, where, embeddings)
+        for i, ids, distances in zip(vector_rows, vector["ids"], vector["distances"]):
+            vector_ids[i] = list(ids)
+            vector_distances[i] = dict(zip(ids, distances))
+
+    fused = [reciprocal_rank_fusion([vector_ids.get(i, []), lexical[i]]) for i in range(len(query_texts))]
+    wanted = list(dict.fromkeys(asin for ranking in fused for asin, _ in ranking))
+    # uris and slim metadata of every candidate, which drops products missing from the vector db
+    found = collection.get(ids = wanted, where = where, include = ["uris", "metadatas"]) if wanted else {"ids": [], "uris": [], "metadatas": []}
+    rows_of = {asin: (uri, metadata) for asin, uri, metadata in zip(found["ids"], found["uris"], found["metadatas"])}
+
+    result = {"ids": [], "distances": [], "uris": [], "metadatas": [], "scores": []}
+    for i, ranking in enumerate(fused):
+        ranking = [(asin, score) for asin, score in ranking if asin in rows_of][:n_results]
+        result["ids"].append([asin for asin, _ in ranking])
+        result["scores"].append([score for _, score in ranking])
+        result["distances"].append([vector_distances.get(i, {}).get(asin) for asin, _ in ranking])
+        result["uris"].append([rows_of[asin][0] for asin, _ in ranking])
+        result["metadatas"].append([dict(rows_of[asin][1] or {}) for asin, _ in ranking])
+    return result
+
+
+def embed_image_queries(
+        query_texts: List[str],
+        images: list,
+        embedding_cache: QueryEmbeddingCache = None,
+        image_cache: ImageEmbeddingCache = None,
+        image_weight: float = IMAGE_QUERY_WEIGHT
+    ) -> List[np.ndarray]:
+    """
+    Query embeddings for images paired with (possibly empty) texts: the image embedding alone,
+    or combined with the text embedding when the text is not blank.
+    """
+    if image_cache is None:
+        image_cache = ImageEmbeddingCache(get_embedding_function())
+    with span("retrieval.image_encode"):
+        embeddings = image_cache.embed(images)
+    texted = [i for i, text in enumerate(query_texts) if text and text.strip()]
+    if texted:
+        texts = [query_texts[i] for i in texted]
+        with span("retrieval.encode"):
+            text_embeddings = embedding_cache.embed(texts) if embedding_cache is not None else get_query_embedding_function()(texts)
+        for i, text_embedding in zip(texted, text_embeddings):
+            embeddings[i] = combine_embeddings(np.asarray(text_embedding, dtype=np.float32), embeddings[i], image_weight)
+    return embeddings
+
+
+def query_db(
+        query: Union[str, List[str]], 
+        collection: Union[Collection, VectorIndex], 
+        n_results: int = 5,
+        metadata_store: MetadataStore = None,
+        embedding_cache: QueryEmbeddingCache = None,
+        lexical_index: LexicalIndex = None,
+        mode: str = "vector",
+        where: dict = None,
+        image = None,
+        image_cache: ImageEmbeddingCache = None,
+        image_weight: float = IMAGE_QUERY_WEIGHT,
+        duplicate_clusters: DuplicateClusters = None
+    ):
+    """
+    Top n_results products per query. mode is "vector" (CLIP text-to-image search), "hybrid"
+    (vector and BM25 results fused, with a lexical-only fast path for identifier-like queries)
+    or "lexical" (BM25 only); the last two need a lexical_index. Results carry the full product
+    records from metadata_store (get_metadata_store()); without it they hold only the slim Chroma
+    metadata, which has no descriptions.
+
+    where is a Chroma metadata filter over price, average_rating, rating_number, main_category
+    and store (see search.query_filters.parse_query_constraints to build one from query text).
+    It is applied inside the nearest-neighbour search, so all n_results returned products match.
+
+    image (encoded bytes, a file path, a PIL image or an array; or a list, one per query) searches
+    by image instead: alone when query is empty, otherwise combined with the text embedding with
+    weight image_weight. Image embeddings are cached by content hash in image_cache. In hybrid
+    mode the text still drives the lexical side.
+
+    With duplicate_clusters, DUPLICATE_OVERFETCH times as many candidates are retrieved and only
+    the best-ranked product of each near-duplicate cluster is kept, so the n_results products
+    are visually distinct.
+    """
+    images = None
+    if image is not None:
+        images = image if isinstance(image, list) else [image]
+    print(f"Querying the database for: {query}" + (f" with {len(images)} image(s)" if images else ""))
+    # Ensure query_texts is always a list of strings
+    if not query and images:
+        query_texts = [""] * len(images)
+    elif isinstance(query, str):
+        query_texts = [query]
+    else:
+        query_texts = query
+
+    query_embeddings = None
+    if images:
+        if len(images) != len(query_texts):
+            raise ValueError(f"Got {len(images)} images for {len(query_texts)} queries")
+        if mode == "lexical":
+            raise ValueError("Image queries need mode='vector' or mode='hybrid'")
+        query_embeddings = embed_image_queries(query_texts, images, embedding_cache, image_cache, image_weight)
+
+    fetch = n_results * DUPLICATE_OVERFETCH if duplicate_clusters is not None else n_results
+    if mode == "vector":
+        result = vector_search(query_texts, collection, fetch, embedding_cache, where, query_embeddings)
+    elif mode in ("hybrid", "lexical"):
+        if lexical_index is None:
+            raise ValueError(f"mode={mode!r} needs a lexical_index")
+        result = hybrid_search(query_texts, collection, fetch, lexical_index, embedding_cache, mode = mode, where = where,
+                               query_embeddings = query_embeddings)
+    else:
+        raise ValueError(f"Unknown retrieval mode {mode!r}; use 'vector', 'hybrid' or 'lexical'")
+    if duplicate_clusters is not None:
+        with span("retrieval.collapse_duplicates"):
+            collapse_duplicates(result, duplicate_clusters, n_results)
+    if metadata_store is not None:
+        with span("retrieval.hydrate"):
+            hydrate_results(result, metadata_store)
+    return result
+
+
+async def aquery_db(
+        query: Union[str, List[str]], 
+        collection: Union[Collection, VectorIndex], 
+        n_results: int = 5,
+        metadata_store: MetadataStore = None,
+        embedding_cache: QueryEmbeddingCache = None,
+        lexical_index: LexicalIndex = None,
+        mode: str = "vector",
+        where: dict = None,
+        image = None,
+        image_cache: ImageEmbeddingCache = None,
+        duplicate_clusters: DuplicateClusters = None,
+        executor: Executor = None
+    ):
+    """
+    Async counterpart of query_db. Chroma's client is synchronous, so the query runs on
+    executor (the loop's default thread pool if None) without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(
+        query_db,
+        query = query,
+        collection = collection,
+        n_results = n_results,
+        metadata_store = metadata_store,
+        embedding_cache = embedding_cache,
+        lexical_index = lexical_index,
+        mode = mode,
+        where = where,
+        image = image,
+        image_cache = image_cache,
+        duplicate_clusters = duplicate_clusters
+    ))
+
+
+def print_results(results):
+    for idx, uri in enumerate(results["uris"][0]):
+        print("ID: ", results["uris"][0][idx])
+        print("Distance: ", results["distances"][0][idx])
+        print(f"Path: {uri}")
+        print(f"Title: ", results["metadatas"][0][idx]["title"])
+        print(f"Description: ", results["metadatas"][0][idx].get("description", ""))
+        print(f"Rating: ", results["metadatas"][0][idx]["average_rating"])
+        print(f"Price: ", results["metadatas"][0][idx]["price"])
+        show_image_from_path(uri)
+        print()
+
+
+def get_collection(product_dataset_name: str = "Amazon-2023", backend: str = INDEX_BACKEND):
+    if backend != "chroma":
+        # drop-in replacement for the collection: query_db only calls .query, and hybrid_search
+        # .get(ids=..., where=..., include=[...]) for candidate lookups
+        return get_vector_index(backend)
+
+    # create vector db:
+    product_collection = get_or_create_vector_db(PATH)
+    
+    return product_collection
+
+
+def get_vector_index(
+        backend: str = "ivf",
+        store_path: str = EMBEDDING_STORE_PATH,
+        index_path: str = IVF_INDEX_PATH,
+        metadata_store: MetadataStore = None,
+        **params
+    ) -> VectorIndex:
+    """
+    In-process index over the memory-mapped embedding store. A trained IVF index is cached at
+    index_path and reused while the store holds the same ids and version (any put or delete
+    since the index was built forces a rebuild); other params (nlist, nprobe, quantizer, pq_m,
+    rerank) only apply when it is (re)built.
+    """
+    store = EmbeddingStore(store_path)
+    ids, uris, vectors = store.as_arrays()
+    if metadata_store is None:
+        metadata_store = get_metadata_store()
+    # the index only ever embeds query text
+    embedding_function = get_query_embedding_function()
+    if backend == "ivf" and index_path and os.path.exists(index_path):
+        try:
+            return IVFIndex.load(index_path, ids, uris, vectors, embedding_function, metadata_store, stamp = store.version)
+        except ValueError as e:
+            print(f"Rebuilding IVF index: {e}")
+    index = build_index(backend, ids, uris, vectors, embedding_function, metadata_store, **params)
+    if backend == "ivf" and index_path:
+        index.save(index_path, stamp = store.version)
+    print(f"{backend} index over {index.count()} embeddings uses {index.memory_bytes() / 1e6:.1f} MB")
+    return index
+
+
+def get_query_embedding_cache(max_entries: int = 10000, disk_path: str = QUERY_CACHE_PATH) -> QueryEmbeddingCache:
+    # query-embedding cache in front of the query encoder (the collection's OpenCLIP model by default)
+    return QueryEmbeddingCache(get_query_embedding_function(), max_entries = max_entries, disk_path = disk_path)
+
+
+def get_image_embedding_cache(max_entries: int = 1000, disk_path: str = QUERY_CACHE_PATH) -> ImageEmbeddingCache:
+    # image-query embedding cache sharing the collection's OpenCLIP model (and the text cache's file)
+    return ImageEmbeddingCache(get_embedding_function(), max_entries = max_entries, disk_path = disk_path)
+
+
+def get_lexical_index(path: str = LEXICAL_INDEX_PATH) -> LexicalIndex:
+    # open the BM25 index written during ingestion (empty until built)
+    return LexicalIndex(path)
+
+
+def get_metadata_store(path: str = METADATA_PATH) -> MetadataStore:
+    # open the metadata store written during ingestion
+    return MetadataStore(path)
+
+
+def get_duplicate_clusters(path: str = DUPLICATES_PATH) -> DuplicateClusters:
+    # open the near-duplicate clusters written during ingestion (empty until built)
+    return DuplicateClusters(path)
+
+
+def warm_up(
+        open_collection: Callable[[], Union[Collection, VectorIndex]] = None,
+        embedding_function = None,
+        query: str = WARM_UP_QUERY
+    ) -> Tuple[Union[Collection, VectorIndex], dict]:
+    """
+    Load the query encoder (get_query_embedding_function() if None), open the collection with
+    open_collection (get_collection if None) and run one query through it, so the first user
+    query pays only for its own search. Returns the collection and the seconds per step.
+    """
+    seconds = {}
+    start = time.perf_counter()
+    if embedding_function is None:
+        embedding_function = get_query_embedding_function()
+    seconds["model_load"] = time.perf_counter() - start
+
+    t0 = time.perf_counter()
+    collection = (open_collection or get_collection)()
+    seconds["collection_open"] = time.perf_counter() - t0
+
+    # a direct query: warm-up traffic stays out of the query-embedding cache
+    t0 = time.perf_counter()
+    collection.query(query_embeddings=embedding_function([query]), n_results=1, include=["distances"])
+    seconds["first_query"] = time.perf_counter() - t0
+    seconds["total"] = time.perf_counter() - start
+
+    for step, value in seconds.items():
+        observe(f"startup.{step}", value)
+    print("Warm-up done: " + " ".join(f"{step}={value * 1000:.0f}ms" for step, value in seconds.items()))
+    return collection, seconds
+
+
+def start_warm_up(**kwargs) -> Future:
+    """
+    Run warm_up(**kwargs) on a background thread, once per process; later calls return the same
+    future, whose result is warm_up's (collection, seconds). A warm-up that failed (e.g. a
+    transient model download error or a locked db) is started again by the next call.
+    """
+    global _warm_up_future
+    with _warm_up_lock:
+        failed = _warm_up_future is not None and _warm_up_future.done() and _warm_up_future.exception() is not None
+        if failed:
+            print(f"Retrying warm-up after: {_warm_up_future.exception()!r}")
+        if _warm_up_future is None or failed:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm-up")
+            _warm_up_future = executor.submit(warm_up, **kwargs)
+            executor.shutdown(wait=False)
+        return _warm_up_future
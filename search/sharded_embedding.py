@@ -0,0 +1,143 @@
+"""
+Multi-process image embedding for ingestion on many-core hosts.
+
+The file list is split into one contiguous shard per worker process. Each worker loads its own
+copy of the model, pins its thread pools to threads_per_worker and decodes and embeds its shard
+chunk by chunk, sending the vectors back over a bounded queue. The parent is the only writer:
+it consumes the chunks as they arrive and writes them to the collection and embedding store,
+so Chroma and the memory-mapped store never see concurrent writers.
+
+Workers are started with the "spawn" method (torch is not fork-safe) and import only this
+module, numpy, PIL and the embedding function.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import traceback
+import multiprocessing
+from typing import Callable, Iterator, List
+
+import numpy as np
+
+from search.embedding_cache import COLLECTION_MODEL_NAME, COLLECTION_CHECKPOINT, embedding_model_config
+from utils.image_utils import load_image_chunk
+
+
+# thread pools sized by environment variables, which must be set before a worker imports numpy/torch
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+def default_embedding_function():
+    """The collection's OpenCLIP model, built inside each worker."""
+    from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+    return OpenCLIPEmbeddingFunction(model_name=COLLECTION_MODEL_NAME, checkpoint=COLLECTION_CHECKPOINT)
+
+
+def split_shards(total: int, workers: int) -> List[slice]:
+    """Contiguous, near-equal slices of range(total), one per worker (fewer if total is small)."""
+    workers = max(1, min(workers, total))
+    bounds = np.linspace(0, total, workers + 1).round().astype(int)
+    return [slice(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _embed_shard(worker: int, ids: List[str], uris: List[str], chunk_size: int, threads: int, factory: Callable, results):
+    try:
+        embedding_function = factory()
+        if "torch" in sys.modules:
+            # env vars cover OpenMP; torch's own intra-op pool is set explicitly
+            sys.modules["torch"].set_num_threads(threads)
+        # JSON round trip: the config is pickled to the parent and fingerprinted there
+        config = json.loads(json.dumps(embedding_model_config(embedding_function), default=str))
+        results.put(("ready", worker, config))
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids, chunk_uris = ids[start:start + chunk_size], uris[start:start + chunk_size]
+            t0 = time.perf_counter()
+            ok, images = load_image_chunk(chunk_uris)
+            t1 = time.perf_counter()
+            embeddings = np.asarray(embedding_function(images), dtype=np.float32) if images else None
+            t2 = time.perf_counter()
+            results.put(("chunk", worker, {
+                "attempted": chunk_ids,
+                "ids": [chunk_ids[i] for i in ok],
+                "uris": [chunk_uris[i] for i in ok],
+                "embeddings": embeddings,
+                "skipped": len(chunk_ids) - len(ok),
+                "decode_s": t1 - t0,
+                "embed_s": t2 - t1,
+            }))
+        results.put(("done", worker, None))
+    except Exception:
+        results.put(("error", worker, traceback.format_exc()))
+
+
+def embed_sharded(
+        ids: List[str],
+        uris: List[str],
+        workers: int,
+        threads_per_worker: int = None,
+        chunk_size: int = 64,
+        embedding_function_factory: Callable = default_embedding_function,
+        queue_depth: int = 2
+    ) -> Iterator[dict]:
+    """
+    Embed the images at uris in workers processes and yield one dict per chunk as it completes:
+    the chunk's ids ("attempted"), ids, uris and embeddings of the decodable images, the count of
+    skipped files, the worker's decode/embed seconds and the embedding function's model_config.
+    Chunks of different workers arrive interleaved. At most queue_depth chunks per worker wait in
+    the queue, which bounds memory when the writer is slower than the workers.
+
+    embedding_function_factory is called in each worker to build its model and must be
+    picklable (a module-level function or class, or a functools.partial of one). threads_per_worker
+    defaults to the cores divided evenly between workers.
+    """
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // max(1, workers))
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue(maxsize=queue_depth * max(1, workers))
+    processes = []
+
+    # spawned children inherit the environment at start(), before they import anything
+    saved = {name: os.environ.get(name) for name in _THREAD_ENV_VARS}
+    os.environ.update({name: str(threads) for name in _THREAD_ENV_VARS})
+    try:
+        for worker, shard in enumerate(split_shards(len(ids), workers)):
+            process = context.Process(target=_embed_shard, daemon=True, name=f"embed-{worker}",
+                                      args=(worker, ids[shard], uris[shard], chunk_size, threads, embedding_function_factory, results))
+            process.start()
+            processes.append(process)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    model_configs = {}
+    running = len(processes)
+    try:
+        while running:
+            try:
+                kind, worker, payload = results.get(timeout=5)
+            except queue.Empty:
+                # a worker killed outright (e.g. by the OOM killer) never reports back
+                crashed = [p for p in processes if p.exitcode not in (None, 0)]
+                if crashed:
+                    raise RuntimeError(f"Embedding worker {crashed[0].name} exited with code {crashed[0].exitcode}")
+                continue
+            if kind == "ready":
+                model_configs[worker] = payload
+                if payload != next(iter(model_configs.values())):
+                    raise RuntimeError(f"Embedding workers built different models: {payload} vs {next(iter(model_configs.values()))}")
+            elif kind == "chunk":
+                yield {"worker": worker, "model_config": model_configs[worker], **payload}
+            elif kind == "done":
+                running -= 1
+            else:
+                raise RuntimeError(f"Embedding worker {worker} failed:\n{payload}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,277 @@
+"""
+CPU query encoder: the OpenCLIP text tower exported on its own, int8-quantized and traced to
+TorchScript, so serving can embed queries without running the full-precision model.
+
+Usage:
+    python -m search.text_encoder export --output ./models/text_int8
+    python -m search.text_encoder check --model-path ./models/text_int8 --queries queries.txt --store ./data/embeddings
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List
+
+import numpy as np
+
+from search.embedding_cache import COLLECTION_MODEL_NAME, COLLECTION_CHECKPOINT
+
+
+# exported quantized text tower used for queries when set (see serving.get_query_embedding_function)
+TEXT_ENCODER_PATH = os.environ.get("RAG_TEXT_ENCODER_PATH", "")
+
+# intra-op threads for the quantized encoder; 0 leaves torch's default (one per core)
+TEXT_ENCODER_THREADS = int(os.environ.get("RAG_TEXT_ENCODER_THREADS", "0"))
+
+# the collection's model: a tower exported from anything else does not embed into its space
+DEFAULT_MODEL_NAME = COLLECTION_MODEL_NAME
+DEFAULT_CHECKPOINT = COLLECTION_CHECKPOINT
+
+_MODEL_FILE = "text_tower.pt"
+_CONFIG_FILE = "config.json"
+
+
+def export_text_tower(
+        output_dir: str,
+        model_name: str = DEFAULT_MODEL_NAME,
+        checkpoint: str = DEFAULT_CHECKPOINT,
+        quantize: bool = True
+    ) -> dict:
+    """
+    Export the text tower of an OpenCLIP model to output_dir as TorchScript. With quantize, the
+    Linear layers (most of the tower's weights) are dynamically quantized to int8. The visual
+    tower is dropped, so the file holds only what query encoding needs.
+    """
+    import torch
+    import open_clip
+
+    model, _, _ = open_clip.create_model_and_transforms(model_name, pretrained=checkpoint, device="cpu")
+    model.eval()
+    model.visual = torch.nn.Identity()
+    tokenizer = open_clip.get_tokenizer(model_name)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, clip):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, tokens):
+            features = self.clip.encode_text(tokens)
+            return features / features.norm(dim=-1, keepdim=True)
+
+    tower = TextTower(model).eval()
+    if quantize:
+        tower = torch.ao.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+    example = tokenizer(["a photo of a product", "wireless headphones"])
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(tower, example))
+        dim = int(traced(example).shape[-1])
+
+    os.makedirs(output_dir, exist_ok=True)
+    torch.jit.save(traced, os.path.join(output_dir, _MODEL_FILE))
+    config = {
+        "model_name": model_name,
+        "checkpoint": checkpoint,
+        "quantization": "dynamic-int8" if quantize else "none",
+        "context_length": int(example.shape[-1]),
+        "dim": dim,
+        "torch": torch.__version__,
+    }
+    with open(os.path.join(output_dir, _CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+    size_mb = os.path.getsize(os.path.join(output_dir, _MODEL_FILE)) / 1e6
+    print(f"Exported {model_name} ({checkpoint}) text tower to {output_dir}: {size_mb:.0f} MB, {config['quantization']}")
+    return config
+
+
+def check_tower_config(config: dict, model_name: str = DEFAULT_MODEL_NAME, checkpoint: str = DEFAULT_CHECKPOINT, dim: int = None):
+    """
+    Raise ValueError unless an exported tower's config names model_name and checkpoint (and, when
+    given, embeds into dim dimensions), i.e. unless its queries land in the collection's space.
+    """
+    expected = {"model_name": model_name, "checkpoint": checkpoint}
+    if dim is not None:
+        expected["dim"] = dim
+    mismatched = [f"{key} is {config.get(key)!r}, not {value!r}" for key, value in expected.items() if config.get(key) != value]
+    if mismatched:
+        raise ValueError("Exported text tower does not match the collection's model: " + ", ".join(mismatched))
+
+
+class QuantizedTextEmbeddingFunction:
+    """
+    Text-only embedding function over a tower written by export_text_tower. Texts are tokenized
+    with the model's OpenCLIP tokenizer and encoded in batches of batch_size in one forward pass
+    each (OpenCLIPEmbeddingFunction encodes them one at a time).
+
+    num_threads and interop_threads set torch's thread pools, which are process-wide; 0 keeps
+    torch's defaults. Images are not supported: the collection's OpenCLIP function still embeds
+    them at ingestion and for image queries.
+
+    The tower must have been exported from model_name and checkpoint (and embed into dim
+    dimensions, when given); otherwise ValueError is raised before it is loaded.
+    """
+
+    def __init__(
+            self,
+            model_path: str,
+            num_threads: int = TEXT_ENCODER_THREADS,
+            interop_threads: int = 0,
+            batch_size: int = 64,
+            model_name: str = DEFAULT_MODEL_NAME,
+            checkpoint: str = DEFAULT_CHECKPOINT,
+            dim: int = None
+        ):
+        with open(os.path.join(model_path, _CONFIG_FILE), "r") as f:
+            self.config = json.load(f)
+        check_tower_config(self.config, model_name, checkpoint, dim)
+
+        import torch
+        import open_clip
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError:
+                # only allowed before the first parallel op in the process
+                print(f"Could not set interop threads to {interop_threads}: torch already started its pool")
+        self.model_path = model_path
+        self.num_threads = torch.get_num_threads()
+        self.batch_size = batch_size
+        self._torch = torch
+        self._model = torch.jit.load(os.path.join(model_path, _MODEL_FILE), map_location="cpu")
+        self._tokenizer = open_clip.get_tokenizer(self.config["model_name"])
+
+    def __call__(self, input: List[str]) -> List[np.ndarray]:
+        if any(not isinstance(text, str) for text in input):
+            raise TypeError("QuantizedTextEmbeddingFunction only embeds text")
+        embeddings = []
+        for start in range(0, len(input), self.batch_size):
+            embeddings.extend(self.encode_batch(input[start:start + self.batch_size]))
+        return embeddings
+
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        """(len(texts), dim) embeddings of texts in a single forward pass, whatever batch_size is."""
+        with self._torch.inference_mode():
+            return np.asarray(self._model(self._tokenizer(list(texts))).numpy(), dtype=np.float32)
+
+    @staticmethod
+    def name() -> str:
+        return "open_clip_text_int8"
+
+    def get_config(self) -> dict:
+        # identifies the exported weights, so query-embedding caches keep them apart from fp32
+        return {key: self.config[key] for key in ("model_name", "checkpoint", "quantization", "torch")}
+
+
+def encode_text_batch(embedding_function, texts: List[str]) -> np.ndarray:
+    """
+    (len(texts), dim) unit-normalized embeddings of texts in one forward pass of the text model.
+    OpenCLIPEmbeddingFunction's __call__ encodes texts one at a time, so its tokenizer and model
+    are called directly; other embedding functions are called as they are.
+    """
+    if isinstance(embedding_function, QuantizedTextEmbeddingFunction):
+        return embedding_function.encode_batch(texts)
+    model = getattr(embedding_function, "_model", None)
+    tokenizer = getattr(embedding_function, "_tokenizer", None)
+    if model is None or tokenizer is None:
+        return np.asarray(embedding_function(list(texts)), dtype=np.float32)
+    torch = embedding_function._torch
+    with torch.no_grad():
+        features = model.encode_text(tokenizer(list(texts)).to(embedding_function.device))
+        features /= features.norm(dim=-1, keepdim=True)
+    return np.asarray(features.cpu().numpy(), dtype=np.float32)
+
+
+def check_parity(
+        candidate,
+        reference,
+        queries: List[str],
+        collection,
+        k: int = 10,
+        min_cosine: float = 0.98,
+        min_overlap: float = 0.9
+    ) -> dict:
+    """
+    Compare a query encoder against the full-precision one on queries: cosine similarity of
+    their embeddings, and overlap of the top-k products each retrieves from collection (anything
+    with a Chroma-style .query). Passes when every cosine is at least min_cosine and the mean
+    top-k overlap is at least min_overlap.
+    """
+    candidate_embeddings = np.asarray(candidate(queries), dtype=np.float32)
+    reference_embeddings = np.asarray(reference(queries), dtype=np.float32)
+    cosines = (candidate_embeddings * reference_embeddings).sum(1) / (
+        np.linalg.norm(candidate_embeddings, axis=1) * np.linalg.norm(reference_embeddings, axis=1))
+
+    overlaps = []
+    for start in range(0, len(queries), 256):
+        batch = slice(start, start + 256)
+        found = collection.query(query_embeddings=candidate_embeddings[batch], n_results=k, include=["distances"])["ids"]
+        truth = collection.query(query_embeddings=reference_embeddings[batch], n_results=k, include=["distances"])["ids"]
+        overlaps.extend(len(set(f) & set(t)) / max(len(t), 1) for f, t in zip(found, truth))
+    overlaps = np.asarray(overlaps)
+
+    report = {
+        "queries": len(queries),
+        "k": k,
+        "cosine_mean": round(float(cosines.mean()), 5),
+        "cosine_min": round(float(cosines.min()), 5),
+        "overlap_mean": round(float(overlaps.mean()), 4),
+        "overlap_min": round(float(overlaps.min()), 4),
+        "worst_queries": [queries[i] for i in np.argsort(cosines)[:5]],
+    }
+    report["passed"] = bool(report["cosine_min"] >= min_cosine and report["overlap_mean"] >= min_overlap)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="export and quantize the text tower")
+    export.add_argument("--output", required=True)
+    export.add_argument("--model", default=DEFAULT_MODEL_NAME)
+    export.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    export.add_argument("--no-quantize", action="store_true")
+    check = commands.add_parser("check", help="parity of an exported tower against the full-precision model")
+    check.add_argument("--model-path", required=True)
+    check.add_argument("--queries", default=None, help=".txt or .jsonl queries (default: synthetic)")
+    check.add_argument("--store", default=None, help="embedding store to retrieve from (default: the Chroma collection)")
+    check.add_argument("--k", type=int, default=10)
+    check.add_argument("--min-cosine", type=float, default=0.98)
+    check.add_argument("--min-overlap", type=float, default=0.9)
+    check.add_argument("--threads", type=int, default=TEXT_ENCODER_THREADS)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_text_tower(args.output, args.model, args.checkpoint, quantize=not args.no_quantize)
+        return
+
+    from search.serving import get_collection, get_embedding_function
+    # raises unless the tower was exported from the collection's model
+    candidate = QuantizedTextEmbeddingFunction(args.model_path, num_threads=args.threads)
+    reference = get_embedding_function()
+    if args.queries:
+        from search.batch_search import read_queries
+        _, queries = read_queries(args.queries)
+    else:
+        from benchmarks.synthetic import generate_queries
+        queries = generate_queries(500)
+    if args.store:
+        from search.ann_index import ExactIndex
+        from search.embedding_store import EmbeddingStore
+        collection = ExactIndex(*EmbeddingStore(args.store).as_arrays())
+    else:
+        collection = get_collection(backend="chroma")
+
+    start = time.perf_counter()
+    report = check_parity(candidate, reference, queries, collection, args.k, args.min_cosine, args.min_overlap)
+    print(json.dumps(report, indent=2))
+    print(f"Parity {'passed' if report['passed'] else 'FAILED'} in {time.perf_counter() - start:.1f}s "
+          f"(cosine >= {args.min_cosine}, mean top-{args.k} overlap >= {args.min_overlap})")
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Differential check of utils.text_preprocess.normalize_text against the original
+two-function implementation (normalize_homoglyphs followed by the regex passes),
+run over the text fields of the real catalog. Also reports the speedup.
+
+Usage:
+    python -m testing_scripts.check_normalize_text --rows 50000
+"""
+import re
+import time
+import argparse
+import unicodedata
+
+from datasets import load_dataset
+
+from utils.homoglyphs import _TRANSLATION_TABLE, unidecode
+from utils.text_preprocess import normalize_text
+
+FIELDS = ["title", "description", "main_category", "store"]
+
+EDGE_CASES = [
+    "", " ", "\n\t", "VoI. 2", "voI. 3", "VOI. 4", "Vo I .", "15\" Laptop", "a %", " .x", "x , y ;z",
+    "Ｆｕｌｌｗｉｄｔｈ １２３", "Ναι Кофе", "“Quoted” — dash…", "Café crème", "emoji 🎧 headphones",
+    "tab\tand nbsp　ideographic", "under_score & ampersand # hash", "Ϲ Ϻ ᧐", "ﬁ ligature",
+]
+
+
+def reference_normalize_homoglyphs(text: str) -> str:
+    s = unicodedata.normalize("NFKC", text)
+    s = s.translate(_TRANSLATION_TABLE)
+    if unidecode is not None:
+        try:
+            s = unidecode(s)
+        except Exception:
+            pass
+    s = re.sub(r"[^\x00-\x7F]+", "", s)
+    s = re.sub(r"\s+", " ", s).strip()
+    s = re.sub(r"\s+([.,;:!?%])", r"\1", s)
+    s = re.sub(r"\b(V|v)oI\.", r"\1ol.", s)
+    return s.upper()
+
+
+def reference_normalize_text(text: str) -> str:
+    if not isinstance(text, str):
+        return ""
+    text = reference_normalize_homoglyphs(text)
+    text = unicodedata.normalize("NFKC", text)
+    text = text.replace("\n", " ")
+    text = re.sub(r"[^\w\s.,!?;:()\"'-]", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    text = re.sub(r'(\d+)"', r"\1 inch", text)
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=None, help="number of catalog rows to check (default: all)")
+    args = parser.parse_args()
+
+    data = load_dataset("milistu/AMAZON-Products-2023")["train"].select_columns(FIELDS)
+    if args.rows:
+        data = data.select(range(min(args.rows, len(data))))
+
+    values = list(EDGE_CASES)
+    for field in FIELDS:
+        values.extend(data[field])
+
+    start = time.perf_counter()
+    expected = [reference_normalize_text(v) for v in values]
+    reference_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [normalize_text(v) for v in values]
+    fast_s = time.perf_counter() - start
+
+    mismatches = [(v, e, a) for v, e, a in zip(values, expected, actual) if e != a]
+    for value, exp, act in mismatches[:20]:
+        print(f"MISMATCH for {value!r}:\n  expected {exp!r}\n  actual   {act!r}")
+
+    print(f"Checked {len(values)} values: {len(mismatches)} mismatches")
+    print(f"reference {reference_s:.2f}s, normalize_text {fast_s:.2f}s, speedup {reference_s / fast_s:.1f}x")
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
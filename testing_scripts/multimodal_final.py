@@ -2,6 +2,7 @@ from search.search_query import (get_collection,
                                 load_data_into_collection, 
                                 query_db,
                                 print_results,
+                                get_metadata_store,
                                 )
 from utils.image_utils import show_image_from_path
 from utils.langchain import (format_prompt_inputs,
@@ -23,6 +24,12 @@ def get_cached_collection():
     return get_collection()
 
 
+@st.cache_resource
+def get_cached_metadata_store():
+    # descriptions live in the metadata store, not in the slim Chroma metadata
+    return get_metadata_store()
+
+
 @st.cache_resource
 def get_cached_vision_model(model_name="gpt-4o", temperature=0.0):
     return get_vision_model(model_name, temperature)
@@ -75,7 +82,7 @@ if __name__ == "__main__":
     
         # fetch the images from VectorDB based on text query
         with st.spinner("Retrieving images..."):
-            results = query_db(query = query, collection = product_collection, n_results = 2)
+            results = query_db(query = query, collection = product_collection, n_results = 2, metadata_store = get_cached_metadata_store())
         
         # display the retrieved images
         st.write("Here are the top products based on your query:")
@@ -0,0 +1,108 @@
+import io
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from utils.image_utils import download_images
+
+
+def _png(color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+IMAGES = {"/red.png": _png("red"), "/flaky.png": _png("green"), "/truncated.png": _png("blue")}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # keep-alive, as served by the real image host
+    protocol_version = "HTTP/1.1"
+    requests = Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        first = self.requests[self.path] == 1
+        body = IMAGES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path == "/flaky.png" and first:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if self.path == "/truncated.png" and first:
+                # the connection drops halfway through the body
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    ImageHandler.requests.clear()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(server, tmp_path, names, **kwargs):
+    items = [(f"{server}/{name}", str(tmp_path / name)) for name in names]
+    return download_images(items, workers=4, timeout=5.0, backoff=0.0, **kwargs)
+
+
+def test_downloads_and_skips_present_files(server, tmp_path):
+    stats = _download(server, tmp_path, ["red.png"])
+    assert stats == {"downloaded": 1, "skipped": 0, "failed": 0}
+    with Image.open(tmp_path / "red.png") as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+
+    stats = _download(server, tmp_path, ["red.png"])
+    assert stats == {"downloaded": 0, "skipped": 1, "failed": 0}
+    assert ImageHandler.requests["/red.png"] == 1
+
+
+def test_retries_server_errors(server, tmp_path):
+    stats = _download(server, tmp_path, ["flaky.png"])
+    assert stats == {"downloaded": 1, "skipped": 0, "failed": 0}
+    assert ImageHandler.requests["/flaky.png"] == 2
+
+    stats = _download(server, tmp_path, ["missing.png"])
+    assert stats == {"downloaded": 0, "skipped": 0, "failed": 1}
+    assert not os.path.exists(tmp_path / "missing.png")
+
+
+def test_partial_download_is_retried_and_replaces_stale_part_file(server, tmp_path):
+    # left behind by an interrupted run
+    (tmp_path / "truncated.png.part").write_bytes(b"half an image")
+
+    stats = _download(server, tmp_path, ["truncated.png"])
+    assert stats == {"downloaded": 1, "skipped": 0, "failed": 0}
+    assert ImageHandler.requests["/truncated.png"] == 2
+    assert not os.path.exists(tmp_path / "truncated.png.part")
+    with Image.open(tmp_path / "truncated.png") as image:
+        assert image.getpixel((0, 0)) == (0, 0, 255)
+
+
+def test_duplicate_destinations_are_downloaded_once(server, tmp_path):
+    path = str(tmp_path / "red.png")
+    stats = download_images([(f"{server}/red.png", path)] * 8, workers=8, timeout=5.0, backoff=0.0)
+    assert stats == {"downloaded": 1, "skipped": 7, "failed": 0}
+    assert ImageHandler.requests["/red.png"] == 1
@@ -0,0 +1,34 @@
+import inspect
+
+import pytest
+from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+
+from search.ingestion import DeferredOpenCLIPEmbeddingFunction
+from search.text_encoder import (DEFAULT_MODEL_NAME,
+                                 DEFAULT_CHECKPOINT,
+                                 check_tower_config,
+                                 export_text_tower)
+
+
+def _defaults(function) -> dict:
+    parameters = inspect.signature(function).parameters
+    return {name: parameters[name].default for name in ("model_name", "checkpoint")}
+
+
+def test_export_defaults_match_collection_model():
+    exported = _defaults(export_text_tower)
+    assert exported == {"model_name": DEFAULT_MODEL_NAME, "checkpoint": DEFAULT_CHECKPOINT}
+    assert exported == _defaults(DeferredOpenCLIPEmbeddingFunction.__init__)
+    assert exported == _defaults(OpenCLIPEmbeddingFunction.__init__)
+
+
+def test_check_tower_config():
+    config = {"model_name": DEFAULT_MODEL_NAME, "checkpoint": DEFAULT_CHECKPOINT, "dim": 512}
+    check_tower_config(config)
+    check_tower_config(config, dim=512)
+    with pytest.raises(ValueError, match="dim"):
+        check_tower_config(config, dim=1024)
+    with pytest.raises(ValueError, match="model_name"):
+        check_tower_config(dict(config, model_name="ViT-H-14"))
+    with pytest.raises(ValueError, match="checkpoint"):
+        check_tower_config(dict(config, checkpoint="laion2b_s32b_b79k"))
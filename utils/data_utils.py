@@ -1,11 +1,13 @@
 import os
+import json
 import datasets
 
 
 def get_file_names(dataset_folder: str):
     ids = []
     uris = []
-    for filename in os.listdir(dataset_folder):
+    # sorted so chunked ingestion walks the folder in a stable, resumable order
+    for filename in sorted(os.listdir(dataset_folder)):
         if filename.endswith(".png"):
             file_path = os.path.join(dataset_folder, filename)
             id = filename.split("/")[-1].rstrip(".png").split("_")[-1]
@@ -15,12 +17,12 @@ def get_file_names(dataset_folder: str):
 
 
 def get_metadata(dataset: datasets.DatasetDict | datasets.Dataset | datasets.IterableDataset | datasets.IterableDatasetDict,
-    num_images: int = 500):
+    num_images: int = None):
     columns = ["parent_asin", "title", "description", "main_category", "store", "average_rating", "rating_number", "price"] #, "details"] --> ignoring details for now
     metadata = {}
 
     for idx, i in enumerate(dataset):
-        if idx == num_images:
+        if num_images is not None and idx == num_images:
             break
         dict = {}
         for col in columns:
@@ -32,3 +34,63 @@ def get_metadata(dataset: datasets.DatasetDict | datasets.Dataset | datasets.Ite
         metadata[i['parent_asin']] = dict
 
     return metadata
+
+
+def iter_chunks(items: list, chunk_size: int, start: int = 0):
+    """Yield (offset, slice) pairs of at most chunk_size items, starting at start."""
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    for offset in range(start, len(items), chunk_size):
+        yield offset, items[offset:offset + chunk_size]
+
+
+def read_checkpoint(checkpoint_path: str) -> dict:
+    """Return the saved ingestion checkpoint, or an empty dict when there is none."""
+    if not checkpoint_path or not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path, "r") as f:
+        return json.load(f)
+
+
+def write_checkpoint(checkpoint_path: str, checkpoint: dict):
+    """Atomically replace the checkpoint file so a crash never leaves it half written."""
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    tmp_path = f"{checkpoint_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def open_done_log(log_path: str, header: dict, resume: bool = True) -> set:
+    """
+    Open an append-only log of finished ASINs for the run described by header (e.g. dataset
+    folder and total), for ingestion whose chunks finish out of order. Returns the ASINs already
+    logged under the same header when resume is True, else an empty set; the file is rewritten
+    as the header plus those ASINs, which also drops a line torn by a crash.
+    """
+    done = set()
+    if resume and log_path and os.path.exists(log_path):
+        with open(log_path, "r") as f:
+            lines = f.read().split("\n")
+        try:
+            same_run = json.loads(lines[0]) == header
+        except ValueError:
+            same_run = False
+        for line in lines[1:] if same_run else []:
+            try:
+                done.update(json.loads(line))
+            except ValueError:
+                # empty trailing line, or one cut short mid-write
+                continue
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+    tmp_path = f"{log_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(header) + "\n" + (json.dumps(sorted(done)) + "\n" if done else ""))
+    os.replace(tmp_path, log_path)
+    return done
+
+
+def append_done_log(log_path: str, ids: list):
+    """Record one finished chunk in a log opened with open_done_log."""
+    with open(log_path, "a") as f:
+        f.write(json.dumps(ids) + "\n")
@@ -1,18 +1,51 @@
+from __future__ import annotations
+
+import io
 import os
+import time
+import base64
+import mimetypes
+import threading
+import http.client
 import urllib
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import TYPE_CHECKING
+import numpy as np
 from PIL import Image
-import matplotlib.pyplot as plt
-import datasets
-from tqdm import trange
 
+# matplotlib, tqdm and datasets are imported where used: the serving path only needs PIL
+if TYPE_CHECKING:
+    import datasets
 
-def is_saved_images(
-        dataset_folder: str,
-        num_images: int
-    ):
-    if len(os.listdir(dataset_folder)) == num_images:
-        return True
-    return False
+
+# concurrent connections used by download_images
+DOWNLOAD_WORKERS = 16
+
+# HTTP statuses worth retrying (throttling and transient server errors)
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# per-thread keep-alive connections, keyed by (scheme, host)
+_thread_local = threading.local()
+
+# compact copies of the product images that are sent to the vision model
+DERIVATIVE_FOLDER = "./products_dataset/AMAZON-Products-2023-derivatives"
+DERIVATIVE_MAX_EDGE = 512
+DERIVATIVE_FORMAT = "JPEG"
+DERIVATIVE_QUALITY = 85
+
+# query images are downscaled so their short edge is this before embedding (CLIP's input side)
+QUERY_IMAGE_MIN_EDGE = 224
+
+# side of the difference hash: hash_size x hash_size bits (64 for the default)
+DHASH_SIZE = 8
+
+IMAGE_FORMATS = {
+    "JPEG": (".jpg", "image/jpeg"),
+    "WEBP": (".webp", "image/webp"),
+    "PNG": (".png", "image/png"),
+}
 
 
 def show_image_from_uri(uri: str):
@@ -27,6 +60,7 @@ def show_image_from_uri(uri: str):
 
 def show_image_from_path(path: str):
     if isinstance(path, str):
+        import matplotlib.pyplot as plt
         image = Image.open(path)
         plt.imshow(image)
         plt.axis("off")
@@ -42,6 +76,7 @@ def open_example_image(
     ):
     if not execute:
         return
+    import matplotlib.pyplot as plt
     print(data.num_rows)
     product_image = data["train"][idx]["image"]
     img = show_image_from_uri(uri = product_image)
@@ -50,22 +85,285 @@ def open_example_image(
     plt.show()
 
 
+def _get_connection(scheme: str, netloc: str, timeout: float) -> http.client.HTTPConnection:
+    connections = getattr(_thread_local, "connections", None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+    conn = connections.get((scheme, netloc))
+    if conn is None:
+        conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        conn = connections[(scheme, netloc)] = conn_cls(netloc, timeout = timeout)
+    return conn
+
+
+def _drop_connection(scheme: str, netloc: str):
+    conn = getattr(_thread_local, "connections", {}).pop((scheme, netloc), None)
+    if conn is not None:
+        conn.close()
+
+
+def fetch_bytes(
+        uri: str,
+        timeout: float = 30.0,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_redirects: int = 3
+    ) -> bytes:
+    """
+    GET uri over a reused keep-alive connection of the calling thread.
+    Connection errors and retryable statuses are retried with exponential backoff.
+    """
+    if not isinstance(uri, str):
+        raise ValueError(f"Not a valid image link! {uri}")
+
+    attempt, redirects = 0, 0
+    while True:
+        parsed = urllib.parse.urlsplit(uri)
+        target = parsed.path or "/"
+        if parsed.query:
+            target += f"?{parsed.query}"
+        try:
+            conn = _get_connection(parsed.scheme, parsed.netloc, timeout)
+            conn.request("GET", target, headers = {"Connection": "keep-alive"})
+            response = conn.getresponse()
+            body = response.read()
+            if response.status == 200:
+                return body
+            if response.status in (301, 302, 303, 307, 308) and redirects < max_redirects:
+                uri = urllib.parse.urljoin(uri, response.getheader("Location"))
+                redirects += 1
+                continue
+            if response.status not in RETRYABLE_STATUSES or attempt >= retries:
+                raise ValueError(f"HTTP {response.status} while fetching {uri}")
+        except (http.client.HTTPException, OSError):
+            # the server may have closed the keep-alive connection; reconnect on retry
+            _drop_connection(parsed.scheme, parsed.netloc)
+            if attempt >= retries:
+                raise
+        time.sleep(backoff * (2 ** attempt))
+        attempt += 1
+
+
+def save_image_atomic(data: bytes, path: str):
+    """Decode image bytes and write them as PNG via a temp file, so path is either complete or absent."""
+    tmp_path = f"{path}.part"
+    with Image.open(io.BytesIO(data)) as image:
+        image.save(tmp_path, format = "PNG")
+    os.replace(tmp_path, path)
+
+
+def download_images(
+        items: list,
+        workers: int = DOWNLOAD_WORKERS,
+        timeout: float = 30.0,
+        retries: int = 3,
+        backoff: float = 0.5
+    ) -> dict:
+    """
+    Download (uri, path) pairs concurrently with at most `workers` requests in flight.
+    Files that already exist are skipped, so an interrupted run resumes where it stopped.
+    Only the first item for a path is downloaded (the others count as skipped), so no two
+    downloads write the same temp file. Works with any http(s) server, including a local
+    http.server for testing.
+    """
+    from tqdm import tqdm
+    stats = {"downloaded": 0, "skipped": 0, "failed": 0}
+    todo = {}
+    for uri, path in items:
+        if path in todo or os.path.exists(path):
+            stats["skipped"] += 1
+        else:
+            todo[path] = uri
+
+    def download(uri, path):
+        save_image_atomic(fetch_bytes(uri, timeout = timeout, retries = retries, backoff = backoff), path)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {executor.submit(download, uri, path): uri for path, uri in todo.items()}
+        for future in tqdm(as_completed(futures), total = len(futures), desc = "Saving images"):
+            try:
+                future.result()
+                stats["downloaded"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Failed to download {futures[future]}: {e}")
+    return stats
+
+
 def save_all_images(
         dataset: datasets.DatasetDict | datasets.Dataset | datasets.IterableDataset | datasets.IterableDatasetDict, 
         dataset_folder: str,
-        num_images: int = 1000
+        num_images: int = 1000,
+        workers: int = DOWNLOAD_WORKERS
     ):
     # check if dataset_folder exists else make dir
     os.makedirs(dataset_folder, exist_ok = True)
 
-    # check if num_images already saved in dataset_folder:
-    if is_saved_images(dataset_folder, num_images):
-        print(f"{dataset_folder} dir already contains first {num_images} images")
-        return
+    # read both columns once instead of indexing a row per field
+    rows = dataset["train"].select_columns(["image", "parent_asin"])[:num_images]
+    items = [
+        (uri, os.path.join(dataset_folder, f"image_{prod_id}.png"))
+        for uri, prod_id in zip(rows["image"], rows["parent_asin"])
+    ]
+
+    stats = download_images(items, workers = workers)
+    print(f"Saved first {num_images} to folder: {dataset_folder} "
+          f"({stats['downloaded']} downloaded, {stats['skipped']} already present, {stats['failed']} failed)")
+
+
+def get_derivative_path(
+        image_path: str,
+        derivative_folder: str = DERIVATIVE_FOLDER,
+        image_format: str = DERIVATIVE_FORMAT
+    ) -> str:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(derivative_folder, stem + IMAGE_FORMATS[image_format][0])
+
+
+def make_image_derivative(
+        image_path: str,
+        derivative_folder: str = DERIVATIVE_FOLDER,
+        max_edge: int = DERIVATIVE_MAX_EDGE,
+        image_format: str = DERIVATIVE_FORMAT,
+        quality: int = DERIVATIVE_QUALITY
+    ) -> str:
+    """Write a copy of image_path downscaled to max_edge pixels on its longest side; skipped if up to date."""
+    out_path = get_derivative_path(image_path, derivative_folder, image_format)
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(image_path):
+        return out_path
+
+    with Image.open(image_path) as image:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if image_format == "JPEG" and image.mode != "RGB":
+            # JPEG has no alpha channel: flatten transparent product shots onto white
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask = rgba.split()[-1])
+        tmp_path = f"{out_path}.part"
+        image.save(tmp_path, format = image_format, quality = quality, optimize = True)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def make_image_derivatives(
+        uris: list,
+        derivative_folder: str = DERIVATIVE_FOLDER,
+        max_edge: int = DERIVATIVE_MAX_EDGE,
+        image_format: str = DERIVATIVE_FORMAT,
+        workers: int = os.cpu_count() or 1
+    ) -> dict:
+    """Produce derivatives for all uris in parallel and report the total size reduction."""
+    from tqdm import tqdm
+    os.makedirs(derivative_folder, exist_ok = True)
+    stats = {"images": 0, "failed": 0, "original_bytes": 0, "derivative_bytes": 0}
+
+    def derive(uri):
+        return uri, make_image_derivative(uri, derivative_folder, max_edge, image_format)
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = [executor.submit(derive, uri) for uri in uris]
+        for future in tqdm(as_completed(futures), total = len(futures), desc = "Creating image derivatives"):
+            try:
+                uri, out_path = future.result()
+            except Exception as e:
+                stats["failed"] += 1
+                print(f"Failed to create derivative: {e}")
+                continue
+            stats["images"] += 1
+            stats["original_bytes"] += os.path.getsize(uri)
+            stats["derivative_bytes"] += os.path.getsize(out_path)
+
+    print(f"Created {stats['images']} derivatives in {derivative_folder}: "
+          f"{stats['original_bytes'] / 1e6:.1f} MB -> {stats['derivative_bytes'] / 1e6:.1f} MB")
+    return stats
+
+
+def load_image_chunk(uris: list):
+    """Decode a chunk of images like Chroma's ImageLoader, skipping files that fail to open."""
+    positions, images = [], []
+    for pos, uri in enumerate(uris):
+        try:
+            with Image.open(uri) as image:
+                images.append(np.array(image))
+            positions.append(pos)
+        except Exception as e:
+            print(f"Skipping unreadable image {uri}: {e}")
+    return positions, images
+
+
+def prepare_query_image(image, min_edge: int = QUERY_IMAGE_MIN_EDGE):
+    """
+    Decode an uploaded query image (encoded bytes, PIL image or array) into an RGB array whose
+    short edge is at most min_edge. CLIP resizes to that size anyway, so downscaling first only
+    saves work; JPEGs are decoded directly at a reduced scale where possible.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+        image.draft("RGB", (min_edge, min_edge))
+    elif not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    if image.mode != "RGB":
+        # flatten transparent product shots onto white, as for the derivatives
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask = rgba.split()[-1])
+    scale = min_edge / min(image.size)
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BICUBIC)
+    return np.asarray(image)
+
+
+def dhash(image, hash_size: int = DHASH_SIZE) -> int:
+    """
+    Difference hash of an image (file path, encoded bytes, PIL image or array) as an integer of
+    hash_size * hash_size bits. The image is reduced to hash_size + 1 by hash_size grey pixels
+    and each bit records whether a pixel is brighter than its right neighbour, so re-encoded,
+    resized or recoloured copies of a photo differ in only a few bits.
+    """
+    if isinstance(image, (str, bytes, bytearray, memoryview)):
+        # closed once hashed: a scan over the whole catalog would otherwise hold one file per image
+        with Image.open(image if isinstance(image, str) else io.BytesIO(image)) as opened:
+            # JPEGs decode straight to a small greyscale image
+            opened.draft("L", (4 * hash_size, 4 * hash_size))
+            return dhash(opened, hash_size)
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    if image.mode in ("RGBA", "LA", "P"):
+        # transparent areas count as white, as for the derivatives
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask = rgba.split()[-1])
+    pixels = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+@lru_cache(maxsize = 1024)
+def _encode_image_file(path: str, mtime: float):
+    with open(path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
 
-    for i in trange(num_images, desc="Saving images"):
-        uri = dataset["train"][i]["image"]
-        prod_id = dataset["train"][i]["parent_asin"]
-        image = show_image_from_uri(uri)
-        image.save(os.path.join(dataset_folder, f"image_{prod_id}.png"))
-    print(f"Saved first {num_images} to folder: {dataset_folder}") 
+def get_image_payload(image_path: str, derivative_folder: str = DERIVATIVE_FOLDER):
+    """
+    Return (mime_type, base64_data, original_size) for the image to send in a prompt.
+    The derivative is used when one exists, otherwise the original file. A derivative older
+    than the original (the product image was replaced) is regenerated first, and the original
+    is sent if that fails. Encoded payloads are memoized per (path, mtime).
+    """
+    path = image_path
+    if derivative_folder:
+        for image_format in IMAGE_FORMATS:
+            candidate = get_derivative_path(image_path, derivative_folder, image_format)
+            if not os.path.exists(candidate):
+                continue
+            if os.path.getmtime(candidate) < os.path.getmtime(image_path):
+                try:
+                    candidate = make_image_derivative(image_path, derivative_folder, image_format = image_format)
+                except Exception as e:
+                    print(f"Sending the original of {image_path}: its derivative is stale and could not be rebuilt: {e}")
+                    break
+            path = candidate
+            break
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return mime_type, _encode_image_file(path, os.path.getmtime(path)), os.path.getsize(image_path)
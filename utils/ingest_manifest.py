@@ -0,0 +1,102 @@
+import os
+import json
+import sqlite3
+import hashlib
+from typing import Dict, List, Optional
+
+
+# per-product content hashes of what is currently in the vector db
+MANIFEST_PATH = "./data/ingestion_manifest.sqlite"
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hash_record(record: dict) -> str:
+    """Hash of a normalized product record, independent of key order."""
+    return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IngestionManifest:
+    """
+    SQLite table of what was last written to the vector db for each parent_asin: the image
+    uri, its size and mtime, and content hashes of the image bytes and the metadata record.
+
+    The size/mtime pair lets diff() reuse the stored image hash for files that were not touched,
+    so a refresh only reads the bytes of images that actually changed on disk.
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifest "
+                "(parent_asin TEXT PRIMARY KEY, uri TEXT, size INTEGER, mtime_ns INTEGER, "
+                "image_hash TEXT, metadata_hash TEXT) WITHOUT ROWID"
+            )
+
+    def entries(self) -> Dict[str, dict]:
+        columns = ["uri", "size", "mtime_ns", "image_hash", "metadata_hash"]
+        return {
+            row[0]: dict(zip(columns, row[1:]))
+            for row in self._conn.execute(f"SELECT parent_asin, {', '.join(columns)} FROM manifest")
+        }
+
+    def diff(self, ids: List[str], uris: List[str], records: List[Optional[dict]]) -> dict:
+        """
+        Compare the current catalog (image files plus metadata records, None where missing)
+        against the manifest. Returns the products to embed (new or changed image), those
+        whose metadata alone changed, the ASINs to delete, the count left untouched, and the
+        fresh manifest entry of every product to write.
+        """
+        previous = self.entries()
+        plan = {"embed": [], "update_metadata": [], "delete": [], "unchanged": 0, "entries": {}}
+        current = set()
+
+        for asin, uri, record in zip(ids, uris, records):
+            if record is None:
+                continue
+            current.add(asin)
+            stat = os.stat(uri)
+            old = previous.get(asin)
+            if old is not None and (old["uri"], old["size"], old["mtime_ns"]) == (uri, stat.st_size, stat.st_mtime_ns):
+                image_hash = old["image_hash"]
+            else:
+                image_hash = hash_file(uri)
+            entry = {"uri": uri, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                     "image_hash": image_hash, "metadata_hash": hash_record(record)}
+            plan["entries"][asin] = entry
+
+            if old is None or old["image_hash"] != image_hash or old["uri"] != uri:
+                plan["embed"].append(asin)
+            elif old["metadata_hash"] != entry["metadata_hash"]:
+                plan["update_metadata"].append(asin)
+            else:
+                plan["unchanged"] += 1
+
+        plan["delete"] = sorted(set(previous) - current)
+        return plan
+
+    def update(self, entries: Dict[str, dict]):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?, ?)",
+                [(asin, e["uri"], e["size"], e["mtime_ns"], e["image_hash"], e["metadata_hash"]) for asin, e in entries.items()],
+            )
+
+    def remove(self, asins: List[str]):
+        with self._conn:
+            self._conn.executemany("DELETE FROM manifest WHERE parent_asin = ?", [(asin,) for asin in asins])
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM manifest").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
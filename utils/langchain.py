@@ -1,10 +1,18 @@
 from multiprocessing import Value
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-import base64
+from typing import Any, Callable, Iterator, AsyncIterator, List, Optional
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+import asyncio
+import random
+import time
 
 from dotenv import load_dotenv
 
+from utils.image_utils import get_image_payload, DERIVATIVE_FOLDER
+from utils.metrics import increment, span, traced
+
 load_dotenv()
 
 VISION_MODELS = [
@@ -26,38 +34,140 @@ VISION_MODELS = [
     "computer-use-preview"
 ]
 
+# bump whenever get_image_prompt_template changes, so cached responses are not reused
+PROMPT_TEMPLATE_VERSION = "3"
+
+# per-request budget for the packed product context
+PROMPT_MAX_BYTES = 1_000_000
+PROMPT_MAX_TOKENS = 6000
+DESCRIPTION_MAX_CHARS = 1500
+
+# estimated vision tokens per image by detail level (OpenAI: 85 base + 170 per 512px tile)
+IMAGE_TOKENS = {"high": 765, "low": 85}
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text
+    return len(text) // 4 + 1
+
+
+def _product_details(rank: int, metadata: dict, description: str) -> str:
+    return (f"**Product {rank} Details**\n"
+            f"- **Title**: {metadata.get('title', '')}\n"
+            f"- **Description**: {description}\n"
+            f"- **Price**: {metadata.get('price', '')}")
+
+
+@traced("prompt.build")
+def format_prompt_inputs(
+        data, 
+        user_query, 
+        derivative_folder = DERIVATIVE_FOLDER,
+        max_products = None,
+        max_bytes = PROMPT_MAX_BYTES,
+        max_tokens = PROMPT_MAX_TOKENS,
+        max_description_chars = DESCRIPTION_MAX_CHARS
+    ):
+    """
+    Pack the retrieved products of the first query, in rank order, into one user message.
 
-def format_prompt_inputs(data, user_query):
+    Products are added while the message stays under max_bytes (text plus base64 images) and
+    an estimated max_tokens. Descriptions are truncated to max_description_chars, and further
+    when the budget runs low; images fall back from high to low detail, then are dropped.
+    Packing stops at the first product whose title and price no longer fit.
+    """
     print("Formatting prompt inputs...")
-    inputs = {}
+    uris = data["uris"][0] if data.get("uris") else []
+    metadatas = data["metadatas"][0] if data.get("metadatas") else []
+    if max_products is not None:
+        metadatas = metadatas[:max_products]
+
+    content = [{"type": "text", "text": user_query}]
+    used_bytes = len(user_query.encode("utf-8"))
+    used_tokens = _estimate_tokens(user_query)
+    stats = {"products": 0, "retrieved": len(metadatas), "truncated": 0,
+             "images_high": 0, "images_low": 0, "images_dropped": 0, "bytes_saved": 0}
+
+    if not metadatas:
+        content.append({"type": "text", "text": "No matching products were found in the catalog."})
 
-    # add user query to dict
-    inputs["user_query"] = user_query
+    for rank, metadata in enumerate(metadatas, start = 1):
+        image_url, image_saved = None, 0
+        if rank <= len(uris):
+            with span("prompt.image_read"):
+                mime_type, image_data, original_size = get_image_payload(uris[rank - 1], derivative_folder)
+            image_url = f"data:{mime_type};base64,{image_data}"
+            # base64 size of the full-resolution file versus the derivative actually sent
+            image_saved = 4 * ((original_size + 2) // 3) - len(image_data)
 
-    # get first two image paths
-    image_path_1 = data["uris"][0][0]
-    image_path_2 = data["uris"][0][1]
+        # keep room for at least a low-detail image, unless the image alone busts the byte budget
+        reserve_bytes, reserve_tokens = 0, 0
+        if image_url is not None and used_bytes + len(image_url) <= max_bytes:
+            reserve_bytes, reserve_tokens = len(image_url), IMAGE_TOKENS["low"]
 
-    # encode images to base64
-    with open(image_path_1, "rb") as image_file:
-        image_data_1 = image_file.read()
-    inputs["image_data_1"] = base64.b64encode(image_data_1).decode("utf-8")
+        def overflow(details):
+            return max(len(details.encode("utf-8")) - (max_bytes - used_bytes - reserve_bytes),
+                       4 * (_estimate_tokens(details) - (max_tokens - used_tokens - reserve_tokens)))
 
-    with open(image_path_2, "rb") as image_file:
-        image_data_2 = image_file.read()
-    inputs["image_data_2"] = base64.b64encode(image_data_2).decode("utf-8")
+        description = metadata.get("description", "") or ""
+        truncated = len(description) > max_description_chars
+        if truncated:
+            description = description[:max_description_chars].rstrip() + "..."
+        details = _product_details(rank, metadata, description)
+        if overflow(details) > 0:
+            # shrink the description to what is left; stop once even title and price don't fit
+            keep = len(description) - overflow(details) - len("...") - 4
+            description = description[:keep].rstrip() + "..." if keep > 0 else ""
+            details = _product_details(rank, metadata, description)
+            truncated = True
+            if overflow(details) > 0:
+                break
+        content.append({"type": "text", "text": details})
+        used_bytes += len(details.encode("utf-8"))
+        used_tokens += _estimate_tokens(details)
+        stats["products"] += 1
+        stats["truncated"] += truncated
 
+        if image_url is None:
+            continue
+        for detail in ("high", "low"):
+            if used_bytes + len(image_url) <= max_bytes and used_tokens + IMAGE_TOKENS[detail] <= max_tokens:
+                content.append({"type": "image_url", "image_url": {"url": image_url, "detail": detail}})
+                used_bytes += len(image_url)
+                used_tokens += IMAGE_TOKENS[detail]
+                stats[f"images_{detail}"] += 1
+                stats["bytes_saved"] += image_saved
+                break
+        else:
+            stats["images_dropped"] += 1
 
-    inputs["title_1"] = data["metadatas"][0][0]["title"]
-    inputs["description_1"] = data["metadatas"][0][0]["description"]
-    inputs["price_1"] = data["metadatas"][0][0]["price"]
+    stats["bytes"] = used_bytes
+    stats["tokens"] = used_tokens
+    print(f"Packed {stats['products']}/{stats['retrieved']} products into {used_bytes} bytes, ~{used_tokens} tokens "
+          f"(images: {stats['images_high']} high, {stats['images_low']} low, {stats['images_dropped']} dropped; "
+          f"{stats['bytes_saved']} bytes saved by derivatives)")
 
-    inputs["title_2"] = data["metadatas"][0][1]["title"]
-    inputs["description_2"] = data["metadatas"][0][1]["description"]
-    inputs["price_2"] = data["metadatas"][0][1]["price"]
+    increment("prompt.requests")
+    increment("prompt.payload_bytes", used_bytes)
+    increment("prompt.bytes_saved", stats["bytes_saved"])
 
     print("Prompt inputs formatted successfully...")
-    return inputs
+    return {
+        "user_query": user_query,
+        "product_context": [HumanMessage(content = content)],
+        "packing_stats": stats,
+    }
+
+
+async def aformat_prompt_inputs(data, user_query, derivative_folder = DERIVATIVE_FOLDER):
+    """Async counterpart of format_prompt_inputs; file reads and encoding run in a worker thread."""
+    return await asyncio.to_thread(format_prompt_inputs, data, user_query, derivative_folder)
+
+
+async def agenerate_answer(chain, prompt_input, timeout: float = 60.0):
+    """Run the vision chain with its native async invocation, giving up after timeout seconds."""
+    with span("generation.llm"):
+        return await asyncio.wait_for(chain.ainvoke(prompt_input), timeout = timeout)
 
 
 def get_vision_model(model_name = 'gpt-4o', temperature = 0.0, **kwargs):
@@ -68,7 +178,9 @@ def get_vision_model(model_name = 'gpt-4o', temperature = 0.0, **kwargs):
     
     if model_name not in VISION_MODELS:
         raise ValueError("Wrong OpenAI vision model name. Choose the right one!")
-    
+
+    # imported here: langchain_openai takes longer to import than the rest of the serving path
+    from langchain_openai import ChatOpenAI
     vision_model = ChatOpenAI(
         model = model_name,
         temperature = temperature,
@@ -78,6 +190,72 @@ def get_vision_model(model_name = 'gpt-4o', temperature = 0.0, **kwargs):
     return vision_model
 
 
+class StubVisionModel(BaseChatModel):
+    """
+    Offline stand-in for ChatOpenAI in tests and benchmarks. Waits `latency` seconds
+    (or whatever `latency_sampler` returns) before the first token, then emits the
+    response word by word with `token_delay` seconds between words. A `failure_rate`
+    share of calls raises after the first-token wait, like a rate-limited or failed API call.
+    """
+
+    response: str = "This is a stub answer about the retrieved products."
+    latency: float = 0.0
+    latency_sampler: Optional[Callable[[], float]] = None
+    token_delay: float = 0.0
+    failure_rate: float = 0.0
+    model_name: str = "stub"
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub-vision-model"
+
+    def _first_token_latency(self) -> float:
+        return self.latency_sampler() if self.latency_sampler else self.latency
+
+    def _maybe_fail(self):
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("Stub vision model failure (simulated API error)")
+
+    def _tokens(self) -> List[str]:
+        words = self.response.split(" ")
+        return [w if i == 0 else f" {w}" for i, w in enumerate(words)]
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._first_token_latency())
+        self._maybe_fail()
+        time.sleep(self.token_delay * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._first_token_latency())
+        self._maybe_fail()
+        await asyncio.sleep(self.token_delay * len(self._tokens()))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    def _stream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self._first_token_latency())
+        self._maybe_fail()
+        for i, token in enumerate(self._tokens()):
+            if i:
+                time.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._first_token_latency())
+        self._maybe_fail()
+        for i, token in enumerate(self._tokens()):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def get_stub_vision_model(**kwargs):
+    """
+    Return a StubVisionModel usable wherever get_vision_model's ChatOpenAI is, without network access.
+    """
+    return StubVisionModel(**kwargs)
+
+
 def get_image_prompt_template(system_prompt=None, assistant_prompt=None):
 
     image_prompt = ChatPromptTemplate.from_messages(
@@ -97,24 +275,8 @@ def get_image_prompt_template(system_prompt=None, assistant_prompt=None):
                     "Maintain a more conversational tone, don't make too many lists or bullet points. Use markdown formatting for highlights, emphasis, and structure."
                 )
             ),
-            (
-                "user",
-                [
-                    {"type": "text", "text": "{user_query}"},
-                    
-                    {"type": "text", "text": "**Product 1 Details**\n"
-                                            "- **Title**: {title_1}\n"
-                                            "- **Description**: {description_1}\n"
-                                            "- **Price**: {price_1}"},
-                    {"type": "image_url", "image_url": "data:image/jpeg;base64,{image_data_1}"},
-
-                    {"type": "text", "text": "**Product 2 Details**\n"
-                                            "- **Title**: {title_2}\n"
-                                            "- **Description**: {description_2}\n"
-                                            "- **Price**: {price_2}"},
-                    {"type": "image_url", "image_url": "data:image/jpeg;base64,{image_data_2}"},
-                ],
-            ),
+            # product details and images packed by format_prompt_inputs
+            MessagesPlaceholder("product_context"),
         ]
     )
 
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import os
+import json
+import sqlite3
+import threading
+from typing import TYPE_CHECKING, List, Optional
+
+if TYPE_CHECKING:
+    # only for annotations: serving opens the store without importing datasets
+    import datasets
+
+
+# full product records keyed by parent_asin
+METADATA_PATH = "./data/products_metadata.sqlite"
+
+METADATA_COLUMNS = ["parent_asin", "title", "description", "main_category", "store", "average_rating", "rating_number", "price"]
+
+# small, filterable fields copied into Chroma metadata; everything else is read from the store
+CHROMA_METADATA_FIELDS = ["parent_asin", "title", "main_category", "store", "average_rating", "rating_number", "price"]
+
+# SQLite caps the number of bound parameters per statement
+_MAX_VARIABLES = 900
+
+
+class MetadataStore:
+    """
+    Persistent product metadata keyed by parent_asin, backed by a SQLite table with the
+    ASIN as primary key. Built once during ingestion, then used for point and batch lookups
+    by ingestion and serving.
+    """
+
+    def __init__(self, path: str = METADATA_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Streamlit serves sessions from several threads; share one connection behind a lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS products (parent_asin TEXT PRIMARY KEY, record TEXT NOT NULL) WITHOUT ROWID"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT)")
+
+    def build(self, dataset: datasets.Dataset, batch_size: int = 10000):
+        """(Re)load all rows of a preprocessed dataset, recording its fingerprint."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM products")
+            for batch in dataset.select_columns(METADATA_COLUMNS).iter(batch_size=batch_size):
+                rows = [dict(zip(METADATA_COLUMNS, values)) for values in zip(*(batch[col] for col in METADATA_COLUMNS))]
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO products VALUES (?, ?)",
+                    [(row["parent_asin"], json.dumps(row)) for row in rows],
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO store_info VALUES ('fingerprint', ?)",
+                (getattr(dataset, "_fingerprint", None),),
+            )
+        print(f"Metadata store at {self.path} holds {len(self)} products")
+
+    def is_built_from(self, dataset: datasets.Dataset) -> bool:
+        fingerprint = getattr(dataset, "_fingerprint", None)
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM store_info WHERE key = 'fingerprint'").fetchone()
+        return fingerprint is not None and row is not None and row[0] == fingerprint
+
+    def get(self, asin: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM products WHERE parent_asin = ?", (asin,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, asins: List[str]) -> List[Optional[dict]]:
+        """Records for asins in the same order; None where an ASIN is unknown."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(asins), _MAX_VARIABLES):
+                chunk = asins[start:start + _MAX_VARIABLES]
+                placeholders = ",".join("?" * len(chunk))
+                for asin, record in self._conn.execute(
+                    f"SELECT parent_asin, record FROM products WHERE parent_asin IN ({placeholders})", chunk
+                ):
+                    found[asin] = json.loads(record)
+        return [found.get(asin) for asin in asins]
+
+    def distinct_values(self, field: str) -> List:
+        """Sorted distinct non-empty values of a field, e.g. the catalog's categories."""
+        if field not in METADATA_COLUMNS:
+            raise ValueError(f"Unknown metadata field {field!r}")
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT json_extract(record, ?) FROM products", (f"$.{field}",)
+            ).fetchall()
+        return sorted(value for (value,) in rows if value not in (None, ""))
+
+    def __contains__(self, asin: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM products WHERE parent_asin = ?", (asin,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def to_chroma_metadata(record: dict) -> dict:
+    """Slim a full product record down to the fields stored in Chroma."""
+    return {field: record[field] for field in CHROMA_METADATA_FIELDS if field in record}
+
+
+def get_or_build_metadata_store(dataset: datasets.Dataset, path: str = METADATA_PATH) -> MetadataStore:
+    """Open the store at path, rebuilding it only when dataset differs from the one it was built from."""
+    store = MetadataStore(path)
+    if not store.is_built_from(dataset):
+        store.build(dataset)
+    return store
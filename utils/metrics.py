@@ -0,0 +1,184 @@
+import os
+import time
+import math
+import json
+import threading
+import functools
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable
+
+
+def percentiles(values: Iterable[float], points: Iterable[float] = (50, 95, 99)) -> Dict[str, float]:
+    """Nearest-rank percentiles of values, keyed like {"p50": ..., "p95": ..., "p99": ...}."""
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{p:g}": 0.0 for p in points}
+    return {f"p{p:g}": ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] for p in points}
+
+
+class StageTimer:
+    """Accumulate wall time and row counts per pipeline stage and report rows/sec."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.rows = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.rows[name] += rows
+
+    def record(self, name: str, seconds: float, rows: int = 0):
+        self.seconds[name] += seconds
+        self.rows[name] += rows
+
+    def format_ms(self) -> str:
+        """One-line summary of stage latencies, e.g. for request logs."""
+        return " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.seconds.items())
+
+    def report(self) -> dict:
+        report = {}
+        for name, seconds in self.seconds.items():
+            rows = self.rows[name]
+            report[name] = {
+                "rows": rows,
+                "seconds": round(seconds, 4),
+                "rows_per_sec": round(rows / seconds, 2) if seconds > 0 else 0.0,
+            }
+        return report
+
+    def print_report(self, title: str = "Stage timings"):
+        print(f"{title}:")
+        for name, stats in self.report().items():
+            print(f"  {name:<10} {stats['rows']:>9} rows  {stats['seconds']:>9.2f}s  {stats['rows_per_sec']:>10.2f} rows/sec")
+
+
+# Process-wide tracing and metrics for the serving path. Off unless RAG_METRICS=1 is set or
+# enable_metrics() is called; when off, span() returns a shared no-op context manager and
+# increment() returns immediately, so instrumented code pays almost nothing.
+_enabled = os.environ.get("RAG_METRICS", "0").lower() not in ("", "0", "false", "no")
+_NOOP_SPAN = nullcontext()
+
+
+class MetricsRegistry:
+    """Thread-safe counters plus duration summaries (count, sum, recent-sample percentiles) per span."""
+
+    def __init__(self, max_samples: int = 2048):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(float)
+            self.span_counts = defaultdict(int)
+            self.span_sums = defaultdict(float)
+            self.span_samples = defaultdict(lambda: deque(maxlen=self.max_samples))
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.span_counts[name] += 1
+            self.span_sums[name] += seconds
+            self.span_samples[name].append(seconds)
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            spans = {
+                name: {
+                    "count": self.span_counts[name],
+                    "sum_seconds": round(self.span_sums[name], 6),
+                    **{k: round(v, 6) for k, v in percentiles(self.span_samples[name]).items()},
+                }
+                for name in sorted(self.span_counts)
+            }
+            counters = {name: self.counters[name] for name in sorted(self.counters)}
+        return {"spans": spans, "counters": counters}
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        snapshot = self.snapshot()
+        lines = [f"# TYPE {prefix}_span_seconds summary"]
+        for name, stats in snapshot["spans"].items():
+            for key, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{quantile}"}} {stats[key]}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {stats["sum_seconds"]}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {stats["count"]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in snapshot["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def enable_metrics(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def metrics_enabled() -> bool:
+    return _enabled
+
+
+@contextmanager
+def _timed_span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        REGISTRY.increment(f"{name}.errors")
+        raise
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - start)
+
+
+def span(name: str):
+    """Time the enclosed block as span `name` (errors are counted as `name`.errors)."""
+    if not _enabled:
+        return _NOOP_SPAN
+    return _timed_span(name)
+
+
+def traced(name: str):
+    """Decorator form of span() for whole functions."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _timed_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe(name: str, seconds: float):
+    """Record an externally measured duration under span `name`."""
+    if _enabled:
+        REGISTRY.observe(name, seconds)
+
+
+def increment(name: str, value: float = 1):
+    if _enabled:
+        REGISTRY.increment(name, value)
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition of all spans and counters."""
+    return REGISTRY.to_prometheus()
+
+
+def log_metrics_json(path: str):
+    """Append a timestamped snapshot of all spans and counters to a JSON-lines log."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps({"timestamp": time.time(), **REGISTRY.snapshot()}) + "\n")
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+from utils.metrics import increment
+from utils.text_preprocess import normalize_query
+
+
+# disk-backed cache of vision chain answers
+RESPONSE_CACHE_PATH = "./data/response_cache.sqlite"
+
+
+def context_key(product_ids: List[str], model_name: str, prompt_version: str) -> str:
+    """Everything besides the query that determines an answer: what was shown to which model, and how."""
+    payload = json.dumps({"ids": list(product_ids), "model": model_name, "prompt": prompt_version})
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM answers keyed on (retrieved product ids, model name, prompt template
+    version, query). A query that misses exactly can still hit an entry for the same context whose
+    query embedding has cosine similarity >= similarity_threshold. Entries expire after ttl_seconds
+    and the least recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(
+        self,
+        path: str = RESPONSE_CACHE_PATH,
+        ttl_seconds: float = 24 * 3600,
+        max_entries: int = 5000,
+        similarity_threshold: float = 0.95,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "id INTEGER PRIMARY KEY, context_key TEXT NOT NULL, query TEXT NOT NULL, embedding BLOB, "
+                "response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL, "
+                "UNIQUE (context_key, query))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_access ON responses (last_access)")
+
+    def get(
+        self,
+        product_ids: List[str],
+        model_name: str,
+        prompt_version: str,
+        query: str,
+        query_embedding: Optional[np.ndarray] = None,
+    ) -> Optional[str]:
+        key = context_key(product_ids, model_name, prompt_version)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            row = self._conn.execute(
+                "SELECT id, response FROM responses WHERE context_key = ? AND query = ?", (key, normalize_query(query))
+            ).fetchone()
+            if row is not None:
+                self.exact_hits += 1
+                increment("response_cache.exact_hits")
+            elif query_embedding is not None:
+                row = self._most_similar(key, query_embedding)
+                if row is not None:
+                    self.semantic_hits += 1
+                    increment("response_cache.semantic_hits")
+            if row is None:
+                self.misses += 1
+                increment("response_cache.misses")
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE id = ?", (now, row[0]))
+        return row[1]
+
+    def _most_similar(self, key: str, query_embedding: np.ndarray):
+        rows = self._conn.execute(
+            "SELECT id, response, embedding FROM responses WHERE context_key = ? AND embedding IS NOT NULL", (key,)
+        ).fetchall()
+        if not rows:
+            return None
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        matrix = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+        similarities = matrix @ query_embedding / (
+            np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_embedding) + 1e-12
+        )
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        return rows[best][:2]
+
+    def put(
+        self,
+        product_ids: List[str],
+        model_name: str,
+        prompt_version: str,
+        query: str,
+        response: str,
+        query_embedding: Optional[np.ndarray] = None,
+    ):
+        key = context_key(product_ids, model_name, prompt_version)
+        embedding = None if query_embedding is None else np.asarray(query_embedding, dtype=np.float32).tobytes()
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (context_key, query, embedding, response, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, normalize_query(query), embedding, response, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE id IN "
+                "(SELECT id FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
@@ -1,9 +1,26 @@
+from __future__ import annotations
+
+import os
 import re
 import json
+import shutil
 import unicodedata
-from datasets import Dataset
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from utils.homoglyphs import _TRANSLATION_TABLE, unidecode
+
+if TYPE_CHECKING:
+    # datasets is only imported by the dataset-level functions, so serving code can use the
+    # string helpers (normalize_query) without it
+    from datasets import Dataset
+
+
+# bump whenever the output of preprocess_dataset changes, so cached outputs are rebuilt
+PREPROCESS_VERSION = "1"
 
-from utils.homoglyphs import normalize_homoglyphs
+# on-disk Arrow cache of preprocessed datasets, keyed by input fingerprint and PREPROCESS_VERSION
+PREPROCESS_CACHE_DIR = "./data/preprocessed"
 
 
 def normalize_to_ascii(text: str) -> str:
@@ -18,17 +35,63 @@ def normalize_to_ascii(text: str) -> str:
     return text
 
 
+# Compiled patterns for normalize_text. The steps reproduce
+# normalize_text(normalize_homoglyphs(text)) of the original implementation exactly:
+# whitespace collapsing before the punctuation fix is subsumed by the final collapse, and
+# "replace unknown chars with spaces" + "collapse whitespace" become one translate + split.
+# On ASCII, str.split() and the regex \s agree on what counts as whitespace.
+_NON_ASCII = re.compile(r"[^\x00-\x7F]+")
+_SPACE_BEFORE_PUNCT = re.compile(r"\s+(?=[.,;:!?%])")
+_VOL_TYPO = re.compile(r"(?<=\b[Vv]o)I(?=\.)")
+_INCHES = re.compile(r'(?<=\d)"')
+_UNKNOWN_TO_SPACE = bytes(
+    c if re.match(r"[\w\s.,!?;:()\"'-]", chr(c)) else ord(" ") for c in range(256)
+)
+
+# strings up to this length (store names, categories, ...) go through the LRU memo
+NORMALIZE_MEMO_MAX_LEN = 64
+NORMALIZE_MEMO_SIZE = 8192
+
+
+def _normalize_ascii(text: str) -> str:
+    text = _SPACE_BEFORE_PUNCT.sub("", text)
+    if "oI." in text:
+        text = _VOL_TYPO.sub("l", text)  # "VoI." -> "Vol."
+    text = text.upper().encode("ascii").translate(_UNKNOWN_TO_SPACE).decode("ascii")
+    text = " ".join(text.split())  # remove unknown special chars
+    if '"' in text:
+        text = _INCHES.sub(" inch", text)  # 15" → 15 inch
+    return text
+
+
+def _normalize_text_uncached(text: str) -> str:
+    if not text.isascii():
+        # homoglyph folding; every step below is the identity on pure-ASCII input
+        text = unicodedata.normalize("NFKC", text).translate(_TRANSLATION_TABLE)
+        if unidecode is not None:
+            try:
+                text = unidecode(text)
+            except Exception:
+                pass
+        text = _NON_ASCII.sub("", text)
+    return _normalize_ascii(text)
+
+
+_normalize_text_cached = lru_cache(maxsize=NORMALIZE_MEMO_SIZE)(_normalize_text_uncached)
+
+
 def normalize_text(text: str) -> str:
     """Normalize unicode, remove weird spaces/newlines, and standardize quotes."""
     if not isinstance(text, str):
         return ""
-    text = normalize_homoglyphs(text=text)
-    text = unicodedata.normalize("NFKC", text)  # normalize font variations
-    text = text.replace("\n", " ")
-    text = re.sub(r"[^\w\s.,!?;:()\"'-]", " ", text)  # remove unknown special chars
-    text = re.sub(r"\s+", " ", text).strip()
-    text = re.sub(r'(\d+)"', r"\1 inch", text)  # 15" → 15 inch
-    return text
+    if len(text) <= NORMALIZE_MEMO_MAX_LEN:
+        return _normalize_text_cached(text)
+    return _normalize_text_uncached(text)
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a query. CLIP's tokenizer lowercases and collapses whitespace anyway."""
+    return " ".join(query.lower().split())
 
 
 def clean_parent_asin(asin: str) -> str:
@@ -79,8 +142,10 @@ def parse_details(details_str: str):
     return flat_details
 
 
-def preprocess_dataset(dataset: Dataset):
-    """Main preprocessing pipeline for HuggingFace Dataset. Guarantees no None."""
+def preprocess_dataset_rowwise(dataset: Dataset):
+    """Row-at-a-time reference implementation of preprocess_dataset, kept for benchmarks."""
+    from datasets import Dataset
+
     processed = []
 
     for row in dataset:
@@ -110,3 +175,76 @@ def preprocess_dataset(dataset: Dataset):
         processed.append(processed_row)
 
     return Dataset.from_list(processed)
+
+
+def _preprocess_batch(batch: dict) -> dict:
+    """Column-batch version of the per-row cleaning in preprocess_dataset_rowwise."""
+    num_rows = len(next(iter(batch.values())))
+
+    def column(name):
+        # missing columns behave like row.get(name) returning None
+        return batch.get(name) or [None] * num_rows
+
+    return {
+        "parent_asin": [clean_parent_asin(v) for v in column("parent_asin")],
+        "title": [normalize_text(v) for v in column("title")],
+        "description": [normalize_text(v) for v in column("description")],
+        "main_category": [normalize_text(v) for v in column("main_category")],
+        "store": [normalize_text(v) for v in column("store")],
+        "average_rating": [clean_numeric(v, dtype="float", max_rating=5.0) for v in column("average_rating")],
+        "rating_number": [clean_numeric(v, dtype="int") for v in column("rating_number")],
+        "price": [clean_numeric(v, dtype="float", max_rating=None) for v in column("price")],
+    }
+
+
+def get_preprocess_cache_path(dataset: Dataset, cache_dir: str = PREPROCESS_CACHE_DIR):
+    """Cache location for a dataset, or None when the dataset has no fingerprint."""
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if not cache_dir or not fingerprint:
+        return None
+    return os.path.join(cache_dir, f"{fingerprint}-v{PREPROCESS_VERSION}")
+
+
+def preprocess_dataset(
+    dataset: Dataset,
+    batch_size: int = 1000,
+    num_proc: int = None,
+    cache_dir: str = PREPROCESS_CACHE_DIR,
+):
+    """
+    Main preprocessing pipeline for HuggingFace Dataset. Guarantees no None.
+
+    Rows are cleaned in column batches spread over num_proc processes (defaults to all cores).
+    The result is saved as Arrow under cache_dir, keyed by the input fingerprint and
+    PREPROCESS_VERSION, and memory-mapped back; unchanged inputs skip the work entirely.
+    Pass cache_dir=None to disable the cache.
+    """
+    from datasets import load_from_disk
+
+    cache_path = get_preprocess_cache_path(dataset, cache_dir)
+    if cache_path and os.path.exists(cache_path):
+        print(f"Loading preprocessed dataset from cache: {cache_path}")
+        return load_from_disk(cache_path)
+
+    if num_proc is None:
+        num_proc = os.cpu_count() or 1
+    # no point forking more workers than there are batches
+    num_proc = max(1, min(num_proc, -(-len(dataset) // batch_size)))
+
+    processed = dataset.map(
+        _preprocess_batch,
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc if num_proc > 1 else None,
+        remove_columns=dataset.column_names,
+        desc="Preprocessing dataset",
+    )
+
+    if cache_path is None:
+        return processed
+
+    tmp_path = f"{cache_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    processed.save_to_disk(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return load_from_disk(cache_path)